@@ -0,0 +1,324 @@
+"""Throughput benchmarks for mbstats hot path stages.
+
+Each stage is fed with lines from the synthetic generator, timed on its
+own, and reported as input log lines per second. A second pass, run with
+tracemalloc, reports allocated blocks and peak bytes per stage.
+
+Usage:
+
+    python -m benchmarks.bench --lines 100000 --save baseline.json
+    python -m benchmarks.bench --lines 100000 --compare baseline.json --threshold 0.1
+
+With --compare, exit code is 1 if any stage throughput dropped by more
+than threshold (ratio) compared to the baseline.
+"""
+
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict
+import json
+import os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mbstats.app import (
+    get_default_status,
+    get_storage,
+    mbsdict,
+    mbspostprocess,
+    process_bucket,
+)
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.catchup import MmapTailer
+from mbstats.influxdb1x import make_lines
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    compile_format,
+    parse_format,
+    parse_upstreams,
+)
+from mbstats.statusformat import (
+    dumps,
+    loads,
+)
+from pygtail import Pygtail
+
+from benchmarks.loggen import (
+    add_generator_arguments,
+    generator_from_args,
+)
+
+STAGES = (
+    'parseline',
+    'parse_upstreams',
+    'process_bucket',
+    'mbspostprocess',
+    '_add_points',
+    'make_lines',
+    'status_save',
+    'status_load',
+    'read_pygtail',
+    'read_mmap',
+)
+
+BUCKET_DURATION = 60
+
+# positions of fields in default log format
+POSITIONS = parse_format(DEFAULT_FORMAT)[1]
+
+# parser for default log format
+parseline = compile_format(DEFAULT_FORMAT)
+
+
+def prepare(lines):
+    """Builds inputs for each stage, returns a dict of stage -> callable"""
+    status = get_default_status(BUCKET_DURATION, 2, 10)
+    status = {k: v() for k, v in status.items()}
+    backend = InfluxBackend(Namespace(dry_run=True))
+    tags = {'host': 'bench', 'name': 'bench'}
+
+    upstreams = []
+    for line in lines:
+        items = line.split('|')
+        if items[POSITIONS['upstream_addr']] != '-':
+            upstreams.append(
+                {
+                    'upstream_addr': items[POSITIONS['upstream_addr']],
+                    'upstream_status': items[POSITIONS['upstream_status']],
+                    'upstream_response_time': items[
+                        POSITIONS['upstream_response_time']
+                    ],
+                    'upstream_connect_time': items[POSITIONS['upstream_connect_time']],
+                    'upstream_header_time': items[
+                        POSITIONS['upstream_header_time']
+                    ].rstrip('\r\n'),
+                }
+            )
+
+    parsed = []
+    for line in lines:
+        row, _last_msec, bucket = parseline(line, bucket_duration=BUCKET_DURATION)
+        parsed.append((bucket, row))
+
+    # results are kept, so allocations pass accounts for produced objects
+    def run_parseline():
+        return [parseline(line, bucket_duration=BUCKET_DURATION) for line in lines]
+
+    def run_parse_upstreams():
+        return [parse_upstreams(upstream) for upstream in upstreams]
+
+    def fill_storage():
+        storage = get_storage()
+        for bucket, row in parsed:
+            storage[bucket].append(row)
+        return storage
+
+    def run_process_bucket(storage):
+        mbs = mbsdict()
+        for bucket in list(storage):
+            process_bucket(bucket, storage, status, mbs)
+        return mbs
+
+    def build_mbs():
+        mbs = run_process_bucket(fill_storage())
+        mbspostprocess(mbs)
+        return mbs
+
+    mbs = build_mbs()
+    points = list(backend._add_points(mbs, status))
+    # worst case, all lines are leftovers
+    saved_status = dict(status, leftover=fill_storage())
+    saved = dumps(saved_status)
+
+    # catching up with a backlog, the directory is removed once runners are
+    # garbage collected
+    workdir = tempfile.TemporaryDirectory()
+
+    def path(name):
+        return os.path.join(workdir.name, name)
+
+    with open(path('bench.log'), 'w') as f:
+        f.writelines(lines)
+
+    def new_pygtail():
+        if os.path.exists(path('bench.offset')):
+            os.remove(path('bench.offset'))
+        return Pygtail(path('bench.log'), offset_file=path('bench.offset'))
+
+    def new_mmap_tailer():
+        return MmapTailer(path('bench.log'), 0, path('bench.offset'))
+
+    def read(tailer):
+        lines = list(tailer)
+        tailer.update_offset_file()
+        return lines
+
+    return {
+        'parseline': (None, lambda _arg: run_parseline()),
+        'parse_upstreams': (None, lambda _arg: run_parse_upstreams()),
+        'process_bucket': (fill_storage, run_process_bucket),
+        'mbspostprocess': (
+            lambda: run_process_bucket(fill_storage()),
+            mbspostprocess,
+        ),
+        '_add_points': (None, lambda _arg: list(backend._add_points(mbs, status))),
+        'make_lines': (
+            None,
+            lambda _arg: make_lines({'points': points, 'tags': tags}, precision='m'),
+        ),
+        'status_save': (None, lambda _arg: dumps(saved_status)),
+        'status_load': (None, lambda _arg: loads(saved)),
+        'read_pygtail': (new_pygtail, read),
+        'read_mmap': (new_mmap_tailer, read),
+    }
+
+
+def time_stage(setup, func, repeat):
+    """Returns the best duration over repeat runs, setup is not timed"""
+    best = None
+    for _i in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def trace_stage(setup, func):
+    """Returns (allocated blocks, peak bytes) for one run of the stage"""
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _peak = tracemalloc.get_traced_memory()
+        result = func(arg)
+        _current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(
+        stat.count_diff
+        for stat in after.compare_to(before, 'lineno')
+        if stat.count_diff > 0
+    )
+    return blocks, peak - base
+
+
+def run(lines, repeat=3, allocations=True, stages=STAGES):
+    results = defaultdict(dict)
+    runners = prepare(lines)
+    for stage in stages:
+        setup, func = runners[stage]
+        duration = time_stage(setup, func, repeat)
+        results[stage]['seconds'] = duration
+        results[stage]['lines_per_second'] = len(lines) / duration
+        if allocations:
+            blocks, peak = trace_stage(setup, func)
+            results[stage]['alloc_blocks'] = blocks
+            results[stage]['alloc_peak_bytes'] = peak
+    return dict(results)
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of (stage, current, baseline) for regressed stages"""
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        reference = baseline[stage]['lines_per_second']
+        current = result['lines_per_second']
+        if current < reference * (1.0 - threshold):
+            regressions.append((stage, current, reference))
+    return regressions
+
+
+def print_results(results, baseline=None, out=sys.stdout):
+    out.write(
+        '%-16s %14s %12s %14s %16s\n'
+        % ('stage', 'lines/s', 'vs baseline', 'alloc blocks', 'alloc peak bytes')
+    )
+    for stage, result in results.items():
+        if baseline and stage in baseline:
+            ratio = '%+.1f%%' % (
+                100.0
+                * (result['lines_per_second'] / baseline[stage]['lines_per_second'] - 1)
+            )
+        else:
+            ratio = '-'
+        out.write(
+            '%-16s %14.0f %12s %14s %16s\n'
+            % (
+                stage,
+                result['lines_per_second'],
+                ratio,
+                result.get('alloc_blocks', '-'),
+                result.get('alloc_peak_bytes', '-'),
+            )
+        )
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark mbstats hot path stages")
+    parser.add_argument(
+        '--lines', type=int, default=50000, help="number of lines to generate"
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3, help="number of timed runs per stage"
+    )
+    parser.add_argument(
+        '--stage', action='append', choices=STAGES, help="stage(s) to run"
+    )
+    parser.add_argument(
+        '--no-allocations',
+        action='store_true',
+        help="skip the tracemalloc allocations pass",
+    )
+    parser.add_argument('--save', metavar='FILE', help="save results as json")
+    parser.add_argument(
+        '--compare', metavar='FILE', help="compare with json results from --save"
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help="maximum allowed throughput drop ratio with --compare",
+    )
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    lines = list(generator_from_args(args).lines(args.lines))
+    results = run(
+        lines,
+        repeat=args.repeat,
+        allocations=not args.no_allocations,
+        stages=args.stage or STAGES,
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline=baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=4)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for stage, current, reference in regressions:
+            sys.stdout.write(
+                f"REGRESSION {stage}: {current:.0f} lines/s < {reference:.0f} lines/s"
+                f" (threshold {args.threshold:.0%})\n"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""End-to-end throughput harness, running main_loop() against a fake InfluxDB.
+
+Usage:
+
+    python -m benchmarks.e2e --lines 200000 --max-lines 50000 --latency 0.005
+"""
+
+from argparse import ArgumentParser
+from collections import defaultdict
+import math
+import os.path
+import sys
+import tempfile
+import time
+
+from mbstats.app import (
+    init_logger,
+    main_loop,
+)
+from mbstats.cmdline_options import parse_options
+
+from benchmarks.fakeinflux import FakeInfluxServer
+from benchmarks.loggen import (
+    add_generator_arguments,
+    generator_from_args,
+)
+
+
+def run(
+    generator,
+    lines=100000,
+    max_lines=20000,
+    batch_size=500,
+    latency=0.0,
+    error_rate=0.0,
+    partial_write_rate=0.0,
+    extra_args=None,
+):
+    """Runs main loops until all lines are parsed, returns a results dict"""
+    with tempfile.TemporaryDirectory() as workdir:
+        logfile = os.path.join(workdir, 'stats.log')
+        with open(logfile, 'w') as f:
+            f.writelines(generator.lines(lines))
+
+        with FakeInfluxServer(
+            latency=latency,
+            error_rate=error_rate,
+            partial_write_rate=partial_write_rate,
+        ) as server:
+            args = [
+                '-f',
+                logfile,
+                '-w',
+                workdir,
+                '--do-not-skip-to-end',
+                '--influx-host',
+                '127.0.0.1',
+                '--influx-port',
+                str(server.port),
+                '--influx-batch-size',
+                str(batch_size),
+                '--max-lines',
+                str(max_lines),
+                '--log-handler',
+                'file',
+                '-qq',
+            ]
+            options = parse_options(args + (extra_args or []))
+            logger = init_logger(options)
+
+            own_stats = defaultdict(float)
+            loops = math.ceil(lines / max_lines) if max_lines > 0 else 1
+            start = time.perf_counter()
+            for loop in range(loops):
+                fields = main_loop(options, logger, first_loop=loop == 0)
+                for k, v in fields.items():
+                    own_stats[k] += v
+            duration = time.perf_counter() - start
+
+            results = server.stats.as_dict()
+        results['loops'] = loops
+        results['duration_seconds'] = duration
+        results['lines_per_second'] = own_stats['parsed_lines'] / duration
+        results['points_per_second'] = results['points'] / duration
+        results['own_stats'] = dict(own_stats)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Run mbstats end-to-end on a fake InfluxDB")
+    parser.add_argument(
+        '--lines', type=int, default=100000, help="number of lines to generate"
+    )
+    parser.add_argument(
+        '--max-lines', type=int, default=20000, help="lines parsed per loop"
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=500, help="points per write request"
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help="write latency in seconds"
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0, help="ratio of failed writes"
+    )
+    parser.add_argument(
+        '--partial-write-rate',
+        type=float,
+        default=0.0,
+        help="ratio of partial writes",
+    )
+    add_generator_arguments(parser)
+    # spread lines over enough buckets to produce points at default scale
+    parser.set_defaults(rate=100.0)
+    args, extra_args = parser.parse_known_args()
+
+    results = run(
+        generator_from_args(args),
+        lines=args.lines,
+        max_lines=args.max_lines,
+        batch_size=args.batch_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        partial_write_rate=args.partial_write_rate,
+        extra_args=extra_args,
+    )
+    own_stats = results.pop('own_stats')
+    for k, v in results.items():
+        sys.stdout.write(
+            f"{k:24} {v:.0f}\n" if isinstance(v, float) else f"{k:24} {v}\n"
+        )
+    for k in sorted(own_stats):
+        if k.startswith('stage_'):
+            sys.stdout.write(f"{k:40} {own_stats[k]:.3f}\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""In-process stand-in for an InfluxDB 1.x HTTP server.
+
+Implements /ping, /write and /query (CREATE/DROP DATABASE, SHOW DATABASES),
+with configurable latency, error injection and partial write responses.
+
+Usage as a standalone server:
+
+    python -m benchmarks.fakeinflux --port 8086 --latency 0.01 --error-rate 0.05
+"""
+
+from argparse import ArgumentParser
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeInfluxStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.write_requests = 0
+        self.query_requests = 0
+        self.points = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.partial_writes = 0
+        self.dropped_points = 0
+
+    def as_dict(self):
+        with self.lock:
+            return {k: v for k, v in vars(self).items() if k != 'lock'}
+
+
+class FakeInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, payload=None):
+        body = b''
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _form_params(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return parse_qs(body.decode('utf-8'))
+        # urllib3 sends POST fields as multipart/form-data
+        message = BytesParser().parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+        )
+        params = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            params[name] = [part.get_payload(decode=True).decode('utf-8')]
+        return params
+
+    def _handle(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        body = self._read_body()
+        with server.stats.lock:
+            server.stats.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path == '/ping':
+            return self._reply(204)
+        if url.path == '/write':
+            return self._write(params, body)
+        if url.path == '/query':
+            if self.command == 'POST' and body:
+                params.update(self._form_params(body))
+            return self._query(params)
+        return self._reply(404, {'error': 'not found'})
+
+    def _write(self, params, body):
+        server = self.server
+        stats = server.stats
+        lines = [line for line in body.split(b'\n') if line]
+        with stats.lock:
+            stats.write_requests += 1
+            stats.bytes_received += len(body)
+            if server.rng.random() < server.error_rate:
+                stats.errors += 1
+                error = True
+            else:
+                error = False
+        if error:
+            return self._reply(500, {'error': 'injected server error'})
+
+        database = params.get('db', [''])[0]
+        if database not in server.databases:
+            return self._reply(404, {'error': f'database not found: "{database}"'})
+
+        dropped = 0
+        with stats.lock:
+            if lines and server.rng.random() < server.partial_write_rate:
+                dropped = max(1, len(lines) // 10)
+                stats.partial_writes += 1
+                stats.dropped_points += dropped
+            stats.points += len(lines) - dropped
+        if server.keep_lines:
+            with stats.lock:
+                server.lines.extend(lines[dropped:])
+        if dropped:
+            return self._reply(
+                400,
+                {
+                    'error': 'partial write: field type conflict: input field'
+                    ' "value" is type float, already exists as type integer'
+                    f' dropped={dropped}'
+                },
+            )
+        return self._reply(204)
+
+    def _query(self, params):
+        server = self.server
+        with server.stats.lock:
+            server.stats.query_requests += 1
+        query = params.get('q', [''])[0].strip()
+        m = re.match(r'(CREATE|DROP) DATABASE "?([^"]+)"?', query, re.IGNORECASE)
+        if m:
+            if m.group(1).upper() == 'CREATE':
+                server.databases.add(m.group(2))
+            else:
+                server.databases.discard(m.group(2))
+            return self._reply(200, {'results': [{'statement_id': 0}]})
+        if query.upper() == 'SHOW DATABASES':
+            series = {
+                'name': 'databases',
+                'columns': ['name'],
+                'values': [[name] for name in sorted(server.databases)],
+            }
+            return self._reply(
+                200, {'results': [{'statement_id': 0, 'series': [series]}]}
+            )
+        return self._reply(200, {'results': [{'statement_id': 0}]})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeInfluxServer(ThreadingHTTPServer):
+    """Threaded HTTP server, use as a context manager to run it in background
+
+    latency: seconds to wait before answering each request
+    error_rate: probability of answering a write with HTTP 500
+    partial_write_rate: probability of a write dropping 10% of its points
+    keep_lines: store received line protocol lines in self.lines
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        latency=0.0,
+        error_rate=0.0,
+        partial_write_rate=0.0,
+        keep_lines=False,
+        seed=0,
+    ):
+        super().__init__((host, port), FakeInfluxHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.partial_write_rate = partial_write_rate
+        self.keep_lines = keep_lines
+        self.rng = random.Random(seed)
+        self.databases = set()
+        self.lines = []
+        self.stats = FakeInfluxStats()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = ArgumentParser(description="Run a fake InfluxDB 1.x server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--partial-write-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeInfluxServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        partial_write_rate=args.partial_write_rate,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats.as_dict())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Synthetic generator for mbstats nginx stats log lines (format version 1).
+
+Usage:
+
+    python -m benchmarks.loggen --lines 100000 > /tmp/stats.log
+"""
+
+import argparse
+import random
+import sys
+
+DEFAULT_STATUS_MIX = '200:85,304:5,404:5,499:1,500:2,502:2'
+
+
+def parse_status_mix(status_mix):
+    """Converts '200:85,404:5' to ([200, 404], [85, 5])"""
+    statuses = []
+    weights = []
+    for item in status_mix.split(','):
+        status, weight = item.split(':')
+        statuses.append(int(status))
+        weights.append(float(weight))
+    return statuses, weights
+
+
+class LogGenerator:
+    """Generates stats log lines with tunable cardinality and shape
+
+    vhosts, loctags, upstreams: number of distinct values for each tag
+    chain_length: maximum number of upstream servers contacted per request
+    redirect_rate: probability of an internal redirect on an upstream
+    out_of_order_rate: probability a line is logged late, up to max_lateness
+    no_upstream_rate: probability a request has no upstream at all
+    gzip_rate: probability a response is gzipped
+    status_mix: comma-separated status:weight pairs
+    rate: number of lines per second of simulated traffic
+    """
+
+    def __init__(
+        self,
+        vhosts=10,
+        loctags=3,
+        upstreams=4,
+        chain_length=1,
+        redirect_rate=0.0,
+        out_of_order_rate=0.0,
+        max_lateness=5.0,
+        no_upstream_rate=0.1,
+        gzip_rate=0.3,
+        status_mix=DEFAULT_STATUS_MIX,
+        rate=1000.0,
+        start=1568962563.0,
+        seed=0,
+    ):
+        self.rng = random.Random(seed)
+        self.vhosts = [f'vhost{i}.example.org' for i in range(vhosts)]
+        self.loctags = ['-'] + [f'loc{i}' for i in range(loctags - 1)]
+        self.upstreams = [f'10.2.2.{i + 10}:65412' for i in range(upstreams)]
+        self.chain_length = max(1, chain_length)
+        self.redirect_rate = redirect_rate
+        self.out_of_order_rate = out_of_order_rate
+        self.max_lateness = max_lateness
+        self.no_upstream_rate = no_upstream_rate
+        self.gzip_rate = gzip_rate
+        self.statuses, self.status_weights = parse_status_mix(status_mix)
+        self.step = 1.0 / rate
+        self.msec = start
+
+    def _upstream_fields(self, status):
+        rng = self.rng
+        addrs = []
+        statuses = []
+        response_times = []
+        connect_times = []
+        header_times = []
+        for _i in range(rng.randint(1, self.chain_length)):
+            group = [rng.choice(self.upstreams)]
+            if rng.random() < self.redirect_rate:
+                group.append(rng.choice(self.upstreams))
+            addrs.append(' : '.join(group))
+            statuses.append(' : '.join(str(status) for _addr in group))
+            response_times.append(
+                ' : '.join('%.3f' % rng.expovariate(20.0) for _addr in group)
+            )
+            connect_times.append(
+                ' : '.join('%.3f' % rng.expovariate(1000.0) for _addr in group)
+            )
+            header_times.append(
+                ' : '.join('%.3f' % rng.expovariate(25.0) for _addr in group)
+            )
+        return [
+            ', '.join(addrs),
+            ', '.join(statuses),
+            ', '.join(response_times),
+            ', '.join(connect_times),
+            ', '.join(header_times),
+        ]
+
+    def line(self):
+        rng = self.rng
+        self.msec += self.step
+        msec = self.msec
+        if rng.random() < self.out_of_order_rate:
+            msec -= rng.uniform(0, self.max_lateness)
+        status = rng.choices(self.statuses, self.status_weights)[0]
+        if rng.random() < self.gzip_rate:
+            gzip_ratio = '%.2f' % rng.uniform(1.0, 8.0)
+        else:
+            gzip_ratio = '-'
+        if rng.random() < self.no_upstream_rate:
+            upstream = ['-', '-', '-', '-', '-']
+        else:
+            upstream = self._upstream_fields(status)
+        fields = [
+            '1',
+            '%.3f' % msec,
+            rng.choice(self.vhosts),
+            rng.choice(('-', 's')),
+            rng.choice(self.loctags),
+            str(status),
+            str(rng.randint(100, 50000)),
+            gzip_ratio,
+            str(rng.randint(100, 2000)),
+            '%.3f' % rng.expovariate(20.0),
+        ] + upstream
+        return '|'.join(fields) + '\n'
+
+    def lines(self, count):
+        for _i in range(count):
+            yield self.line()
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--vhosts', type=int, default=10, help="number of vhosts")
+    parser.add_argument('--loctags', type=int, default=3, help="number of loctags")
+    parser.add_argument(
+        '--upstreams', type=int, default=4, help="number of upstream servers"
+    )
+    parser.add_argument(
+        '--chain-length',
+        type=int,
+        default=1,
+        help="maximum number of upstream servers contacted per request",
+    )
+    parser.add_argument(
+        '--redirect-rate',
+        type=float,
+        default=0.0,
+        help="probability of an internal redirect",
+    )
+    parser.add_argument(
+        '--out-of-order-rate',
+        type=float,
+        default=0.0,
+        help="probability of a line logged late",
+    )
+    parser.add_argument(
+        '--max-lateness',
+        type=float,
+        default=5.0,
+        help="maximum lateness in seconds of out-of-order lines",
+    )
+    parser.add_argument(
+        '--no-upstream-rate',
+        type=float,
+        default=0.1,
+        help="probability of a request without upstream",
+    )
+    parser.add_argument(
+        '--gzip-rate', type=float, default=0.3, help="probability of gzip"
+    )
+    parser.add_argument(
+        '--status-mix',
+        default=DEFAULT_STATUS_MIX,
+        help="comma-separated status:weight pairs",
+    )
+    parser.add_argument(
+        '--rate', type=float, default=1000.0, help="lines per simulated second"
+    )
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+
+
+def generator_from_args(args):
+    return LogGenerator(
+        vhosts=args.vhosts,
+        loctags=args.loctags,
+        upstreams=args.upstreams,
+        chain_length=args.chain_length,
+        redirect_rate=args.redirect_rate,
+        out_of_order_rate=args.out_of_order_rate,
+        max_lateness=args.max_lateness,
+        no_upstream_rate=args.no_upstream_rate,
+        gzip_rate=args.gzip_rate,
+        status_mix=args.status_mix,
+        rate=args.rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic stats log")
+    parser.add_argument(
+        '--lines', type=int, default=10000, help="number of lines to generate"
+    )
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    sys.stdout.writelines(generator_from_args(args).lines(args.lines))
+
+
+if __name__ == '__main__':
+    main()
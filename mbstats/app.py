@@ -45,11 +45,7 @@ from collections import (
     defaultdict,
     deque,
 )
-from enum import (
-    IntEnum,
-    unique,
-)
-import itertools
+import functools
 import logging.config
 import logging.handlers
 import math
@@ -62,225 +58,233 @@ from pygtail import Pygtail
 
 from mbstats.backends import BackendDryRun
 from mbstats.backends.influxdb import InfluxBackend
+from mbstats.cardinality import (
+    get_limiters,
+    limiters_stats,
+    parse_limits,
+)
+from mbstats.catchup import MmapTailer
 from mbstats.cmdline_options import (
     ParseOptionsSysExit,
     parse_options,
 )
+from mbstats.dimensions import (
+    STATUS_MEASUREMENTS,
+    UPSTREAM_MEASUREMENTS,
+    Dimensions,
+)
+from mbstats.idle import IdleCheck
 from mbstats.locker import (
     Locker,
     LockingError,
 )
+from mbstats.logformat import (
+    ParseFiltered,
+    ParseLate,
+    ParseSkip,
+    compile_format,
+    custom_measurements,
+    enabled_groups,
+    parse_filters,
+)
+from mbstats.lookback import (
+    adapt_lookback,
+    decay_lateness,
+)
+from mbstats.memory import (
+    AllocationSites,
+    memory_stats,
+    start_tracing,
+)
+from mbstats.normalize import parse_normalize
+from mbstats.overload import (
+    adapt_sampling,
+    pending_bytes,
+)
+from mbstats.profiling import (
+    LoopProfiler,
+    StackSampler,
+)
 from mbstats.safefile import SafeFile
+from mbstats.sketch import (
+    DDSketch,
+    parse_percentiles,
+    percentile_suffix,
+)
+from mbstats.thresholds import (
+    LatencyThresholds,
+    classify,
+)
 from mbstats.utils import (
+    StageTimer,
     bucket2time,
     load_obj,
     msec2bucket,
+    parse_rollups,
     save_obj,
 )
 
 
-# https://github.com/metabrainz/openresty-gateways/blob/master/files/nginx/nginx.conf#L23
-@unique
-class PosField(IntEnum):
-    version = 0
-    msec = 1
-    vhost = 2
-    protocol = 3
-    loctag = 4
-    status = 5
-    bytes_sent = 6
-    gzip_ratio = 7
-    request_length = 8
-    request_time = 9
-    upstream_addr = 10
-    upstream_status = 11
-    upstream_response_time = 12
-    upstream_connect_time = 13
-    upstream_header_time = 14
-
-
-def factory():
-    return lambda x: x
-
-
-types = defaultdict(factory)
-# pylint: disable=W0108
-types['upstream_status'] = lambda x: int(x)
-types['upstream_response_time'] = types['upstream_connect_time'] = types[
-    'upstream_header_time'
-] = lambda x: float(x)
-# pylint: enable=W0108
-
-
-# @profile
-
-
-def parse_upstreams(row):
-    # servers were contacted ", "
-    # internal redirect " : "
-    r = dict()
-    splitted = [x.split(' : ') for x in row['upstream_addr'].split(", ")]
-    r['servers_contacted'] = len(splitted)
-    r['internal_redirects'] = len([x for x in splitted if len(x) > 1])
-    upstream_addr = list(itertools.chain.from_iterable(splitted))
-
-    upstream_status = list(
-        itertools.chain.from_iterable(
-            [x.split(' : ') for x in row['upstream_status'].split(", ")]
-        )
-    )
-    upstream_response_time = list(
-        itertools.chain.from_iterable(
-            [x.split(' : ') for x in row['upstream_response_time'].split(", ")]
-        )
-    )
-    upstream_header_time = list(
-        itertools.chain.from_iterable(
-            [x.split(' : ') for x in row['upstream_header_time'].split(", ")]
-        )
-    )
-    upstream_connect_time = list(
-        itertools.chain.from_iterable(
-            [x.split(' : ') for x in row['upstream_connect_time'].split(", ")]
-        )
-    )
-
-    r['status'] = dict()
-    r['response_time'] = defaultdict(float)
-    r['connect_time'] = defaultdict(float)
-    r['header_time'] = defaultdict(float)
-    r['response_time_count'] = defaultdict(int)
-    r['connect_time_count'] = defaultdict(int)
-    r['header_time_count'] = defaultdict(int)
-    r['servers'] = []
-    for item in zip(
-        upstream_addr,
-        upstream_status,
-        upstream_response_time,
-        upstream_connect_time,
-        upstream_header_time,
-    ):
-        k = item[0]
-        r['servers'].append(k)
-        # not using defauldict() here intentionally, because it requires lamba/function
-        # and it breaks with pickle
-        if k not in r['status']:
-            r['status'][k] = dict()
-
-        # ensure status code is an integer (but it is stored as string), this
-        # should raise ValueError if it can't be converted
-        if item[1] != '-':
-            status = str(int(item[1]))
-        else:
-            status = item[1]
-        if status in r['status'][k]:
-            r['status'][k][status] += 1
-        else:
-            r['status'][k][status] = 1
-
-        if item[2] not in ('-', ''):
-            try:
-                r['response_time'][k] += float(item[2])
-                r['response_time_count'][k] += 1
-            except ValueError:
-                raise
-
-        if item[3] not in ('-', ''):
-            try:
-                r['connect_time'][k] += float(item[3])
-                r['connect_time_count'][k] += 1
-            except ValueError:
-                raise
-
-        if item[4] not in ('-', ''):
-            try:
-                r['header_time'][k] += float(item[4])
-                r['header_time_count'][k] += 1
-            except ValueError:
-                raise
-
-    return r
-
-
 class ParseEnd(Exception):
     pass
 
 
-class ParseSkip(Exception):
-    pass
-
-
-def parseline(line, last_msec=0, ignore_before=0, bucket_duration=60):
-    items = line.split('|')
-    if items[0] != '1':
-        raise ParseSkip(f"invalid log version: {items[0]}")
-    try:
-        msec = float(items[PosField.msec])
-    except ValueError as e:
-        raise ParseSkip(str(e))
-    if msec <= ignore_before:
-        # skip unordered & old entries
-        raise ParseSkip("unordered or old entry")
-    try:
-        row = {
-            'vhost': items[PosField.vhost],
-            'protocol': items[PosField.protocol],
-            'loctag': items[PosField.loctag],
-            'status': int(items[PosField.status]),
-            'bytes_sent': int(items[PosField.bytes_sent]),
-            'request_length': int(items[PosField.request_length]),
-        }
-
-        if items[PosField.gzip_ratio] != '-':
-            row['gzip_ratio'] = float(items[PosField.gzip_ratio])
-        if items[PosField.request_time] != '-':
-            row['request_time'] = float(items[PosField.request_time])
+def get_parser(options):
+    """Compiles the log lines parser for options, see compile_format()"""
+    return compile_format(
+        options.log_format,
+        enabled_groups(options.disable_measurements),
+        include=parse_filters(options.include_lines),
+        exclude=parse_filters(options.exclude_lines),
+        normalize=parse_normalize(options.normalize_tags),
+        normalize_cache_size=options.normalize_cache_size,
+    )
 
-        if items[PosField.upstream_addr] != '-':
-            # Note : last element contains trailing new line character
-            # from readline()
-            upstreams = {
-                'upstream_addr': items[PosField.upstream_addr],
-                'upstream_status': items[PosField.upstream_status],
-                'upstream_response_time': items[PosField.upstream_response_time],
-                'upstream_connect_time': items[PosField.upstream_connect_time],
-                'upstream_header_time': items[PosField.upstream_header_time].rstrip(
-                    '\r\n'
-                ),
-            }
 
-            row['upstreams'] = parse_upstreams(upstreams)
-    except ValueError as e:
-        raise ParseSkip(str(e))
+def get_storage():
+    return defaultdict(deque)
 
-    if msec > last_msec:
-        last_msec = msec
-    bucket = msec2bucket(msec, bucket_duration)
 
-    return row, last_msec, bucket
+def parse_budget_reached(parsed_lines, parsed_bytes, options, deadline, scale=1):
+    """Returns a reason string if a per-loop parsing budget is exhausted
 
+    Lines budget is multiplied by scale, ie. when only 1 in scale lines is
+    parsed; bytes and seconds budgets are hard limits on reading.
+    """
+    if parsed_lines == options.max_lines * scale:
+        return "max_lines=%d" % (options.max_lines * scale)
+    if options.max_bytes > 0 and parsed_bytes >= options.max_bytes:
+        return "max_bytes=%d" % options.max_bytes
+    if deadline and time.time() >= deadline:
+        return "max_seconds=%0.3f" % options.max_seconds
+    return None
 
-def get_storage():
-    return defaultdict(deque)
 
+def log_skipped(skipped, options, logger=None):
+    """Logs a summary of skipped lines per reason
 
-def parsefile(tailer, status, options, logger=None, first_loop=False):
+    Only the first --skip-log-limit lines per reason are logged one by one.
+    """
+    if not logger:
+        return
+    total = sum(skipped.values())
+    summary = ' '.join(
+        '%s=%d' % (reason, count) for reason, count in sorted(skipped.items())
+    )
+    not_logged = sum(
+        count - options.skip_log_limit
+        for reason, count in skipped.items()
+        if count > options.skip_log_limit and reason != ParseFiltered.reason
+    )
+    if not_logged:
+        logger.warning(
+            "Skipped %d lines (%s), %d not logged" % (total, summary, not_logged)
+        )
+    elif options.quiet < 2:
+        logger.info("Skipped %d lines (%s)" % (total, summary))
+
+
+def parsefile(
+    tailer,
+    status,
+    options,
+    logger=None,
+    first_loop=False,
+    timer=None,
+    emit=None,
+    previous_lookback_factor=None,
+    parse=None,
+    flush_before=None,
+):
+    """Parses new lines from tailer and aggregates them per bucket
+
+    Lines are parsed by parse, as returned by get_parser(options), which is
+    compiled if not passed.
+
+    If emit is set, buckets that can't receive more lines are removed from
+    mbs as soon as possible, post-processed and passed to emit(), along with
+    the time in seconds before which all buckets were emitted. Lines older
+    than the lookback window are then skipped, as between loops.
+
+    If previous_lookback_factor differs from status['lookback_factor'], lines
+    for buckets processed during previous loop are still skipped, and
+    leftover buckets which became ready are processed first.
+
+    If status['sampling_rate'] is more than 1, only 1 in N lines is parsed
+    and each stored row carries N as its weight, see process_bucket().
+
+    If flush_before (in seconds) is set, ie. when the log file is idle,
+    leftover buckets are processed as if a line logged at flush_before was
+    parsed, and last_msec is moved to flush_before.
+    """
+    if timer is None:
+        timer = StageTimer()
     parsed_lines = 0
+    parsed_bytes = 0
     skipped_lines = 0
     first_run = False
-    max_lines = options.max_lines
+    if options.max_seconds > 0:
+        deadline = time.time() + options.max_seconds
+    else:
+        deadline = 0
     bucket_duration = status['bucket_duration']
     lookback_factor = status['lookback_factor']
-    mbs = mbsdict()
+    sampling_rate = status['sampling_rate']
+    sampled_out = 0
+    if previous_lookback_factor is None:
+        previous_lookback_factor = lookback_factor
+    percentiles = parse_percentiles(options.percentiles)
+    thresholds = LatencyThresholds(options.latency_thresholds) or None
+    dimensions = Dimensions(options.drop_tags) or None
+    if parse is None:
+        parse = get_parser(options)
+    custom = parse.custom
+    if percentiles:
+        mbs = mbsdict(
+            sketch_factory=functools.partial(DDSketch, options.percentiles_accuracy),
+            custom=custom,
+        )
+    else:
+        mbs = mbsdict(custom=custom)
+    late_grace = options.late_grace_buckets
+    lateness = status['lateness'] if options.adaptive_lookback else None
     # lines are logged when request ends, which means they can be unordered
     if not status['last_msec']:
         ignore_before = 0
+        skip_before = 0
+        newest_bucket = 0
+    else:
+        ignore_before = status['last_msec'] - bucket_duration * previous_lookback_factor
+        # late lines are aggregated to buckets already processed
+        skip_before = ignore_before - bucket_duration * late_grace
+        newest_bucket = msec2bucket(status['last_msec'], bucket_duration)
+    if late_grace and ignore_before:
+        processed_until = msec2bucket(ignore_before, bucket_duration) - 1
     else:
-        ignore_before = status['last_msec'] - bucket_duration * lookback_factor
+        processed_until = None
+    # buckets before skip_before won't be aggregated again
+    limiters = (
+        get_limiters(
+            status['cardinality'],
+            parse_limits(options.cardinality_limits),
+            keep_from=msec2bucket(skip_before, bucket_duration)
+            if skip_before
+            else None,
+        )
+        or None
+    )
     if logger:
         logger.debug(
-            "max_lines=%d bucket_duration=%d lookback_factor=%d ignore_before=%f"
-            % (max_lines, bucket_duration, lookback_factor, ignore_before)
+            "max_lines=%d max_bytes=%d max_seconds=%0.3f bucket_duration=%d"
+            " lookback_factor=%d ignore_before=%f"
+            % (
+                options.max_lines,
+                options.max_bytes,
+                options.max_seconds,
+                bucket_duration,
+                lookback_factor,
+                ignore_before,
+            )
         )
     last_msec = 0
     last_bucket = 0
@@ -297,28 +301,57 @@ def parsefile(tailer, status, options, logger=None, first_loop=False):
                         len(storage[bucket]),
                     )
                 )
+        if previous_lookback_factor > lookback_factor and newest_bucket:
+            # those buckets won't be processed with the new lookback factor
+            for bucket in sorted(storage):
+                if (
+                    newest_bucket - previous_lookback_factor
+                    < bucket
+                    <= newest_bucket - lookback_factor
+                    and storage[bucket]
+                ):
+                    with timer.measure('aggregate'):
+                        process_bucket(
+                            bucket,
+                            storage,
+                            status,
+                            mbs,
+                            thresholds=thresholds,
+                            limiters=limiters,
+                            dimensions=dimensions,
+                            normalize_upstream=parse.normalize_upstream,
+                            custom=custom,
+                        )
     else:
         storage = get_storage()
         if logger:
             logger.info("First run")
         first_run = first_loop and not options.do_not_skip_to_end
     bucket = 0
+    emitted_before = 0
+    skipped = defaultdict(int)
+    loop_start = time.perf_counter()
+    accounted_before = timer.total()
     if first_run:
         # code duplication here, intentional
         try:
-            for line in tailer:
+            for line in timer.timed_iter(tailer, 'read'):
                 parsed_lines += 1
+                parsed_bytes += len(line)
                 try:
-                    items = line.split('|', 2)
-                    msec = float(items[PosField.msec])
+                    items = line.split('|', parse.msec_index + 1)
+                    msec = float(items[parse.msec_index])
                     if msec > last_msec:
                         last_msec = msec
                     bucket = int(math.ceil(msec / bucket_duration))
                 except ValueError as e:
                     logger.error(str(e), line)
                     raise
-                if parsed_lines == max_lines:
-                    raise ParseEnd
+                reason = parse_budget_reached(
+                    parsed_lines, parsed_bytes, options, deadline
+                )
+                if reason:
+                    raise ParseEnd(reason)
         except ParseEnd:
             pass
         # ensure we start on an entire bucket, so values are correct
@@ -331,19 +364,49 @@ def parsefile(tailer, status, options, logger=None, first_loop=False):
             )
     else:
         try:
-            for line in tailer:
+            for line in timer.timed_iter(tailer, 'read'):
                 parsed_lines += 1
+                parsed_bytes += len(line)
+                if sampling_rate > 1 and parsed_lines % sampling_rate:
+                    # deterministic 1 in N sampling, budget is checked on
+                    # sampled lines only, bytes budget may be exceeded by
+                    # less than N lines
+                    sampled_out += 1
+                    continue
                 try:
-                    row, last_msec, bucket = parseline(
+                    row, last_msec, bucket = parse(
                         line,
-                        ignore_before=ignore_before,
+                        ignore_before=skip_before,
                         bucket_duration=bucket_duration,
                         last_msec=last_msec,
                     )
+                    if sampling_rate > 1:
+                        # row stands for N lines, even if it is processed
+                        # in a later loop, at another rate
+                        row['sampling'] = sampling_rate
                     storage[bucket].append(row)
                     ready_to_process = bucket - lookback_factor
-
-                    if storage[ready_to_process]:
+                    if lateness is not None:
+                        if bucket > newest_bucket:
+                            newest_bucket = bucket
+                        late = min(newest_bucket - bucket, options.lookback_factor)
+                        lateness[late] = lateness.get(late, 0) + 1
+
+                    if processed_until is not None and bucket <= processed_until:
+                        timer.count('late_lines')
+                        with timer.measure('aggregate'):
+                            process_bucket(
+                                bucket,
+                                storage,
+                                status,
+                                mbs,
+                                thresholds=thresholds,
+                                limiters=limiters,
+                                dimensions=dimensions,
+                                normalize_upstream=parse.normalize_upstream,
+                                custom=custom,
+                            )
+                    elif storage[ready_to_process]:
                         if logger and options.quiet < 2:
                             logger.info(
                                 "Processing bucket: %s %d"
@@ -354,23 +417,123 @@ def parsefile(tailer, status, options, logger=None, first_loop=False):
                                     len(storage[ready_to_process]),
                                 )
                             )
-                        process_bucket(ready_to_process, storage, status, mbs)
+                        with timer.measure('aggregate'):
+                            process_bucket(
+                                ready_to_process,
+                                storage,
+                                status,
+                                mbs,
+                                thresholds=thresholds,
+                                limiters=limiters,
+                                dimensions=dimensions,
+                                normalize_upstream=parse.normalize_upstream,
+                                custom=custom,
+                            )
+                        if late_grace:
+                            processed_until = max(
+                                processed_until or 0, ready_to_process
+                            )
+                        if emit is not None:
+                            # next lines can't be older than ignore_before, so
+                            # buckets before horizon won't be processed again
+                            horizon = (
+                                msec2bucket(
+                                    last_msec - bucket_duration * lookback_factor,
+                                    bucket_duration,
+                                )
+                                - lookback_factor
+                            )
+                            if horizon > emitted_before:
+                                ignore_before = max(
+                                    ignore_before,
+                                    last_msec - bucket_duration * lookback_factor,
+                                )
+                                skip_before = (
+                                    ignore_before - bucket_duration * late_grace
+                                )
+                                emitted_before = horizon
+                                with timer.measure('emit'):
+                                    emit_buckets(
+                                        mbs,
+                                        storage,
+                                        status,
+                                        percentiles,
+                                        horizon,
+                                        emit,
+                                        late_grace=late_grace,
+                                        logger=logger,
+                                        timer=timer,
+                                        custom=custom,
+                                    )
                 except ParseSkip as e:
-                    if logger:
-                        logger.error(f"{line}: {e}")
+                    if lateness is not None and isinstance(e, ParseLate):
+                        # at least as late as the lookback window
+                        late = min(lookback_factor, options.lookback_factor)
+                        lateness[late] = lateness.get(late, 0) + 1
                     skipped_lines += 1
+                    skipped[e.reason] += 1
+                    if logger and e.log and skipped[e.reason] <= options.skip_log_limit:
+                        logger.error(f"{line}: {e}")
                 except Exception as e:
                     if logger:
                         logger.error(f"{line}: {e}")
                     raise
-                if parsed_lines == max_lines:
-                    raise ParseEnd
-        except ParseEnd:
-            pass
-        if skipped_lines and logger and options.quiet < 2:
-            logger.info("Skipped %d unordered lines" % skipped_lines)
+                reason = parse_budget_reached(
+                    parsed_lines, parsed_bytes, options, deadline, scale=sampling_rate
+                )
+                if reason:
+                    raise ParseEnd(reason)
+        except ParseEnd as e:
+            if logger and options.quiet < 2:
+                logger.info(
+                    "Parsing budget reached (%s), leaving remaining lines for next loop"
+                    % e
+                )
+        if skipped_lines:
+            log_skipped(skipped, options, logger=logger)
+            for reason, count in skipped.items():
+                timer.count(f'skipped_lines_{reason}', count)
+        if sampled_out:
+            timer.count('sampled_out_lines', sampled_out)
+
+    if flush_before is not None:
+        flush_bucket = msec2bucket(flush_before, bucket_duration) - lookback_factor
+        for ready in sorted(storage):
+            if ready <= flush_bucket and storage[ready]:
+                if logger and options.quiet < 2:
+                    logger.info(
+                        "Flushing bucket: %s %d"
+                        % (bucket2time(ready, bucket_duration), len(storage[ready]))
+                    )
+                with timer.measure('aggregate'):
+                    process_bucket(
+                        ready,
+                        storage,
+                        status,
+                        mbs,
+                        thresholds=thresholds,
+                        limiters=limiters,
+                        dimensions=dimensions,
+                        normalize_upstream=parse.normalize_upstream,
+                        custom=custom,
+                    )
+        if flush_before > last_msec:
+            last_msec = flush_before
+
+    # parsing is what remains of the loop once other stages (reading,
+    # aggregation, emission) are accounted, it avoids timing each line twice;
+    # reading time being estimated, it may exceed what remains
+    timer.add(
+        'parse',
+        max(
+            time.perf_counter() - loop_start - (timer.total() - accounted_before),
+            0.0,
+        ),
+    )
+    timer.count('read_bytes', parsed_bytes)
 
-    tailer.update_offset_file()
+    with timer.measure('offset_commit'):
+        tailer.update_offset_file()
     last_bucket = bucket
     leftover = get_storage()
     for bucket in storage:
@@ -389,12 +552,77 @@ def parsefile(tailer, status, options, logger=None, first_loop=False):
                     )
                 )
 
-    mbspostprocess(mbs)
+    with timer.measure('postprocess'):
+        mbspostprocess(mbs, custom)
+        if percentiles:
+            # sketches of buckets that can still receive lines are kept
+            keep_from = msec2bucket(
+                last_msec - bucket_duration * (lookback_factor + late_grace),
+                bucket_duration,
+            )
+            mbspercentiles(mbs, status['sketches'], percentiles, keep_from)
     return (mbs, leftover, last_msec, parsed_lines, skipped_lines)
 
 
-def mbsdict():
-    return {
+def emit_buckets(
+    mbs,
+    storage,
+    status,
+    percentiles,
+    before,
+    emit,
+    late_grace=0,
+    logger=None,
+    timer=None,
+    custom=(),
+):
+    """Moves buckets before `before` out of mbs and passes them to emit()
+
+    Unprocessed rows of those buckets are dropped, like leftovers which are
+    too old at end of loop.
+    """
+    if timer is None:
+        timer = StageTimer()
+    for bucket in [bucket for bucket in storage if bucket < before]:
+        del storage[bucket]
+    part = mbssplit(mbs, before)
+    if not any(part.values()):
+        return
+    if logger:
+        logger.debug(
+            "Emitting buckets before %s"
+            % bucket2time(before, status['bucket_duration'])
+        )
+    with timer.measure('postprocess'):
+        mbspostprocess(part, custom)
+        if percentiles:
+            keep_from = before + status['lookback_factor'] - late_grace
+            mbspercentiles(part, status['sketches'], percentiles, keep_from)
+    emit(part, (before - 1) * status['bucket_duration'])
+
+
+# counters indexed by mbstats.thresholds.classify() result
+APDEX = {
+    'request_time': (
+        'request_time_satisfied',
+        'request_time_tolerating',
+        'request_time_frustrated',
+    ),
+    'upstreams_response_time': (
+        'upstreams_response_time_satisfied',
+        'upstreams_response_time_tolerating',
+        'upstreams_response_time_frustrated',
+    ),
+}
+
+SKETCHES = {
+    'request_time': '_request_time_sketch',
+    'upstreams_response_time': '_upstreams_response_time_sketch',
+}
+
+
+def mbsdict(sketch_factory=None, custom=()):
+    mbs = {
         'bytes_sent': defaultdict(int),
         'gzip_count': defaultdict(int),
         'gzip_count_percent': defaultdict(float),
@@ -423,78 +651,215 @@ def mbsdict():
         'upstreams_servers_contacted_per_hit': defaultdict(float),
         'upstreams_servers': defaultdict(int),
         'upstreams_status': defaultdict(int),
+        'request_time_satisfied': defaultdict(int),
+        'request_time_tolerating': defaultdict(int),
+        'request_time_frustrated': defaultdict(int),
+        'request_time_apdex': defaultdict(float),
+        'upstreams_response_time_satisfied': defaultdict(int),
+        'upstreams_response_time_tolerating': defaultdict(int),
+        'upstreams_response_time_frustrated': defaultdict(int),
+        'upstreams_response_time_apdex': defaultdict(float),
+        # highest sampling rate of rows per bucket, see process_bucket()
+        '_sampling': defaultdict(int),
     }
-
-
-def process_bucket(bucket, storage, status, mbs):
+    if sketch_factory is not None:
+        for key in SKETCHES.values():
+            mbs[key] = defaultdict(sketch_factory)
+    if custom:
+        additive, means = custom_measurements(custom)
+        for measurement, conversion in additive:
+            mbs[measurement] = defaultdict(conversion)
+        for measurement in means:
+            mbs[measurement] = defaultdict(float)
+    return mbs
+
+
+def process_bucket(
+    bucket,
+    storage,
+    status,
+    mbs,
+    thresholds=None,
+    limiters=None,
+    dimensions=None,
+    normalize_upstream=None,
+    custom=(),
+):
+    """Aggregates rows of bucket from storage into mbs
+
+    Upstream addresses are normalized here, after values of each server
+    were accumulated by parse_upstreams(), so servers mapped to the same
+    tag are still counted separately. Rows sampled 1 in N lines count as N
+    lines, buckets are flagged in _sampling, see --overload-seconds. Fields
+    declared in log format are aggregated as custom_measurements() tells.
+    """
+    sampling = mbs['_sampling']
+    # (field, sums, counts or None)
+    custom_sums = []
+    for name, _conversion, aggregation in custom:
+        if aggregation == 'sum':
+            custom_sums.append((name, mbs[f'{name}_sum'], None))
+        else:
+            custom_sums.append((name, mbs[f'_{name}_premean'], mbs[f'_{name}_count']))
+    request_time_sketch = mbs.get('_request_time_sketch')
+    upstreams_response_time_sketch = mbs.get('_upstreams_response_time_sketch')
+    if thresholds:
+        request_time_apdex = [mbs[k] for k in APDEX['request_time']]
+        upstreams_apdex = [mbs[k] for k in APDEX['upstreams_response_time']]
+    threshold = None
+    limit_vhost = limit_loctag = limit_upstream = None
+    if limiters:
+        limit_vhost = limiters.get('vhost')
+        limit_loctag = limiters.get('loctag')
+        limit_upstream = limiters.get('upstream')
+    drop_vhost = drop_protocol = drop_loctag = False
+    keep_upstream = dict.fromkeys(UPSTREAM_MEASUREMENTS, True)
+    keep_status = dict.fromkeys(STATUS_MEASUREMENTS, True)
+    if dimensions:
+        drop_vhost = 'vhost' in dimensions.common
+        drop_protocol = 'protocol' in dimensions.common
+        drop_loctag = 'loctag' in dimensions.common
+        keep_upstream = dimensions.upstream
+        keep_status = dimensions.status
+    keep_upstreams_hits = keep_upstream['upstreams_hits']
+    keep_upstreams_status = keep_upstream['upstreams_status']
+    keep_response_time = keep_upstream['upstreams_response_time_mean']
+    keep_connect_time = keep_upstream['upstreams_connect_time_mean']
+    keep_header_time = keep_upstream['upstreams_header_time_mean']
+    keep_apdex = keep_upstream['upstreams_response_time_apdex']
+    keep_sketch = keep_upstream['upstreams_response_time_percentiles']
+    keep_status_status = keep_status['status']
+    keep_upstreams_status_status = keep_status['upstreams_status']
     while True:
         try:
             row = storage[bucket].pop()
-
-            tags = (bucket, row['vhost'], row['protocol'], row['loctag'])
-            mbs['hits'][tags] += 1
-            mbs['bytes_sent'][tags] += row['bytes_sent']
+            weight = row.get('sampling', 1)
+            if weight > 1 and sampling[(bucket,)] < weight:
+                sampling[(bucket,)] = weight
+
+            vhost = row['vhost']
+            protocol = row['protocol']
+            loctag = row['loctag']
+            if thresholds:
+                threshold = thresholds.get(vhost, loctag)
+            if limit_vhost is not None:
+                vhost = limit_vhost(vhost, bucket, weight)
+            if limit_loctag is not None:
+                loctag = limit_loctag(loctag, bucket, weight)
+            if drop_vhost:
+                vhost = None
+            if drop_protocol:
+                protocol = None
+            if drop_loctag:
+                loctag = None
+
+            tags = (bucket, vhost, protocol, loctag)
+            mbs['hits'][tags] += weight
+            if request_time_sketch is not None and 'request_time' in row:
+                request_time_sketch[tags].add(row['request_time'], weight)
+            if threshold is not None and 'request_time' in row:
+                request_time_apdex[classify(row['request_time'], threshold)][tags] += (
+                    weight
+                )
+            mbs['bytes_sent'][tags] += row['bytes_sent'] * weight
 
             if 'gzip_ratio' in row:
-                mbs['gzip_count'][tags] += 1
-                mbs['_gzip_ratio_premean'][tags] += row['gzip_ratio']
+                mbs['gzip_count'][tags] += weight
+                mbs['_gzip_ratio_premean'][tags] += row['gzip_ratio'] * weight
+
+            if 'request_length' in row:
+                mbs['_request_length_premean'][tags] += row['request_length'] * weight
+            if 'request_time' in row:
+                mbs['_request_time_premean'][tags] += row['request_time'] * weight
 
-            mbs['_request_length_premean'][tags] += row['request_length']
-            mbs['_request_time_premean'][tags] += row['request_time']
+            if keep_status_status:
+                mbs['status'][tags + (row['status'],)] += weight
+            else:
+                mbs['status'][tags + (None,)] += weight
 
-            tags = (bucket, row['vhost'], row['protocol'], row['loctag'], row['status'])
-            mbs['status'][tags] += 1
+            for name, sums, counts in custom_sums:
+                if name in row:
+                    sums[tags] += row[name] * weight
+                    if counts is not None:
+                        counts[tags] += weight
 
             if 'upstreams' in row:
                 ru = row['upstreams']
 
-                tags = (bucket, row['vhost'], row['protocol'], row['loctag'])
-                mbs['hits_with_upstream'][tags] += 1
-                mbs['_upstreams_servers_contacted'][tags] += ru['servers_contacted']
-                mbs['_upstreams_internal_redirects'][tags] += ru['internal_redirects']
-                mbs['upstreams_servers'][tags] += len(ru['servers'])
+                mbs['hits_with_upstream'][tags] += weight
+                mbs['_upstreams_servers_contacted'][tags] += (
+                    ru['servers_contacted'] * weight
+                )
+                mbs['_upstreams_internal_redirects'][tags] += (
+                    ru['internal_redirects'] * weight
+                )
+                mbs['upstreams_servers'][tags] += len(ru['servers']) * weight
+                # key without upstream, for measurements dropping it
+                dropped = tags + (None,)
                 for upstream in ru['servers']:
-                    tags = (
-                        bucket,
-                        row['vhost'],
-                        row['protocol'],
-                        row['loctag'],
-                        upstream,
+                    if normalize_upstream is not None:
+                        upstream_tag = normalize_upstream(upstream)
+                    else:
+                        upstream_tag = upstream
+                    if limit_upstream is not None:
+                        upstream_tag = limit_upstream(upstream_tag, bucket, weight)
+                    kept = tags + (upstream_tag,)
+                    mbs['upstreams_hits'][kept if keep_upstreams_hits else dropped] += (
+                        weight
+                    )
+                    k = kept if keep_response_time else dropped
+                    mbs['_upstreams_response_time_premean'][k] += (
+                        ru['response_time'][upstream] * weight
+                    )
+                    mbs['_upstreams_response_time_count_premean'][k] += (
+                        ru['response_time_count'][upstream] * weight
+                    )
+                    k = kept if keep_connect_time else dropped
+                    mbs['_upstreams_connect_time_premean'][k] += (
+                        ru['connect_time'][upstream] * weight
+                    )
+                    mbs['_upstreams_connect_time_count_premean'][k] += (
+                        ru['connect_time_count'][upstream] * weight
                     )
-                    mbs['upstreams_hits'][tags] += 1
-                    mbs['_upstreams_response_time_premean'][tags] += ru[
-                        'response_time'
-                    ][upstream]
-                    mbs['_upstreams_connect_time_premean'][tags] += ru['connect_time'][
-                        upstream
-                    ]
-                    mbs['_upstreams_header_time_premean'][tags] += ru['header_time'][
-                        upstream
-                    ]
-                    mbs['_upstreams_response_time_count_premean'][tags] += ru[
-                        'response_time_count'
-                    ][upstream]
-                    mbs['_upstreams_connect_time_count_premean'][tags] += ru[
-                        'connect_time_count'
-                    ][upstream]
-                    mbs['_upstreams_header_time_count_premean'][tags] += ru[
-                        'header_time_count'
-                    ][upstream]
+                    k = kept if keep_header_time else dropped
+                    mbs['_upstreams_header_time_premean'][k] += (
+                        ru['header_time'][upstream] * weight
+                    )
+                    mbs['_upstreams_header_time_count_premean'][k] += (
+                        ru['header_time_count'][upstream] * weight
+                    )
+                    if (
+                        upstreams_response_time_sketch is not None
+                        and ru['response_time_count'][upstream]
+                    ):
+                        upstreams_response_time_sketch[
+                            kept if keep_sketch else dropped
+                        ].add(ru['response_time'][upstream], weight)
+                    if threshold is not None and ru['response_time_count'][upstream]:
+                        upstreams_apdex[
+                            classify(ru['response_time'][upstream], threshold)
+                        ][kept if keep_apdex else dropped] += weight
+                    k = kept if keep_upstreams_status else dropped
                     for status_ in ru['status'][upstream]:
-                        tags = (
-                            bucket,
-                            row['vhost'],
-                            row['protocol'],
-                            row['loctag'],
-                            upstream,
-                            status_,
-                        )
-                        mbs['upstreams_status'][tags] += 1
+                        if not keep_upstreams_status_status:
+                            status_ = None
+                        mbs['upstreams_status'][k + (status_,)] += weight
         except IndexError:
             break
 
 
-def mbspostprocess(mbs):
+def mbssplit(mbs, before):
+    """Moves entries of buckets before `before` from mbs to a new dict"""
+    part = {}
+    for measurement, values in mbs.items():
+        moved = defaultdict(values.default_factory)
+        for k in [k for k in values if k[0] < before]:
+            moved[k] = values.pop(k)
+        part[measurement] = moved
+    return part
+
+
+def mbspostprocess(mbs, custom=()):
     if mbs['gzip_count']:
         for k, v in list(mbs['_gzip_ratio_premean'].items()):
             mbs['gzip_ratio_mean'][k] = v / mbs['gzip_count'][k]
@@ -538,6 +903,158 @@ def mbspostprocess(mbs):
             if count:
                 mbs['upstreams_internal_redirects_per_hit'][k] = float(v) / count
 
+    for name, (satisfied, tolerating, frustrated) in APDEX.items():
+        satisfied = mbs[satisfied]
+        tolerating = mbs[tolerating]
+        frustrated = mbs[frustrated]
+        for k in set(satisfied) | set(tolerating) | set(frustrated):
+            s = satisfied.get(k, 0)
+            t = tolerating.get(k, 0)
+            mbs[f'{name}_apdex'][k] = (s + t / 2.0) / (s + t + frustrated.get(k, 0))
+
+    if custom:
+        for measurement, (sums, counts) in custom_measurements(custom)[1].items():
+            counts = mbs[counts]
+            for k, v in list(mbs[sums].items()):
+                if counts[k]:
+                    mbs[measurement][k] = v / counts[k]
+
+
+def mbspercentiles(mbs, saved_sketches, percentiles, keep_from):
+    """Computes percentiles measurements from sketches
+
+    Sketches saved from previous loops for the same series are merged,
+    then current sketches are saved, and those for buckets before
+    keep_from are discarded.
+    """
+    for name, key in SKETCHES.items():
+        saved = saved_sketches.setdefault(name, {})
+        for tags, sketch in mbs[key].items():
+            if tags in saved:
+                sketch.merge(saved[tags])
+            saved[tags] = sketch
+            for percentile in percentiles:
+                measurement = f'{name}_{percentile_suffix(percentile)}'
+                if measurement not in mbs:
+                    mbs[measurement] = {}
+                mbs[measurement][tags] = sketch.quantile(percentile / 100.0)
+        for tags in [tags for tags in saved if tags[0] < keep_from]:
+            del saved[tags]
+
+
+# measurements summed from rows, derived ones are computed by mbspostprocess()
+ROLLUP_MEASUREMENTS = (
+    'bytes_sent',
+    'gzip_count',
+    '_gzip_ratio_premean',
+    'hits',
+    'hits_with_upstream',
+    '_request_length_premean',
+    '_request_time_premean',
+    'status',
+    '_upstreams_connect_time_premean',
+    '_upstreams_connect_time_count_premean',
+    '_upstreams_header_time_premean',
+    '_upstreams_header_time_count_premean',
+    'upstreams_hits',
+    '_upstreams_internal_redirects',
+    '_upstreams_response_time_premean',
+    '_upstreams_response_time_count_premean',
+    '_upstreams_servers_contacted',
+    'upstreams_servers',
+    'upstreams_status',
+    'request_time_satisfied',
+    'request_time_tolerating',
+    'request_time_frustrated',
+    'upstreams_response_time_satisfied',
+    'upstreams_response_time_tolerating',
+    'upstreams_response_time_frustrated',
+)
+
+
+def additive_measurements(custom=()):
+    """Returns (measurement, type) of measurements summed across buckets"""
+    additive = [(m, int) for m in ROLLUP_MEASUREMENTS]
+    if custom:
+        additive += custom_measurements(custom)[0]
+    return additive
+
+
+def mbsrollup(
+    mbs, saved_rollups, durations, bucket_duration, complete_before, custom=()
+):
+    """Accumulates mbs buckets into coarser rollup buckets
+
+    Partial rollups are kept in saved_rollups (stored in status) across
+    loops. Rollup buckets ending before complete_before (in seconds) can't
+    receive more lines: they are removed from saved_rollups, post-processed
+    and returned as a list of (duration, mbs) tuples. A rollup bucket is
+    flagged with the highest sampling rate of its buckets.
+    """
+    additive = additive_measurements(custom)
+    completed = []
+    for duration in list(saved_rollups):
+        if duration not in durations:
+            del saved_rollups[duration]
+    for duration in durations:
+        rollup = saved_rollups.setdefault(duration, mbsdict())
+        factor = duration // bucket_duration
+        for measurement, conversion in additive:
+            target = rollup.setdefault(measurement, defaultdict(conversion))
+            for k, v in mbs[measurement].items():
+                # ceil(), see msec2bucket()
+                target[(-(-k[0] // factor),) + k[1:]] += v
+        sampling = rollup.setdefault('_sampling', defaultdict(int))
+        for k, v in mbs['_sampling'].items():
+            k = (-(-k[0] // factor),)
+            if sampling[k] < v:
+                sampling[k] = v
+
+        last_complete = int(complete_before // duration)
+        done = mbsdict(custom=custom)
+        found = False
+        for measurement, _conversion in additive:
+            source = rollup[measurement]
+            for k in [k for k in source if k[0] <= last_complete]:
+                done[measurement][k] = source.pop(k)
+                found = True
+        for k in [k for k in sampling if k[0] <= last_complete]:
+            done['_sampling'][k] = sampling.pop(k)
+        if found:
+            mbspostprocess(done, custom)
+            completed.append((duration, done))
+    return completed
+
+
+def mbscorrect(mbs, saved, keep_from, custom=()):
+    """Adds aggregates of buckets emitted in previous passes to mbs
+
+    Late lines are aggregated to buckets already emitted, corrected totals
+    are saved in saved (stored in status) until buckets are before
+    keep_from. Derived measurements have to be computed again.
+    """
+    for measurement, _conversion in additive_measurements(custom):
+        values = mbs[measurement]
+        previous = saved.setdefault(measurement, {})
+        for k, v in values.items():
+            if k in previous:
+                v += previous[k]
+                values[k] = v
+            previous[k] = v
+        for k in [k for k in previous if k[0] < keep_from]:
+            del previous[k]
+    # corrected buckets keep the highest sampling rate of their lines
+    sampling = mbs['_sampling']
+    previous = saved.setdefault('_sampling', {})
+    for k, v in sampling.items():
+        if previous.get(k, 0) < v:
+            previous[k] = v
+    for k in {k[:1] for k in mbs['hits']}:
+        if k in previous:
+            sampling[k] = previous[k]
+    for k in [k for k in previous if k[0] < keep_from]:
+        del previous[k]
+
 
 def init_logger(options):
 
@@ -595,6 +1112,13 @@ def get_default_status(bucket_duration, lookback_factor, send_failure_fifo_size)
         'bucket_duration': lambda: bucket_duration,
         'lookback_factor': lambda: lookback_factor,
         'saved_points': lambda: deque([], send_failure_fifo_size),
+        'sketches': lambda: {},
+        'cardinality': lambda: {},
+        'rollups': lambda: {},
+        'corrections': lambda: {},
+        'lateness': lambda: {},
+        'sampling_rate': lambda: 1,
+        'throughput': lambda: 0.0,
     }
 
 
@@ -645,9 +1169,125 @@ class MBStatsSignalCatched(MBStatsException):
     """Raised when a signal is catched, usually leads to exit"""
 
 
-def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
+def save_mbs_points(points, status, options, logger):
+    """Saves points to be resent next loop, as one entry of the FIFO"""
+    status['saved_points'].append(points)
+    logger.info(
+        "Failed to send, saving points for later %d/%d"
+        % (len(status['saved_points']), options.send_failure_fifo_size)
+    )
+
+
+def send_mbs_points(backend, points, status, options, logger, tags=None, save=True):
+    """Sends points, saving them to be resent next loop on failure
+
+    Returns the number of points sent, or None if sending failed, failed
+    points being left to the caller if save is False.
+    """
+    try:
+        if options.simulate_send_failure:
+            raise MBStatsSendPointsFailed('Simulating send failure (mbs)')
+        if not backend.send_points(tags=tags, points=points):
+            raise MBStatsSendPointsFailed('influx_send failed (mbs)')
+        return len(points)
+    except BackendDryRun as e:
+        logger.debug(f"Dry run: {e}")
+        return len(points)
+    except MBStatsSendPointsFailed as e:
+        logger.warning(e)
+        if save:
+            save_mbs_points(points, status, options, logger)
+        return None
+    except Exception as e:
+        logger.error(e, exc_info=True)
+    return 0
+
+
+def send_own_stats(backend, fields, options, logger, tags=None):
+    points = [backend.point_dict('mbstats', fields)]
+    try:
+        if options.simulate_send_failure:
+            raise MBStatsSendPointsFailed('Simulating send failure (ownstats)')
+        if not backend.send_points(tags=tags, points=points):
+            raise MBStatsSendPointsFailed('influx_send failed (ownstats)')
+    except BackendDryRun as e:
+        logger.debug(f"Dry run: {e}")
+    except MBStatsSendPointsFailed as e:
+        logger.warning(e)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+
+
+# own stats fields which aren't reset by an idle loop, see idle_loop()
+GAUGE_FIELDS = ('lookback_factor', 'sampling_rate', 'cardinality_tracked_', 'mem_')
+
+
+def idle_loop(options, logger, backend, start_time=None, tags=None, previous=None):
+    """Only sends own stats, the log file did not change since last loop
+
+    Fields are those of previous loop own stats (previous), so series don't
+    appear and disappear: gauges are kept, others are reset.
+    """
+    if start_time is None:
+        start_time = time.time()
+    logger.debug("Log file unchanged, skipping loop")
+    own_stats_fields = {}
+    for field, value in (previous or {}).items():
+        if not field.startswith(GAUGE_FIELDS):
+            value = type(value)()
+        own_stats_fields[field] = value
+    if options.memory_stats or options.tracemalloc:
+        own_stats_fields.update(memory_stats())
+    own_stats_fields.update(
+        {
+            'duration_seconds': float(round(time.time() - start_time, 1)),
+            'parsed_lines': 0,
+            'skipped_lines': 0,
+            'sent_points': 0,
+            'resent_points': 0,
+            'idle': 1,
+        }
+    )
+    send_own_stats(backend, own_stats_fields, options, logger, tags=tags)
+    return own_stats_fields
+
+
+def main_loop(
+    options,
+    logger,
+    start_time=None,
+    first_loop=False,
+    tags=None,
+    idle=None,
+    parse=None,
+    allocation_sites=None,
+):
+    """Parses new lines of the log file, sends points and saves status
+
+    If idle (an IdleCheck) tells the log file did not change since a loop
+    which left no pending work, lock, offset and status are not touched,
+    unless leftover buckets have to be flushed. Lines are parsed by parse,
+    see parsefile(). Top allocation sites are logged by allocation_sites
+    (an AllocationSites), if any.
+    """
     if start_time is None:
         start_time = time.time()
+    flush_before = None
+    if idle is not None:
+        if idle.unchanged():
+            if not idle.flush_due(start_time):
+                return idle_loop(
+                    options,
+                    logger,
+                    idle.backend,
+                    start_time,
+                    tags=tags,
+                    previous=idle.fields,
+                )
+            flush_before = start_time
+        idle.clean = False
+    if parse is None:
+        parse = get_parser(options)
 
     parsed_lines = 0
     skipped_lines = 0
@@ -655,11 +1295,24 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
     sent_points = 0
     files = None
     lock = None
+    timer = StageTimer()
     try:
         workdir = os.path.abspath(options.workdir)
         files = {
-            'offset': SafeFile(workdir, options.file, suffix='.offset', logger=logger),
-            'status': SafeFile(workdir, options.file, suffix='.status', logger=logger),
+            'offset': SafeFile(
+                workdir,
+                options.file,
+                suffix='.offset',
+                logger=logger,
+                fsync=options.fsync,
+            ),
+            'status': SafeFile(
+                workdir,
+                options.file,
+                suffix='.status',
+                logger=logger,
+                fsync=options.fsync,
+            ),
             'lock': SafeFile(workdir, options.file, suffix='.lock', logger=logger),
         }
 
@@ -684,11 +1337,21 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
             files['offset'].remove_main()
             files['status'].remove_main()
 
+        # Pygtail may rewrite its offset file as soon as it is created (ie.
+        # on truncation), so it has to work on a copy, renamed to main only
+        # if the loop succeeds; offset file is tiny, unlike status
         files['offset'].copy_main_to_tmp()
 
         pygtail = Pygtail(options.file, offset_file=files['offset'].tmp)
+        tailer = pygtail
+        if options.mmap_catchup_bytes > 0 and not pygtail.rotated_logfile:
+            pending = pending_bytes(pygtail)
+            if pending >= options.mmap_catchup_bytes:
+                logger.info("Catching up %d bytes using mmap" % pending)
+                tailer = MmapTailer(options.file, pygtail.offset, files['offset'].tmp)
 
-        status = init_status(files, options, logger)
+        with timer.measure('status_load'):
+            status = init_status(files, options, logger)
 
         if status['leftover'] is not None and len(status['leftover']) > 0:
             fatal = False
@@ -699,28 +1362,149 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
                     options.bucket_duration,
                 )
                 fatal = True
-            if status['lookback_factor'] != options.lookback_factor:
-                msg += " Lookback factor mismatch %d vs %d (set via option)" % (
-                    status['lookback_factor'],
-                    options.lookback_factor,
-                )
-                fatal = True
             if fatal:
                 msg += " If you know what you are doing, remove status file {}".format(
                     files['status'].main
                 )
                 raise MBStatsStatusFileError(msg)
 
+        previous_lookback_factor = status['lookback_factor']
+        if options.adaptive_lookback and status['leftover'] is not None:
+            status['lookback_factor'] = adapt_lookback(
+                status['lateness'],
+                options.adaptive_lookback,
+                previous_lookback_factor,
+                options.lookback_factor,
+            )
+            decay_lateness(status['lateness'])
+        else:
+            status['lookback_factor'] = options.lookback_factor
+            status['lateness'].clear()
+        if status['lookback_factor'] != previous_lookback_factor:
+            logger.info(
+                "Lookback factor changed from %d to %d"
+                % (previous_lookback_factor, status['lookback_factor'])
+            )
+
+        if options.overload_seconds > 0 and status['leftover'] is not None:
+            backlog = pending_bytes(pygtail)
+            sampling_rate = adapt_sampling(
+                backlog,
+                status['throughput'],
+                options.overload_seconds,
+                status['sampling_rate'],
+                options.max_sampling_rate,
+            )
+        else:
+            backlog = None
+            sampling_rate = 1
+        if sampling_rate != status['sampling_rate']:
+            logger.warning(
+                "Sampling rate changed from 1/%d to 1/%d (backlog=%s bytes)"
+                % (status['sampling_rate'], sampling_rate, backlog)
+            )
+        status['sampling_rate'] = sampling_rate
+        measure_throughput = status['leftover'] is not None
+
+        rollup_durations = parse_rollups(options.rollups, status['bucket_duration'])
+        pending_points = []
+
+        late_grace_seconds = status['bucket_duration'] * options.late_grace_buckets
+
+        custom = parse.custom
+
+        def add_points(mbs, complete_before):
+            # rollups accumulate what was aggregated since last pass, so they
+            # are computed before corrections
+            rollups = mbsrollup(
+                mbs,
+                status['rollups'],
+                rollup_durations,
+                status['bucket_duration'],
+                complete_before - late_grace_seconds,
+                custom=custom,
+            )
+            if late_grace_seconds:
+                keep_from = msec2bucket(
+                    complete_before - late_grace_seconds, status['bucket_duration']
+                )
+                mbscorrect(mbs, status['corrections'], keep_from, custom)
+                mbspostprocess(mbs, custom)
+            elif status['corrections']:
+                status['corrections'].clear()
+            with timer.measure('points'):
+                backend.add_points(mbs, status, rollups=rollups)
+            pending_points.extend(backend.points)
+
+        client_seconds = {'serialize': 0.0, 'write': 0.0}
+
+        def account_client_seconds():
+            # client durations are cumulative, only account what was spent
+            # since last call, while sends are being measured
+            if backend.client:
+                for stage, seconds in (
+                    ('serialize', backend.client.serialize_seconds),
+                    ('write', backend.client.write_seconds),
+                ):
+                    timer.add(stage, seconds - client_seconds[stage])
+                    client_seconds[stage] = seconds
+
+        # once a send failed, points of the loop are kept and saved at end
+        # as one entry, instead of paying a timeout per emit
+        send_failed = False
+
+        def emit(mbs, complete_before):
+            nonlocal pending_points, sent_points, send_failed
+            add_points(mbs, complete_before)
+            if not send_failed and len(pending_points) >= options.emit_buffer_points:
+                sent = send_mbs_points(
+                    backend,
+                    pending_points,
+                    status,
+                    options,
+                    logger,
+                    tags=tags,
+                    save=False,
+                )
+                account_client_seconds()
+                if sent is None:
+                    send_failed = True
+                else:
+                    sent_points += sent
+                    pending_points = []
+
         parse_start_time = time.time()
         mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
-            pygtail, status, options, logger=logger, first_loop=first_loop
+            tailer,
+            status,
+            options,
+            logger=logger,
+            first_loop=first_loop,
+            timer=timer,
+            emit=emit if options.emit_buffer_points > 0 else None,
+            previous_lookback_factor=previous_lookback_factor,
+            parse=parse,
+            flush_before=flush_before,
         )
         parse_end_time = time.time()
+        if (
+            measure_throughput
+            and timer.counters['read_bytes']
+            and parse_end_time > parse_start_time
+        ):
+            status['throughput'] = timer.counters['read_bytes'] / (
+                parse_end_time - parse_start_time
+            )
         status['leftover'] = leftover
         status['last_msec'] = last_msec
 
-        backend.add_points(mbs, status)
-        if backend.points or status['saved_points']:
+        add_points(
+            mbs, last_msec - status['bucket_duration'] * status['lookback_factor']
+        )
+        if send_failed:
+            logger.info("Not sending after a failure during this loop")
+            save_mbs_points(pending_points, status, options, logger)
+        elif pending_points or status['saved_points']:
             if status['saved_points']:
                 to_resend = list()
                 for savedpoints in status['saved_points']:
@@ -743,33 +1527,30 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
                 except Exception as e:
                     logger.error(e, exc_info=True)
 
-            if backend.points:
-                try:
-                    if options.simulate_send_failure:
-                        raise MBStatsSendPointsFailed('Simulating send failure (mbs)')
-                    if not backend.send_points(tags=tags):
-                        raise MBStatsSendPointsFailed('influx_send failed (mbs)')
-                    sent_points = len(backend.points)
-                    backend.points = None
-                except BackendDryRun as e:
-                    sent_points = len(backend.points)
-                    logger.debug(f"Dry run: {e}")
-                except MBStatsSendPointsFailed as e:
-                    logger.warning(e)
-                    status['saved_points'].append(backend.points)
-                    logger.info(
-                        "Failed to send, saving points for later %d/%d"
-                        % (len(status['saved_points']), options.send_failure_fifo_size)
+            if pending_points:
+                sent_points += (
+                    send_mbs_points(
+                        backend, pending_points, status, options, logger, tags=tags
                     )
-                except Exception as e:
-                    logger.error(e, exc_info=True)
+                    or 0
+                )
 
-        save_obj(status, files['status'].tmp, logger=logger)
+        with timer.measure('status_save'):
+            save_obj(status, files['status'].tmp, logger=logger)
     except Exception:
         raise
     else:
-        files['offset'].rename_tmp_to_main()
-        files['status'].rename_tmp_to_main()
+        with timer.measure('offset_commit'):
+            files['offset'].rename_tmp_to_main()
+        with timer.measure('status_save'):
+            files['status'].rename_tmp_to_main()
+        if idle is not None:
+            # next loops can be skipped until the log file changes
+            idle.backend = backend
+            idle.clean = not status['saved_points'] and status['sampling_rate'] == 1
+            idle.set_leftover(
+                status['leftover'], status['bucket_duration'], status['lookback_factor']
+            )
     finally:
         if files:
             files['offset'].remove_tmp()
@@ -795,7 +1576,25 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
         'mean_time_per_line_seconds': float(mean_time_per_line_seconds),
         'sent_points': sent_points,
         'resent_points': resent_points,
+        'lookback_factor': status['lookback_factor'],
+        'sampling_rate': status['sampling_rate'],
+        'idle': 0,
     }
+    if backend.client:
+        account_client_seconds()
+        timer.count('sent_bytes', backend.client.bytes_sent)
+        timer.count('write_requests', backend.client.write_requests)
+    own_stats_fields.update(timer.fields())
+    own_stats_fields.update(limiters_stats(status['cardinality']))
+    if options.memory_stats or options.tracemalloc:
+        own_stats_fields.update(
+            memory_stats(
+                mbs=mbs,
+                leftover=status['leftover'],
+                saved_points=status['saved_points'],
+                allocation_sites=allocation_sites,
+            )
+        )
 
     if options.quiet < 2:
         logger.info(
@@ -808,18 +1607,11 @@ def main_loop(options, logger, start_time=None, first_loop=False, tags=None):
                 1000000.0 * mean_time_per_line_seconds,
             )
         )
-    points = [backend.point_dict('mbstats', own_stats_fields)]
-    try:
-        if options.simulate_send_failure:
-            raise MBStatsSendPointsFailed('Simulating send failure (ownstats)')
-        if not backend.send_points(tags=tags, points=points):
-            raise MBStatsSendPointsFailed('influx_send failed (ownstats)')
-    except BackendDryRun as e:
-        logger.debug(f"Dry run: {e}")
-    except MBStatsSendPointsFailed as e:
-        logger.warning(e)
-    except Exception as e:
-        logger.error(e, exc_info=True)
+    send_own_stats(backend, own_stats_fields, options, logger, tags=tags)
+    if idle is not None:
+        idle.fields = own_stats_fields
+
+    return own_stats_fields
 
 
 def main():
@@ -853,6 +1645,23 @@ def main():
         sys.exit(e.code)
 
     logger = init_logger(options)
+    allocation_sites = None
+    if options.tracemalloc:
+        start_tracing()
+        allocation_sites = AllocationSites(options.tracemalloc_interval, logger=logger)
+
+    profile_basepath = SafeFile(
+        os.path.abspath(options.workdir), options.file, suffix='.profile'
+    ).main
+    profiler = None
+    if options.profile:
+        profiler = LoopProfiler(
+            profile_basepath, keep=options.profile_keep, logger=logger
+        )
+    sampler = StackSampler(
+        profile_basepath, interval=options.profile_sampling_interval, logger=logger
+    )
+    signal.signal(signal.SIGUSR2, sampler.request_toggle)
     try:
         retcode = 1
         first_loop = True
@@ -862,12 +1671,41 @@ def main():
         }
         if options.datacenter:
             tags['dc'] = options.datacenter
+        # compiled once, normalization caches are kept across loops
+        parse = get_parser(options)
+        idle = None
+        if options.loop_delay > 0.0:
+            offset_file = SafeFile(
+                os.path.abspath(options.workdir), options.file, suffix='.offset'
+            )
+            idle = IdleCheck(options.file, offset_file.main)
         while True:
+            sampler.update()
             start = time.time()
             try:
-                main_loop(
-                    options, logger, start_time=start, first_loop=first_loop, tags=tags
-                )
+                if profiler:
+                    profiler.runcall(
+                        main_loop,
+                        options,
+                        logger,
+                        start_time=start,
+                        first_loop=first_loop,
+                        tags=tags,
+                        idle=idle,
+                        parse=parse,
+                        allocation_sites=allocation_sites,
+                    )
+                else:
+                    main_loop(
+                        options,
+                        logger,
+                        start_time=start,
+                        first_loop=first_loop,
+                        tags=tags,
+                        idle=idle,
+                        parse=parse,
+                        allocation_sites=allocation_sites,
+                    )
                 first_loop = False
             except (MBStatsSignalCatched, KeyboardInterrupt):
                 raise
@@ -898,6 +1736,8 @@ def main():
         retcode = e.code
     except Exception as e:
         logger.error(e, exc_info=True)
+    finally:
+        sampler.stop()
 
     sys.exit(retcode)
 
@@ -54,7 +54,7 @@ class Backend:
     def send_points(self, tags, points=None):
         raise NotImplementedError
 
-    def add_points(self, mbs, status):
+    def add_points(self, mbs, status, rollups=None):
         raise NotImplementedError
 
 
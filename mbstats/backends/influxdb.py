@@ -46,6 +46,13 @@ from mbstats.backends import (
     BackendDryRun,
 )
 from mbstats.influxdb1x import InfluxDBClient
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    custom_measurements,
+    enabled_groups,
+    parse_format,
+)
+from mbstats.sketch import parse_percentiles, percentile_suffix
 from mbstats.utils import bucket2time, timestamp_RFC3339
 
 MBS_TAGS = {
@@ -66,6 +73,43 @@ MBS_TAGS = {
     'upstreams_response_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
     'upstreams_connect_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
     'upstreams_header_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'request_time_satisfied': ('vhost', 'protocol', 'loctag'),
+    'request_time_tolerating': ('vhost', 'protocol', 'loctag'),
+    'request_time_frustrated': ('vhost', 'protocol', 'loctag'),
+    'request_time_apdex': ('vhost', 'protocol', 'loctag'),
+    'upstreams_response_time_satisfied': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'upstreams_response_time_tolerating': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'upstreams_response_time_frustrated': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'upstreams_response_time_apdex': ('vhost', 'protocol', 'loctag', 'upstream'),
+}
+
+
+# measurements written only if their group is enabled, see --disable-measurements
+GROUP_MEASUREMENTS = {
+    'gzip': ('gzip_count', 'gzip_count_percent', 'gzip_ratio_mean'),
+    'request_length': ('request_length_mean',),
+    'request_time': (
+        'request_time_mean',
+        'request_time_satisfied',
+        'request_time_tolerating',
+        'request_time_frustrated',
+        'request_time_apdex',
+    ),
+    'upstreams': (
+        'hits_with_upstream',
+        'upstreams_hits',
+        'upstreams_status',
+        'upstreams_servers_contacted_per_hit',
+        'upstreams_internal_redirects_per_hit',
+        'upstreams_servers',
+        'upstreams_response_time_mean',
+        'upstreams_connect_time_mean',
+        'upstreams_header_time_mean',
+        'upstreams_response_time_satisfied',
+        'upstreams_response_time_tolerating',
+        'upstreams_response_time_frustrated',
+        'upstreams_response_time_apdex',
+    ),
 }
 
 
@@ -83,6 +127,84 @@ def _process_request_length_mean_value(value):
     return value
 
 
+# measurements derived from sketches, see --percentiles
+PERCENTILES_TAGS = {
+    'request_time': MBS_TAGS['request_time_mean'],
+    'upstreams_response_time': MBS_TAGS['upstreams_response_time_mean'],
+}
+
+PERCENTILES_GROUPS = {
+    'request_time': 'request_time',
+    'upstreams_response_time': 'upstreams',
+}
+
+
+def get_mbs_tags(options):
+    groups = enabled_groups(getattr(options, 'disable_measurements', ''))
+    mbs_tags = dict(MBS_TAGS)
+    for group, measurements in GROUP_MEASUREMENTS.items():
+        if group not in groups:
+            for measurement in measurements:
+                del mbs_tags[measurement]
+    for percentile in parse_percentiles(getattr(options, 'percentiles', '')):
+        for name, tagnames in PERCENTILES_TAGS.items():
+            if PERCENTILES_GROUPS[name] in groups:
+                mbs_tags[f'{name}_{percentile_suffix(percentile)}'] = tagnames
+    for measurement in custom_tags(options):
+        mbs_tags[measurement] = MBS_TAGS['bytes_sent']
+    return mbs_tags
+
+
+def get_custom(options):
+    """Returns fields declared in --log-format, see parse_format()"""
+    custom = []
+    parse_format(getattr(options, 'log_format', DEFAULT_FORMAT), custom=custom)
+    return custom
+
+
+def custom_tags(options):
+    additive, means = custom_measurements(get_custom(options))
+    sums = [m for m, _conversion in additive if not m.startswith('_')]
+    return sums + list(means)
+
+
+# mean measurement -> (sum, count), written as fields with --mean-fields
+MEAN_COMPONENTS = {
+    'gzip_count_percent': ('gzip_count', 'hits'),
+    'gzip_ratio_mean': ('_gzip_ratio_premean', 'gzip_count'),
+    'request_length_mean': ('_request_length_premean', 'hits'),
+    'request_time_mean': ('_request_time_premean', 'hits'),
+    'upstreams_servers_contacted_per_hit': (
+        '_upstreams_servers_contacted',
+        'hits_with_upstream',
+    ),
+    'upstreams_internal_redirects_per_hit': (
+        '_upstreams_internal_redirects',
+        'hits_with_upstream',
+    ),
+    'upstreams_response_time_mean': (
+        '_upstreams_response_time_premean',
+        '_upstreams_response_time_count_premean',
+    ),
+    'upstreams_connect_time_mean': (
+        '_upstreams_connect_time_premean',
+        '_upstreams_connect_time_count_premean',
+    ),
+    'upstreams_header_time_mean': (
+        '_upstreams_header_time_premean',
+        '_upstreams_header_time_count_premean',
+    ),
+}
+
+
+def rollup_suffix(duration):
+    """Returns measurement suffix for a rollup: 300 -> _5m, 3600 -> _1h"""
+    for unit, seconds in (('d', 86400), ('h', 3600), ('m', 60)):
+        if duration % seconds == 0:
+            return f'_{duration // seconds}{unit}'
+    return f'_{duration}s'
+
+
 PROCESS_MEASUREMENT_VALUE = {
     'request_length_mean': _process_request_length_mean_value,
 }
@@ -91,6 +213,10 @@ PROCESS_MEASUREMENT_VALUE = {
 class InfluxBackend(Backend):
     def __init__(self, options, logger=None):
         super().__init__(options, logger=logger)
+        self.mbs_tags = get_mbs_tags(options)
+        self.mean_components = dict(
+            MEAN_COMPONENTS, **custom_measurements(get_custom(options))[1]
+        )
 
     def initialize(self):
         options = self.options
@@ -140,13 +266,24 @@ class InfluxBackend(Backend):
             "fields": fields,
         }
 
-    def _add_points(self, mbs, status):
-        for measurement, tagnames in list(MBS_TAGS.items()):
+    def _add_points(self, mbs, status, bucket_duration=None, suffix=''):
+        if bucket_duration is None:
+            bucket_duration = status['bucket_duration']
+        mean_fields = getattr(self.options, 'mean_fields', 'value')
+        sampling = mbs.get('_sampling')
+        for measurement, tagnames in list(self.mbs_tags.items()):
             if measurement not in mbs:
                 continue
+            sums = counts = None
+            if mean_fields != 'value' and measurement in self.mean_components:
+                sums, counts = (mbs[k] for k in self.mean_components[measurement])
             for tags, value in list(mbs[measurement].items()):
                 influxtags = dict(list(zip(tagnames, tags[1:])))
                 for k, v in list(influxtags.items()):
+                    if v is None:
+                        # dropped, see --drop-tags
+                        del influxtags[k]
+                        continue
                     if k == 'protocol':
                         if v == 's':
                             influxtags[k] = 'https'
@@ -155,12 +292,31 @@ class InfluxBackend(Backend):
                     influxtags[k] = str(v)
                 if measurement in PROCESS_MEASUREMENT_VALUE:
                     value = PROCESS_MEASUREMENT_VALUE[measurement](value)
+                fields = {'value': value}
+                if sums is not None:
+                    if mean_fields == 'sums':
+                        fields = {}
+                    fields['sum'] = sums.get(tags, 0)
+                    fields['count'] = counts.get(tags, 0)
+                if sampling and tags[:1] in sampling:
+                    # bucket values were estimated from 1 in N lines
+                    fields['sampling'] = sampling[tags[:1]]
                 yield self.point_dict(
-                    measurement,
-                    {'value': value},
+                    measurement + suffix,
+                    fields,
                     tags=influxtags,
-                    time_rfc3339=bucket2time(tags[0], status['bucket_duration']),
+                    time_rfc3339=bucket2time(tags[0], bucket_duration),
                 )
 
-    def add_points(self, mbs, status):
-        self.points = list(self._add_points(mbs, status))
+    def add_points(self, mbs, status, rollups=None):
+        points = list(self._add_points(mbs, status))
+        for duration, rollup_mbs in rollups or ():
+            points.extend(
+                self._add_points(
+                    rollup_mbs,
+                    status,
+                    bucket_duration=duration,
+                    suffix=rollup_suffix(duration),
+                )
+            )
+        self.points = points
@@ -0,0 +1,184 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+# tag value used for values outside of the top-k
+OTHER = 'other'
+
+DIMENSIONS = ('vhost', 'loctag', 'upstream')
+
+
+def parse_limits(spec):
+    """Parses 'vhost=100,upstream=50' (or a dict) to {'vhost': 100, ...}"""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        items = list(spec.items())
+    else:
+        items = [item.split('=', 1) for item in str(spec).split(',') if item.strip()]
+    limits = {}
+    for item in items:
+        if len(item) != 2:
+            raise ValueError(f"Invalid cardinality limit: {'='.join(item)}")
+        dimension, limit = item[0].strip(), int(item[1])
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Invalid cardinality dimension: {dimension}")
+        if limit <= 0:
+            raise ValueError(f"Invalid cardinality limit for {dimension}: {limit}")
+        limits[dimension] = limit
+    return limits
+
+
+class HeavyHitters:
+    """Limits the number of distinct values of a tag to its top-k
+
+    Frequencies are estimated with a space-saving style summary of bounded
+    size (capacity counters): when full, the least frequent half is evicted
+    at once, and newcomers start at the highest evicted count, which is
+    recorded as their maximum overestimation. Values are counted with the
+    weight of their row, see --overload-seconds.
+
+    Allowed values are the top-k (by guaranteed count) computed at the start
+    of each loop, topped up by first seen values while less than k are
+    allowed. Other values are folded into OTHER and counted as overflow.
+    Counts are halved at each loop, so the top-k follows traffic changes.
+
+    Values admitted for a bucket are kept until the bucket is before
+    keep_from passed to start_loop(), so a bucket aggregated again (ie. for
+    late lines) is folded the same way.
+    """
+
+    def __init__(self, k, capacity=None):
+        self.k = k
+        self.capacity = capacity or max(10 * k, 100)
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+        self.allowed = set()
+        self.admitted = {}
+        self.overflow = 0
+
+    def __call__(self, value, bucket=None, weight=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += weight
+        else:
+            if len(counts) >= self.capacity:
+                self._evict()
+            counts[value] = self.floor + weight
+            self.errors[value] = self.floor
+        allowed = self.allowed
+        if bucket is None:
+            admitted = allowed
+        else:
+            admitted = self.admitted.get(bucket)
+            if admitted is None:
+                admitted = self.admitted[bucket] = set(allowed)
+        if value in admitted:
+            return value
+        if len(admitted) < self.k:
+            admitted.add(value)
+            if len(allowed) < self.k:
+                allowed.add(value)
+            return value
+        self.overflow += weight
+        return OTHER
+
+    def _evict(self):
+        ordered = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        keep = self.capacity // 2
+        for value, count in ordered[keep:]:
+            del self.counts[value]
+            del self.errors[value]
+            if count > self.floor:
+                self.floor = count
+
+    def top(self, n=None):
+        """Returns values sorted by decreasing guaranteed count"""
+        errors = self.errors
+        ordered = sorted(
+            self.counts.items(),
+            key=lambda item: item[1] - errors[item[0]],
+            reverse=True,
+        )
+        return [value for value, _count in ordered[:n]]
+
+    def start_loop(self, k=None, keep_from=None):
+        if k is not None:
+            self.k = k
+            self.capacity = max(10 * k, 100)
+        self.allowed = set(self.top(self.k))
+        if keep_from is not None:
+            for bucket in [b for b in self.admitted if b < keep_from]:
+                del self.admitted[bucket]
+        self.overflow = 0
+        counts = self.counts
+        errors = self.errors
+        for value in list(counts):
+            counts[value] //= 2
+            errors[value] //= 2
+            if not counts[value]:
+                del counts[value]
+                del errors[value]
+        self.floor //= 2
+
+
+def get_limiters(saved, limits, keep_from=None):
+    """Returns per dimension HeavyHitters, reusing those saved in status
+
+    Values admitted for buckets before keep_from are forgotten.
+    """
+    for dimension in list(saved):
+        if dimension not in limits:
+            del saved[dimension]
+    for dimension, k in limits.items():
+        if dimension not in saved:
+            saved[dimension] = HeavyHitters(k)
+        saved[dimension].start_loop(k, keep_from)
+    return saved
+
+
+def limiters_stats(limiters):
+    fields = {}
+    for dimension, limiter in limiters.items():
+        fields[f'cardinality_overflow_{dimension}'] = limiter.overflow
+        fields[f'cardinality_tracked_{dimension}'] = len(limiter.counts)
+    return fields
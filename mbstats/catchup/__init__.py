@@ -0,0 +1,144 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+import mmap
+import os
+
+# pages behind the cursor are released every CHUNK_SIZE bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def fadvise(fd, offset, length, advice):
+    # not available on all platforms, hints only
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, advice)
+
+
+def madvise(mm, advice, start=0, length=0):
+    if hasattr(mm, 'madvise'):
+        mm.madvise(advice, start, length or len(mm) - start)
+
+
+class MmapTailer:
+    """Iterates over lines of a log file from offset, using mmap
+
+    Used to catch up with a large backlog: the pending region is mapped,
+    and each line is decoded from a slice of a memoryview of the mapping,
+    so nothing else is copied. The offset follows yielded lines. Pages
+    behind the cursor are released, from the mapping and from the page
+    cache, every chunk_size bytes. Lines are yielded with their trailing
+    new line, like Pygtail does, and a trailing incomplete line is left for
+    next loop.
+
+    Offset is written to offset_file in Pygtail format by
+    update_offset_file(), so both can be used alternatively.
+    """
+
+    def __init__(
+        self, filename, offset, offset_file, chunk_size=CHUNK_SIZE, encoding='utf-8'
+    ):
+        self.filename = filename
+        self.offset = offset
+        self.offset_file = offset_file
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.inode = None
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as f:
+            fd = f.fileno()
+            st = os.fstat(fd)
+            self.inode = st.st_ino
+            if st.st_size < self.offset:
+                # truncated
+                self.offset = 0
+            if st.st_size == self.offset:
+                return
+            # mapping has to start at a multiple of allocation granularity
+            base = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+            size = st.st_size - base
+            fadvise(fd, base, size, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ, offset=base) as mm:
+                madvise(mm, getattr(mmap, 'MADV_SEQUENTIAL', 0))
+                yield from self._lines(mm, fd, base, size)
+
+    def _lines(self, mm, fd, base, size):
+        pos = self.offset - base
+        released = 0
+        find = mm.find
+        encoding = self.encoding
+        chunk_size = self.chunk_size
+        with memoryview(mm) as view:
+            while True:
+                end = find(b'\n', pos) + 1
+                if not end:
+                    # nothing left, or incomplete last line
+                    return
+                line = str(view[pos:end], encoding, 'replace')
+                pos = end
+                self.offset = base + end
+                yield line
+                if pos - released >= chunk_size:
+                    release = pos - pos % mmap.PAGESIZE
+                    madvise(
+                        mm,
+                        getattr(mmap, 'MADV_DONTNEED', 0),
+                        released,
+                        release - released,
+                    )
+                    fadvise(
+                        fd,
+                        base + released,
+                        release - released,
+                        getattr(os, 'POSIX_FADV_DONTNEED', 0),
+                    )
+                    released = release
+
+    def current_offset(self):
+        """Returns offset after last yielded line"""
+        return self.offset
+
+    def update_offset_file(self):
+        inode = self.inode
+        if inode is None:
+            inode = os.stat(self.filename).st_ino
+        with open(self.offset_file, 'w') as f:
+            f.write(f"{inode}\n{self.current_offset()}\n")
@@ -43,7 +43,22 @@ import argparse
 import json
 import platform
 
-from mbstats.utils import read_config
+from mbstats.cardinality import parse_limits
+from mbstats.dimensions import parse_dimensions
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    compile_format,
+    enabled_groups,
+    parse_filters,
+)
+from mbstats.normalize import parse_normalize
+from mbstats.safefile import FSYNC_POLICIES
+from mbstats.sketch import parse_percentiles
+from mbstats.thresholds import parse_thresholds
+from mbstats.utils import (
+    parse_rollups,
+    read_config,
+)
 
 
 class ParseOptionsSysExit(Exception):
@@ -52,7 +67,7 @@ class ParseOptionsSysExit(Exception):
         self.code = exit_code
 
 
-def parse_options():
+def parse_options(argv=None):
     description = (
         """Tail and parse a formatted nginx log file, sending results to InfluxDB."""
     )
@@ -92,20 +107,39 @@ def parse_options():
         access_log /var/log/nginx/my.stats.log stats buffer=256k flush=10s
 
     Note: first field in stats format declaration is a format version, it should be set to 1.
+    Other formats can be used with --log-format, for example to add fields.
+    In --log-format, a field declared as $name:int|float:sum|mean is summed or averaged.
 
     """
 
     default_options = {
+        'adaptive_lookback': 0.0,
         'config': [],
         'datacenter': '',
+        'disable_measurements': '',
+        'drop_tags': '',
         'dry_run': False,
+        'exclude_lines': '',
+        'emit_buffer_points': 0,
         'file': '',
+        'fsync': 'none',
         'hostname': platform.node(),
+        'include_lines': '',
+        'latency_thresholds': '',
         'log_conf': None,
         'log_dir': '',
+        'log_format': DEFAULT_FORMAT,
+        'max_bytes': 0,
         'max_lines': 0,
+        'max_seconds': 0.0,
+        'mean_fields': 'value',
         'name': '',
+        'normalize_tags': [],
+        'overload_seconds': 0.0,
+        'percentiles': '',
+        'percentiles_accuracy': 0.01,
         'quiet': 0,
+        'rollups': '',
         'workdir': '.',
         'influx_batch_size': 500,
         'influx_database': 'mbstats',
@@ -115,14 +149,26 @@ def parse_options():
         'influx_timeout': 40,
         'influx_username': 'root',
         'bucket_duration': 60,
+        'cardinality_limits': '',
         'debug': False,
         'do_not_skip_to_end': False,
         'influx_drop_database': False,
+        'late_grace_buckets': 0,
         'locker': 'fcntl',
         'lookback_factor': 2,
+        'max_sampling_rate': 100,
+        'memory_stats': False,
+        'mmap_catchup_bytes': 0,
+        'normalize_cache_size': 4096,
+        'profile': False,
+        'profile_keep': 10,
+        'profile_sampling_interval': 0.005,
         'send_failure_fifo_size': 30000,
         'simulate_send_failure': False,
+        'skip_log_limit': 10,
         'startover': False,
+        'tracemalloc': False,
+        'tracemalloc_interval': 600.0,
         'log_handler': 'file',
         'loop_delay': -1.0,
     }
@@ -134,7 +180,7 @@ def parse_options():
         action='append',
         metavar="FILE",
     )
-    args, remaining_argv = conf_parser.parse_known_args()
+    args, remaining_argv = conf_parser.parse_known_args(argv)
 
     if args.config:
         for conf_path in args.config:
@@ -176,6 +222,31 @@ def parse_options():
         type=int,
         help="maximum number of lines to process per loop",
     )
+    common.add_argument(
+        '--max-bytes',
+        type=int,
+        help="maximum number of bytes to process per loop",
+    )
+    common.add_argument(
+        '--max-seconds',
+        type=float,
+        help="maximum time in seconds spent parsing per loop",
+    )
+    common.add_argument(
+        '--overload-seconds',
+        type=float,
+        metavar='SECONDS',
+        help="when the unread part of the log would take more than SECONDS to"
+        " parse at last loop throughput, only parse 1 in N lines, scaling"
+        " counters by N and flagging points with a sampling field (0 to disable)",
+    )
+    common.add_argument(
+        '--emit-buffer-points',
+        type=int,
+        help="send points of completed buckets while parsing, whenever at least"
+        " this number of points is buffered; lines older than the lookback window"
+        " are then skipped within a loop too (0 to send all points at end of loop)",
+    )
     common.add_argument(
         '-w', '--workdir', help="directory where offset/status are stored"
     )
@@ -195,6 +266,61 @@ def parse_options():
         help='Delay between each run in seconds. If set to 0 or less, run only once.',
     )
 
+    common.add_argument(
+        '--percentiles',
+        help="comma-separated percentiles of request and upstream response times"
+        " to report, ie. 50,95,99",
+    )
+
+    common.add_argument(
+        '--rollups',
+        help="comma-separated durations in seconds of coarser buckets to compute,"
+        " written to measurements suffixed with duration, ie. 300,3600 (_5m, _1h)",
+    )
+    common.add_argument(
+        '--mean-fields',
+        choices=('value', 'both', 'sums'),
+        help="fields written for means and ratios: value (the mean), both (value,"
+        " sum and count) or sums (sum and count only, for weighted downsampling)",
+    )
+    common.add_argument(
+        '--disable-measurements',
+        help="comma-separated measurements groups not to compute, related log"
+        " fields being neither parsed nor aggregated: gzip, request_length,"
+        " request_time, upstreams",
+    )
+    common.add_argument(
+        '--drop-tags',
+        help="comma-separated tags to aggregate away when parsing: vhost,"
+        " protocol, loctag, upstream or status; TAG:M1+M2 keeps upstream or status"
+        " tag only for measurements M1 and M2, ie. protocol,upstream:upstreams_hits",
+    )
+    common.add_argument(
+        '--normalize-tags',
+        action='append',
+        metavar='TAG:RULE',
+        help="normalize vhost, loctag or upstream values, can be repeated, rules"
+        " of a tag are applied in order: lower, strip_port, s/REGEX/REPLACEMENT/"
+        " or CIDR=POOL, ie. --normalize-tags vhost:lower --normalize-tags"
+        " 'vhost:s/^www\\.//' --normalize-tags upstream:10.2.2.0/24=web",
+    )
+    common.add_argument(
+        '--include-lines',
+        help="only process lines matching comma-separated rules on vhost, loctag"
+        " or status, values can be globs, ie. vhost=*.musicbrainz.org,loctag=ws;"
+        " lines have to match one rule per field",
+    )
+    common.add_argument(
+        '--exclude-lines',
+        help="skip lines matching any of comma-separated rules on vhost, loctag"
+        " or status, values can be globs, ie. vhost=health.local,status=444",
+    )
+    common.add_argument(
+        '--latency-thresholds',
+        help="apdex latency thresholds in seconds, per vhost or vhost/loctag,"
+        " ie. 0.5,musicbrainz.org=0.3,musicbrainz.org/ws=1.0",
+    )
+
     influx = parser.add_argument_group('influxdb arguments')
     influx.add_argument('--influx-host', help="influxdb host")
     influx.add_argument('--influx-port', type=int, help="influxdb port")
@@ -221,11 +347,30 @@ def parse_options():
         type=int,
         help="number of buckets to wait before sending any data",
     )
+    expert.add_argument(
+        '--adaptive-lookback',
+        type=float,
+        metavar='PERCENTILE',
+        help="use the smallest lookback factor, up to --lookback-factor, covering"
+        " this percentile of lines lateness, ie. 99.9 (0 to disable)",
+    )
+    expert.add_argument(
+        '--late-grace-buckets',
+        type=int,
+        help="number of buckets, beyond lookback, during which late lines are"
+        " still aggregated, corrected points being sent again (0 to skip them)",
+    )
     expert.add_argument(
         '--startover',
         action='store_true',
         help="ignore all status/offset, like a first run",
     )
+    expert.add_argument(
+        '--fsync',
+        choices=FSYNC_POLICIES,
+        help="flush offset and status files to disk before renaming them (data),"
+        " and the renames too (full)",
+    )
     expert.add_argument(
         '--do-not-skip-to-end',
         action='store_true',
@@ -234,6 +379,15 @@ def parse_options():
     expert.add_argument(
         '--bucket-duration', type=int, help="duration for each bucket in seconds"
     )
+    expert.add_argument(
+        '--log-format',
+        help="nginx log_format of the log file, as a string of fields separated"
+        " by |, starting with a version, ie. '2|$msec|$host|...', variables"
+        " unknown to mbstats are ignored unless declared as $name:type:aggregation"
+        " (type int or float, aggregation sum or mean), ie."
+        " '$upstream_bytes_received:int:sum' is reported as"
+        " upstream_bytes_received_sum",
+    )
     expert.add_argument(
         '--log-conf', action='store', help='Logging configuration file. None by default'
     )
@@ -251,6 +405,71 @@ def parse_options():
         action='store_true',
         help="Simulate send failure for testing purposes",
     )
+    expert.add_argument(
+        '--skip-log-limit',
+        type=int,
+        help="number of skipped lines logged per reason and per loop, others are"
+        " only counted",
+    )
+    expert.add_argument(
+        '--cardinality-limits',
+        help="maximum number of distinct vhost, loctag or upstream tag values,"
+        " others being reported as 'other', ie. vhost=100,upstream=50",
+    )
+    expert.add_argument(
+        '--max-sampling-rate',
+        type=int,
+        help="maximum N when sampling 1 in N lines, see --overload-seconds",
+    )
+    expert.add_argument(
+        '--mmap-catchup-bytes',
+        type=int,
+        help="read the log file using mmap when at least this number of bytes is"
+        " pending, releasing read pages from page cache (0 to disable)",
+    )
+    expert.add_argument(
+        '--normalize-cache-size',
+        type=int,
+        help="number of distinct raw values per tag whose normalization is cached",
+    )
+    expert.add_argument(
+        '--percentiles-accuracy',
+        type=float,
+        help="relative accuracy of percentiles, between 0 and 1 exclusive",
+    )
+    expert.add_argument(
+        '--memory-stats',
+        action='store_true',
+        help="Report internal structures sizes and RSS in own stats",
+    )
+    expert.add_argument(
+        '--tracemalloc',
+        action='store_true',
+        help="Trace allocations with tracemalloc and log top allocation sites,"
+        " implies --memory-stats (slow)",
+    )
+    expert.add_argument(
+        '--tracemalloc-interval',
+        type=float,
+        metavar='SECONDS',
+        help="Minimum interval between logs of top allocation sites",
+    )
+    expert.add_argument(
+        '--profile',
+        action='store_true',
+        help="Run each loop under cProfile, writing .pstats files to workdir",
+    )
+    expert.add_argument(
+        '--profile-keep',
+        type=int,
+        help="Number of rotated .pstats files to keep",
+    )
+    expert.add_argument(
+        '--profile-sampling-interval',
+        type=float,
+        help="Interval in seconds between stack samples, sampling is toggled"
+        " with SIGUSR2",
+    )
 
     options = parser.parse_args(remaining_argv)
     if options.dump_config:
@@ -261,4 +480,58 @@ def parse_options():
         parser.print_usage()
         raise ParseOptionsSysExit(1)
 
+    try:
+        parse_percentiles(options.percentiles)
+    except ValueError as e:
+        parser.error(f"--percentiles: {e}")
+    try:
+        parse_thresholds(options.latency_thresholds)
+    except ValueError as e:
+        parser.error(f"--latency-thresholds: {e}")
+    try:
+        parse_limits(options.cardinality_limits)
+    except ValueError as e:
+        parser.error(f"--cardinality-limits: {e}")
+    try:
+        parse_rollups(options.rollups, options.bucket_duration)
+    except ValueError as e:
+        parser.error(f"--rollups: {e}")
+    if not 0 <= options.adaptive_lookback < 100:
+        parser.error("--adaptive-lookback: must be between 0 and 100")
+    try:
+        compile_format(options.log_format)
+    except ValueError as e:
+        parser.error(f"--log-format: {e}")
+    try:
+        enabled_groups(options.disable_measurements)
+    except ValueError as e:
+        parser.error(f"--disable-measurements: {e}")
+    try:
+        parse_dimensions(options.drop_tags)
+    except ValueError as e:
+        parser.error(f"--drop-tags: {e}")
+    for option in ('include_lines', 'exclude_lines'):
+        try:
+            parse_filters(getattr(options, option))
+        except ValueError as e:
+            parser.error(f"--{option.replace('_', '-')}: {e}")
+    try:
+        parse_normalize(options.normalize_tags)
+    except ValueError as e:
+        parser.error(f"--normalize-tags: {e}")
+    if options.normalize_cache_size <= 0:
+        parser.error("--normalize-cache-size: must be positive")
+    if options.overload_seconds < 0:
+        parser.error("--overload-seconds: must be positive or 0")
+    if options.max_sampling_rate < 1:
+        parser.error("--max-sampling-rate: must be at least 1")
+    if options.mmap_catchup_bytes < 0:
+        parser.error("--mmap-catchup-bytes: must be positive or 0")
+    if options.late_grace_buckets < 0:
+        parser.error("--late-grace-buckets: must be positive or 0")
+    if options.tracemalloc_interval < 0:
+        parser.error("--tracemalloc-interval: must be positive or 0")
+    if not 0 < options.percentiles_accuracy < 1:
+        parser.error("--percentiles-accuracy: must be between 0 and 1 exclusive")
+
     return options
@@ -0,0 +1,114 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+# tags which can only be dropped from all measurements, as measurements share
+# aggregated values (ie. hits is used to compute means)
+COMMON_TAGS = ('vhost', 'protocol', 'loctag')
+
+# measurements which can keep upstream tag while other ones drop it
+UPSTREAM_MEASUREMENTS = (
+    'upstreams_hits',
+    'upstreams_status',
+    'upstreams_response_time_mean',
+    'upstreams_connect_time_mean',
+    'upstreams_header_time_mean',
+    'upstreams_response_time_apdex',
+    'upstreams_response_time_percentiles',
+)
+
+# measurements which can keep status tag while other ones drop it
+STATUS_MEASUREMENTS = ('status', 'upstreams_status')
+
+
+def parse_dimensions(spec):
+    """Parses tags to drop, ie. 'protocol,upstream:upstreams_hits'
+
+    TAG drops the tag from all measurements, TAG:M1+M2 keeps it only for
+    measurements M1 and M2 (upstream and status tags only).
+
+    Returns a dict tag -> measurements keeping it, an empty tuple meaning
+    the tag is dropped everywhere.
+    """
+    keep = {
+        'upstream': UPSTREAM_MEASUREMENTS,
+        'status': STATUS_MEASUREMENTS,
+    }
+    dropped = {}
+    for item in str(spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        tag, _sep, measurements = item.partition(':')
+        tag = tag.strip()
+        if tag not in COMMON_TAGS and tag not in keep:
+            raise ValueError(f"Invalid tag: {tag}")
+        measurements = tuple(m.strip() for m in measurements.split('+') if m.strip())
+        if measurements and tag not in keep:
+            raise ValueError(f"Tag {tag} can only be dropped from all measurements")
+        for measurement in measurements:
+            if measurement not in keep[tag]:
+                raise ValueError(f"Invalid measurement for tag {tag}: {measurement}")
+        dropped[tag] = measurements
+    return dropped
+
+
+class Dimensions:
+    """Tags aggregated away at ingest, see --drop-tags
+
+    Dropped tags are set to None in mbs keys, and aren't written.
+    """
+
+    def __init__(self, spec):
+        dropped = parse_dimensions(spec)
+        self.dropped = dropped
+        self.common = tuple(tag for tag in COMMON_TAGS if tag in dropped)
+        self.upstream = {
+            measurement: measurement in dropped.get('upstream', UPSTREAM_MEASUREMENTS)
+            for measurement in UPSTREAM_MEASUREMENTS
+        }
+        self.status = {
+            measurement: measurement in dropped.get('status', STATUS_MEASUREMENTS)
+            for measurement in STATUS_MEASUREMENTS
+        }
+
+    def __bool__(self):
+        return bool(self.dropped)
@@ -0,0 +1,99 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+import os
+
+
+def read_offset(path):
+    """Returns (inode, offset) saved by Pygtail in path, or None"""
+    try:
+        with open(path) as f:
+            inode, offset = (int(line) for line in f)
+    except (OSError, ValueError):
+        return None
+    return inode, offset
+
+
+class IdleCheck:
+    """Tells whether a loop can be skipped as the log file did not change
+
+    The log file inode and size are compared with the offset saved at the
+    end of last loop, without locking, nor loading status. A loop can only
+    be skipped after a loop which left no pending work (clean), and the
+    backend created by this loop is reused to send own stats, along with
+    fields of this loop, see mbstats.app.idle_loop().
+
+    Leftover buckets aren't completed by newer lines while the log file is
+    idle: once their lookback window has passed (flush_at, in seconds), a
+    loop flushing them is needed even if the log file did not change.
+    """
+
+    def __init__(self, logfile, offset_file):
+        self.logfile = logfile
+        self.offset_file = offset_file
+        self.clean = False
+        self.backend = None
+        self.fields = {}
+        self.flush_at = None
+
+    def unchanged(self):
+        if not self.clean or self.backend is None:
+            return False
+        saved = read_offset(self.offset_file)
+        if saved is None:
+            return False
+        try:
+            st = os.stat(self.logfile)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_size) == saved
+
+    def flush_due(self, now):
+        return self.flush_at is not None and now > self.flush_at
+
+    def set_leftover(self, leftover, bucket_duration, lookback_factor):
+        """Computes when leftover buckets can be flushed, see flush_due()"""
+        buckets = [bucket for bucket, rows in leftover.items() if rows]
+        if buckets:
+            # as if a line of bucket min + lookback_factor was parsed
+            self.flush_at = (min(buckets) + lookback_factor - 1) * bucket_duration
+        else:
+            self.flush_at = None
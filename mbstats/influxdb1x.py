@@ -171,6 +171,11 @@ class InfluxDBClient:
     ):
         self._database = database
         self._retries = retries
+        # cumulative write statistics, reported in mbstats own stats
+        self.serialize_seconds = 0.0
+        self.write_seconds = 0.0
+        self.write_requests = 0
+        self.bytes_sent = 0
         self._baseurl = f"http://{host}:{int(port)}"
         headers = urllib3.make_headers(basic_auth=f"{username}:{password}")
         self._http = urllib3.PoolManager(
@@ -239,7 +244,9 @@ class InfluxDBClient:
         if tags:
             data["tags"] = tags
 
+        start = time.perf_counter()
         body = make_lines(data, precision=time_precision).encode("utf-8")
+        self.serialize_seconds += time.perf_counter() - start
 
         fields = {"db": database or self._database}
         if time_precision:
@@ -249,13 +256,19 @@ class InfluxDBClient:
         from urllib.parse import urlencode
 
         path = "write?" + urlencode(fields)
-        self._request(
-            "POST",
-            path,
-            body=body,
-            headers={"Content-Type": "application/octet-stream"},
-            expected_code=204,
-        )
+        self.write_requests += 1
+        self.bytes_sent += len(body)
+        start = time.perf_counter()
+        try:
+            self._request(
+                "POST",
+                path,
+                body=body,
+                headers={"Content-Type": "application/octet-stream"},
+                expected_code=204,
+            )
+        finally:
+            self.write_seconds += time.perf_counter() - start
 
     @staticmethod
     def _batches(iterable, size):
@@ -0,0 +1,472 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+from collections import defaultdict
+import fnmatch
+import itertools
+import re
+
+from mbstats.normalize import get_normalizers
+from mbstats.utils import msec2bucket
+
+# matches nginx configuration given in mbstats -h
+DEFAULT_FORMAT = (
+    '1|$msec|$host|$statproto|$loctag|$status|$bytes_sent|$gzip_ratio'
+    '|$request_length|$request_time|$upstream_addr|$upstream_status'
+    '|$upstream_response_time|$upstream_connect_time|$upstream_header_time'
+)
+
+# field: (nginx variable, conversion, measurements group using it)
+# fields without group are always needed
+FIELDS = {
+    'msec': ('msec', 'float', None),
+    'vhost': ('host', 'str', None),
+    'protocol': ('statproto', 'str', None),
+    'loctag': ('loctag', 'str', None),
+    'status': ('status', 'int', None),
+    'bytes_sent': ('bytes_sent', 'int', None),
+    'gzip_ratio': ('gzip_ratio', 'optional_float', 'gzip'),
+    'request_length': ('request_length', 'int', 'request_length'),
+    'request_time': ('request_time', 'optional_float', 'request_time'),
+    'upstream_addr': ('upstream_addr', 'upstream', 'upstreams'),
+    'upstream_status': ('upstream_status', 'upstream', 'upstreams'),
+    'upstream_response_time': ('upstream_response_time', 'upstream', 'upstreams'),
+    'upstream_connect_time': ('upstream_connect_time', 'upstream', 'upstreams'),
+    'upstream_header_time': ('upstream_header_time', 'upstream', 'upstreams'),
+}
+
+GROUPS = ('gzip', 'request_length', 'request_time', 'upstreams')
+
+UPSTREAM_FIELDS = [field for field, spec in FIELDS.items() if spec[1] == 'upstream']
+
+VARIABLES = {variable: field for field, (variable, _c, _g) in FIELDS.items()}
+
+# fields declared in log format as $name:type:aggregation, ie.
+# $upstream_bytes_received:int:sum, see custom_measurements()
+CUSTOM_TYPES = ('int', 'float')
+CUSTOM_AGGREGATIONS = ('sum', 'mean')
+CUSTOM_NAME_REGEX = re.compile(r'^[a-z][a-z0-9_]*$')
+# keys of rows which aren't fields, see mbstats.app.process_bucket()
+ROW_KEYS = ('upstreams', 'sampling')
+
+
+class ParseSkip(Exception):
+    # used to count skipped lines per reason
+    reason = 'invalid'
+    log = True
+
+    def __init__(self, message, reason=None):
+        super().__init__(message)
+        if reason is not None:
+            self.reason = reason
+
+
+class ParseLate(ParseSkip):
+    reason = 'late'
+
+
+class ParseFiltered(ParseSkip):
+    reason = 'filtered'
+    # expected, only counted
+    log = False
+
+
+def parse_upstreams(row):
+    # servers were contacted ", "
+    # internal redirect " : "
+    r = dict()
+    splitted = [x.split(' : ') for x in row['upstream_addr'].split(", ")]
+    r['servers_contacted'] = len(splitted)
+    r['internal_redirects'] = len([x for x in splitted if len(x) > 1])
+    upstream_addr = list(itertools.chain.from_iterable(splitted))
+
+    upstream_status = list(
+        itertools.chain.from_iterable(
+            [x.split(' : ') for x in row['upstream_status'].split(", ")]
+        )
+    )
+    upstream_response_time = list(
+        itertools.chain.from_iterable(
+            [x.split(' : ') for x in row['upstream_response_time'].split(", ")]
+        )
+    )
+    upstream_header_time = list(
+        itertools.chain.from_iterable(
+            [x.split(' : ') for x in row['upstream_header_time'].split(", ")]
+        )
+    )
+    upstream_connect_time = list(
+        itertools.chain.from_iterable(
+            [x.split(' : ') for x in row['upstream_connect_time'].split(", ")]
+        )
+    )
+
+    r['status'] = dict()
+    r['response_time'] = defaultdict(float)
+    r['connect_time'] = defaultdict(float)
+    r['header_time'] = defaultdict(float)
+    r['response_time_count'] = defaultdict(int)
+    r['connect_time_count'] = defaultdict(int)
+    r['header_time_count'] = defaultdict(int)
+    r['servers'] = []
+    for item in zip(
+        upstream_addr,
+        upstream_status,
+        upstream_response_time,
+        upstream_connect_time,
+        upstream_header_time,
+    ):
+        k = item[0]
+        r['servers'].append(k)
+        # not using defauldict() here intentionally, because it requires lamba/function
+        # and it breaks with pickle
+        if k not in r['status']:
+            r['status'][k] = dict()
+
+        # ensure status code is an integer (but it is stored as string), this
+        # should raise ValueError if it can't be converted
+        if item[1] != '-':
+            status = str(int(item[1]))
+        else:
+            status = item[1]
+        if status in r['status'][k]:
+            r['status'][k][status] += 1
+        else:
+            r['status'][k][status] = 1
+
+        if item[2] not in ('-', ''):
+            try:
+                r['response_time'][k] += float(item[2])
+                r['response_time_count'][k] += 1
+            except ValueError:
+                raise
+
+        if item[3] not in ('-', ''):
+            try:
+                r['connect_time'][k] += float(item[3])
+                r['connect_time_count'][k] += 1
+            except ValueError:
+                raise
+
+        if item[4] not in ('-', ''):
+            try:
+                r['header_time'][k] += float(item[4])
+                r['header_time_count'][k] += 1
+            except ValueError:
+                raise
+
+    return r
+
+
+def sum_values(value, convert):
+    """Converts value, adding up lists like '12, 3 : 4' of upstream variables"""
+    if ',' not in value and ':' not in value:
+        return convert(value)
+    total = convert(0)
+    for item in value.replace(' : ', ', ').split(', '):
+        if item not in ('-', ''):
+            total += convert(item)
+    return total
+
+
+def custom_measurements(custom):
+    """Returns measurements of fields declared in log format
+
+    Returns a tuple of (measurement, int or float) summed from rows, and a
+    dict of mean measurement: (sum, count). A sum field is written as <name>_sum,
+    a mean field as <name>_mean, both tagged like bytes_sent.
+    """
+    additive = []
+    means = {}
+    for name, conversion, aggregation in custom:
+        conversion = int if conversion == 'int' else float
+        if aggregation == 'sum':
+            additive.append((f'{name}_sum', conversion))
+        else:
+            additive += [(f'_{name}_premean', conversion), (f'_{name}_count', int)]
+            means[f'{name}_mean'] = (f'_{name}_premean', f'_{name}_count')
+    return tuple(additive), means
+
+
+def enabled_groups(disabled):
+    """Returns measurements groups not in disabled, ie. 'gzip,upstreams'"""
+    if isinstance(disabled, str):
+        disabled = [group.strip() for group in disabled.split(',') if group.strip()]
+    for group in disabled:
+        if group not in GROUPS:
+            raise ValueError(f"Invalid measurements group: {group}")
+    return tuple(group for group in GROUPS if group not in disabled)
+
+
+# fields which can be used in --include-lines and --exclude-lines rules
+FILTER_FIELDS = ('vhost', 'loctag', 'status')
+
+
+def parse_filters(spec):
+    """Parses 'vhost=a,vhost=*.b,status=444' to (('status', ('444',)), ...)
+
+    Returned value is hashable, so it can be passed to compile_format().
+    """
+    filters = defaultdict(list)
+    for rule in str(spec or '').split(','):
+        if not rule.strip():
+            continue
+        field, sep, value = rule.partition('=')
+        field = field.strip()
+        if not sep or not value.strip():
+            raise ValueError(f"Invalid filter rule: {rule}")
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Invalid filter field: {field}")
+        filters[field].append(value.strip())
+    return tuple((field, tuple(values)) for field, values in sorted(filters.items()))
+
+
+class GlobMatcher:
+    """Supports `in` operator for a set of glob patterns"""
+
+    def __init__(self, patterns):
+        self.regex = re.compile(
+            '|'.join(fnmatch.translate(pattern) for pattern in patterns)
+        )
+
+    def __contains__(self, value):
+        return self.regex.match(value) is not None
+
+
+def filter_matcher(values):
+    """Returns a frozenset, or a GlobMatcher if any of values is a glob"""
+    if any(c in value for value in values for c in '*?['):
+        return GlobMatcher(values)
+    return frozenset(values)
+
+
+def parse_custom_field(item):
+    """Parses '$name:type:aggregation' to (name, type, aggregation)"""
+    try:
+        name, conversion, aggregation = item[1:].split(':')
+    except ValueError:
+        raise ValueError(f"invalid field declaration: {item}")
+    if not CUSTOM_NAME_REGEX.match(name):
+        raise ValueError(f"invalid field name: {item}")
+    if name in FIELDS or name in VARIABLES:
+        raise ValueError(f"field is known to mbstats, it can't be declared: {item}")
+    if name in ROW_KEYS or name.startswith('upstreams_'):
+        # used by rows or upstreams measurements
+        raise ValueError(f"reserved field name: {item}")
+    if conversion not in CUSTOM_TYPES:
+        raise ValueError(f"invalid field type: {item}")
+    if aggregation not in CUSTOM_AGGREGATIONS:
+        raise ValueError(f"invalid field aggregation: {item}")
+    return name, conversion, aggregation
+
+
+def parse_format(spec, custom=None):
+    """Parses a nginx log_format like '1|$msec|$host|...'
+
+    Returns the version and the position of each field, nginx variables
+    unknown to mbstats are ignored, unless declared with their type and
+    aggregation, ie. $upstream_bytes_received:int:sum. If custom is a list,
+    declared fields are appended to it, as returned by parse_custom_field().
+    """
+    items = spec.strip().split('|')
+    version = items[0]
+    if not version or version.startswith('$'):
+        raise ValueError("log format has to start with a version")
+    positions = {}
+    for position, item in enumerate(items[1:], start=1):
+        if not item.startswith('$'):
+            raise ValueError(f"invalid log format item: {item}")
+        name = item[1:]
+        if ':' in name:
+            declaration = parse_custom_field(item)
+            field = declaration[0]
+            if custom is not None and field not in positions:
+                custom.append(declaration)
+        else:
+            field = VARIABLES.get(name, name if name in FIELDS else None)
+        if field is None:
+            continue
+        if field in positions:
+            raise ValueError(f"duplicated field in log format: {item}")
+        positions[field] = position
+    for field, (variable, _conversion, group) in FIELDS.items():
+        if group is None and field not in positions:
+            raise ValueError(f"missing field in log format: ${variable}")
+    upstreams = [field for field in UPSTREAM_FIELDS if field in positions]
+    if upstreams and len(upstreams) != len(UPSTREAM_FIELDS):
+        raise ValueError(
+            "log format needs all or none of: "
+            + ', '.join('$' + FIELDS[field][0] for field in UPSTREAM_FIELDS)
+        )
+    return version, positions
+
+
+def compile_format(
+    spec, groups=None, include=(), exclude=(), normalize=(), normalize_cache_size=4096
+):
+    """Compiles a log format to a function parsing a line to a row
+
+    Returned function takes a line, and last_msec, ignore_before and
+    bucket_duration keyword arguments, and returns (row, last_msec, bucket).
+    Only fields needed by measurements groups (all if None), and fields
+    declared with their type and aggregation, are extracted and converted.
+    Lines are filtered on raw fields, right after version check, using
+    include and exclude as returned by parse_filters(): for each field in
+    include, value has to match one of the rules. Tags are
+    then normalized using rules returned by parse_normalize(), memoized per
+    distinct raw value in LRU caches of normalize_cache_size entries.
+    Upstream addresses are kept raw in rows, their normalizer is available
+    as `normalize_upstream` attribute of returned function, for
+    mbstats.app.process_bucket(). Generated source is available as
+    `source` attribute of returned function.
+    """
+    custom = []
+    version, positions = parse_format(spec, custom=custom)
+    if groups is not None:
+        positions = {
+            field: position
+            for field, position in positions.items()
+            if field not in FIELDS
+            or FIELDS[field][2] is None
+            or FIELDS[field][2] in groups
+        }
+    last = max(positions.values())
+    # trailing new line character is in last field, if it was split
+    last_split = len(spec.strip().split('|')) - 1
+
+    def item(field):
+        position = positions[field]
+        if position == last_split:
+            return f"items[{position}].rstrip('\\r\\n')"
+        return f"items[{position}]"
+
+    code = [
+        "def parseline(line, last_msec=0, ignore_before=0, bucket_duration=60):",
+        f"    items = line.split('|', {last + 1})",
+        f"    if items[0] != {version!r}:",
+        "        raise ParseSkip(",
+        "            f'invalid log version: {items[0]}', reason='version'",
+        "        )",
+    ]
+    namespace = {}
+    normalizers = get_normalizers(normalize, normalize_cache_size)
+    normalize_upstream = normalizers.pop('upstream', None)
+    for tag, normalizer in normalizers.items():
+        namespace[f'normalize_{tag}'] = normalizer
+    for field, values in include:
+        namespace[f'include_{field}'] = filter_matcher(values)
+        code += [
+            f"    if {item(field)} not in include_{field}:",
+            f"        raise ParseFiltered('{field} not included')",
+        ]
+    for field, values in exclude:
+        namespace[f'exclude_{field}'] = filter_matcher(values)
+        code += [
+            f"    if {item(field)} in exclude_{field}:",
+            f"        raise ParseFiltered('{field} excluded')",
+        ]
+    code += [
+        "    try:",
+        f"        msec = float({item('msec')})",
+        "    except ValueError as e:",
+        "        raise ParseSkip(str(e), reason='msec')",
+        "    if msec <= ignore_before:",
+        "        raise ParseLate('unordered or old entry')",
+        "    try:",
+        "        row = {",
+    ]
+    optional = []
+    for field, (_variable, conversion, _group) in FIELDS.items():
+        if field == 'msec' or field not in positions:
+            continue
+        if conversion == 'str' and field in normalizers:
+            code.append(f"            {field!r}: normalize_{field}({item(field)}),")
+        elif conversion == 'str':
+            code.append(f"            {field!r}: {item(field)},")
+        elif conversion in ('int', 'float'):
+            code.append(f"            {field!r}: {conversion}({item(field)}),")
+        elif conversion == 'optional_float':
+            optional += [
+                f"        value = {item(field)}",
+                "        if value != '-':",
+                f"            row[{field!r}] = float(value)",
+            ]
+    code.append("        }")
+    code += optional
+    for field, conversion, _aggregation in custom:
+        code += [
+            f"        value = {item(field)}",
+            "        if value != '-':",
+            f"            row[{field!r}] = sum_values(value, {conversion})",
+        ]
+    if 'upstream_addr' in positions:
+        code += [
+            f"        if {item('upstream_addr')} != '-':",
+            "            row['upstreams'] = parse_upstreams({",
+        ]
+        code += [
+            f"                {field!r}: {item(field)}," for field in UPSTREAM_FIELDS
+        ]
+        code.append("            })")
+    code += [
+        "    except ValueError as e:",
+        "        raise ParseSkip(str(e), reason='field')",
+        "    if msec > last_msec:",
+        "        last_msec = msec",
+        "    bucket = msec2bucket(msec, bucket_duration)",
+        "    return row, last_msec, bucket",
+    ]
+    source = '\n'.join(code) + '\n'
+    namespace.update(
+        ParseFiltered=ParseFiltered,
+        ParseLate=ParseLate,
+        ParseSkip=ParseSkip,
+        msec2bucket=msec2bucket,
+        parse_upstreams=parse_upstreams,
+        sum_values=sum_values,
+    )
+    exec(compile(source, f'<log format {spec!r}>', 'exec'), namespace)
+    parseline = namespace['parseline']
+    parseline.source = source
+    parseline.msec_index = positions['msec']
+    parseline.normalize_upstream = normalize_upstream
+    parseline.custom = tuple(custom)
+    return parseline
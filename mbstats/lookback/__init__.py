@@ -0,0 +1,72 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+def adapt_lookback(lateness, percentile, current, maximum):
+    """Returns the smallest lookback factor covering percentile of lines
+
+    lateness maps a number of buckets a line was behind the newest one to a
+    count of lines. The lookback factor follows increases at once, but is
+    lowered by one bucket per loop only, to avoid oscillations.
+    """
+    total = sum(lateness.values())
+    if not total:
+        return min(current, maximum)
+    needed = total * percentile / 100.0
+    covered = 0
+    wanted = maximum
+    for late in sorted(lateness):
+        covered += lateness[late]
+        if covered >= needed:
+            # a line late by n buckets needs a lookback of n + 1
+            wanted = min(late + 1, maximum)
+            break
+    if wanted < current:
+        wanted = min(current - 1, maximum)
+    return max(wanted, 1)
+
+
+def decay_lateness(lateness):
+    """Halves counts, so lateness distribution follows traffic changes"""
+    for late in list(lateness):
+        lateness[late] //= 2
+        if not lateness[late]:
+            del lateness[late]
@@ -0,0 +1,160 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+import functools
+import ipaddress
+import re
+
+# tags which can be normalized, using raw values from log lines
+TAGS = ('vhost', 'loctag', 'upstream')
+
+# host and port of an address, ie. 10.2.2.31:65412 or [::1]:8080
+ADDRESS_REGEX = re.compile(r'^(\[[^\]]*\]|[^:\[\]]+):(\d+)$')
+
+
+def split_port(value):
+    """Returns host part of address, or value if it has no port"""
+    m = ADDRESS_REGEX.match(value)
+    if m is None:
+        return value
+    return m.group(1)
+
+
+def parse_rule(rule):
+    """Checks a normalization rule and returns it as a hashable tuple"""
+    if rule in ('lower', 'strip_port'):
+        return (rule,)
+    if rule.startswith('s') and len(rule) > 1:
+        # sed-like, using any delimiter: s/REGEX/REPLACEMENT/
+        delimiter = rule[1]
+        parts = rule[2:].split(delimiter)
+        if len(parts) != 3 or parts[2] or not parts[0]:
+            raise ValueError(f"Invalid rewrite rule: {rule}")
+        try:
+            re.compile(parts[0])
+        except re.error as e:
+            raise ValueError(f"Invalid rewrite rule: {rule}: {e}")
+        return ('rewrite', parts[0], parts[1])
+    network, sep, pool = rule.partition('=')
+    if sep and pool:
+        try:
+            ipaddress.ip_network(network)
+        except ValueError as e:
+            raise ValueError(f"Invalid pool rule: {rule}: {e}")
+        return ('pool', network, pool)
+    raise ValueError(f"Invalid normalization rule: {rule}")
+
+
+def parse_normalize(spec):
+    """Parses ['vhost:lower', 'upstream:10.2.2.0/24=web'] to per tag rules
+
+    Each item is one TAG:RULE, items aren't split on commas, as rewrite
+    rules may contain some (ie. in a quantifier). A single item can be
+    passed as a string. Rules of a tag are applied in order:
+    - lower: folds value to lower case
+    - strip_port: removes port from addresses
+    - s/REGEX/REPLACEMENT/: rewrites value, any delimiter can be used
+    - CIDR=POOL: replaces addresses (with or without port) in CIDR by POOL
+
+    Returned value is hashable, so it can be passed to compile_format().
+    """
+    if isinstance(spec, str):
+        spec = [spec]
+    rules = {}
+    for item in spec or ():
+        item = item.strip()
+        if not item:
+            continue
+        tag, sep, rule = item.partition(':')
+        tag = tag.strip()
+        if not sep or not rule.strip():
+            raise ValueError(f"Invalid normalization: {item}")
+        if tag not in TAGS:
+            raise ValueError(f"Invalid normalization tag: {tag}")
+        rules.setdefault(tag, []).append(parse_rule(rule.strip()))
+    return tuple((tag, tuple(rules[tag])) for tag in TAGS if tag in rules)
+
+
+class Normalizer:
+    """Applies normalization rules of a tag to a raw value"""
+
+    def __init__(self, rules):
+        self.steps = []
+        for rule in rules:
+            if rule[0] == 'lower':
+                self.steps.append(str.lower)
+            elif rule[0] == 'strip_port':
+                self.steps.append(split_port)
+            elif rule[0] == 'rewrite':
+                self.steps.append(
+                    functools.partial(re.compile(rule[1]).sub, rule[2], count=1)
+                )
+            elif rule[0] == 'pool':
+                self.steps.append(
+                    functools.partial(self.pool, ipaddress.ip_network(rule[1]), rule[2])
+                )
+
+    @staticmethod
+    def pool(network, pool, value):
+        try:
+            address = ipaddress.ip_address(split_port(value).strip('[]'))
+        except ValueError:
+            return value
+        if address in network:
+            return pool
+        return value
+
+    def __call__(self, value):
+        for step in self.steps:
+            value = step(value)
+        return value
+
+
+def get_normalizers(rules, cache_size):
+    """Returns per tag normalizers, memoized per distinct raw value
+
+    As the number of distinct raw values is small compared to the number
+    of lines, rules are applied once per value, through a bounded LRU cache.
+    """
+    return {
+        tag: functools.lru_cache(maxsize=cache_size)(Normalizer(tag_rules))
+        for tag, tag_rules in rules
+    }
@@ -0,0 +1,76 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+import math
+import os
+
+
+def pending_bytes(tailer):
+    """Returns the number of bytes not yet read by a Pygtail instance"""
+    try:
+        size = os.stat(tailer.filename).st_size
+        if tailer.rotated_logfile:
+            # remaining of rotated file is read first
+            rotated = os.stat(tailer.rotated_logfile).st_size
+            return max(rotated - tailer.offset, 0) + size
+    except OSError:
+        return 0
+    if size < tailer.offset:
+        # truncated, read from start
+        return size
+    return size - tailer.offset
+
+
+def adapt_sampling(pending, throughput, target_seconds, current, maximum):
+    """Returns N so 1 in N lines are parsed, for the backlog to clear in time
+
+    pending is the backlog in bytes and throughput the bytes per second read
+    during last loop, while sampling 1 in current lines. Sampling rate is
+    raised immediately, lowered by half at most per loop once backlog can be
+    parsed in half of target_seconds, and clamped to [1, maximum].
+    """
+    if throughput > 0:
+        needed = pending / (throughput * target_seconds)
+        if needed > 1:
+            current = math.ceil(current * needed)
+        elif needed < 0.5:
+            current //= 2
+    return max(1, min(current, maximum))
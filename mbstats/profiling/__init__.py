@@ -0,0 +1,161 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+from collections import Counter
+import cProfile
+import os.path
+import signal
+
+
+def rotate_files(path, suffix, keep):
+    """Shifts path.N.suffix to path.N+1.suffix, keeping at most keep files"""
+
+    def name(index):
+        if index:
+            return f"{path}.{index}{suffix}"
+        return f"{path}{suffix}"
+
+    oldest = name(keep - 1)
+    if os.path.isfile(oldest):
+        os.remove(oldest)
+    for index in range(keep - 2, -1, -1):
+        if os.path.isfile(name(index)):
+            os.rename(name(index), name(index + 1))
+    return name(0)
+
+
+class LoopProfiler:
+    """Runs each main loop under cProfile, dumping rotating .pstats files"""
+
+    def __init__(self, basepath, keep=10, logger=None):
+        self.basepath = basepath
+        self.keep = max(1, keep)
+        self.logger = logger
+
+    def runcall(self, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            try:
+                path = rotate_files(self.basepath, '.pstats', self.keep)
+                profiler.dump_stats(path)
+                if self.logger:
+                    self.logger.debug(f"LoopProfiler: dumped stats to {path!r}")
+            except OSError as e:
+                if self.logger:
+                    self.logger.error(f"LoopProfiler: failed to dump stats: {e}")
+
+
+class StackSampler:
+    """Low overhead statistical profiler based on SIGPROF
+
+    Stacks are sampled every interval seconds of CPU time, and dumped
+    in collapsed format (one 'frame;frame;frame count' per line), usable
+    with flamegraph tools. Sampling is toggled on signal through
+    request_toggle(), but only started or stopped by update(), called
+    between loops, so no file is written from the signal handler.
+    """
+
+    def __init__(self, basepath, interval=0.005, logger=None):
+        self.path = f"{basepath}.samples"
+        self.interval = interval
+        self.logger = logger
+        self.stacks = Counter()
+        self.running = False
+        self.toggle_requested = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+            )
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        if self.running:
+            return
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        if self.logger:
+            self.logger.info(f"Stack sampling started (interval={self.interval}s)")
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+        self.dump()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def request_toggle(self, signum=None, frame=None):
+        self.toggle_requested = True
+
+    def update(self):
+        if self.toggle_requested:
+            self.toggle_requested = False
+            self.toggle()
+
+    def dump(self):
+        try:
+            with open(self.path, 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            if self.logger:
+                self.logger.info(
+                    f"Stack sampling: dumped {sum(self.stacks.values())} samples"
+                    f" to {self.path!r}"
+                )
+        except OSError as e:
+            if self.logger:
+                self.logger.error(f"Stack sampling: failed to dump samples: {e}")
+        self.stacks.clear()
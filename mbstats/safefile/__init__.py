@@ -38,14 +38,29 @@
 # For a full description of the license, please visit
 # http://www.gnu.org/licenses/gpl.txt
 #
+import os
 import os.path
 import re
 import shutil
 from uuid import uuid1
 
+# see SafeFile.rename_tmp_to_main()
+FSYNC_POLICIES = ('none', 'data', 'full')
+
+
+def fsync_path(path, directory=False):
+    flags = os.O_RDONLY
+    if directory:
+        flags |= getattr(os, 'O_DIRECTORY', 0)
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class SafeFile:
-    def __init__(self, workdir, identifier, suffix='', logger=None):
+    def __init__(self, workdir, identifier, suffix='', logger=None, fsync='none'):
         self.identifier = identifier
         self.suffix = suffix
         self.sane_filename = re.sub(r'\W', '_', self.identifier + self.suffix)
@@ -55,15 +70,25 @@ class SafeFile:
         self.old = f"{self.main}.old"
         self.lock = f"{self.main}.lock"
         self.logger = logger
+        self.fsync = fsync
 
     def backup_main(self):
+        # previous generation is kept as a hard link, no byte is copied, main
+        # being replaced by a rename; copy only if links aren't supported
         try:
             if os.path.isfile(self.old):
                 os.unlink(self.old)
-            shutil.copy2(self.main, self.old)
+            try:
+                os.link(self.main, self.old)
+                action = 'Linked'
+            except FileNotFoundError:
+                raise
+            except OSError:
+                shutil.copy2(self.main, self.old)
+                action = 'Copied'
             if self.logger:
                 self.logger.debug(
-                    f"backup_main(): Copied {self.main!r} to {self.old!r}"
+                    f"backup_main(): {action} {self.main!r} to {self.old!r}"
                 )
         except Exception as e:
             if self.logger:
@@ -72,9 +97,18 @@ class SafeFile:
                 )
 
     def rename_tmp_to_main(self):
+        """Atomically replaces main by tmp, keeping previous main as old
+
+        With fsync policy 'data', tmp content is flushed to disk before the
+        rename, with 'full' the rename itself is flushed too.
+        """
         try:
+            if self.fsync != 'none':
+                fsync_path(self.tmp)
             self.backup_main()
             os.rename(self.tmp, self.main)
+            if self.fsync == 'full':
+                fsync_path(self.workdir, directory=True)
             if self.logger:
                 self.logger.debug(
                     f"rename_tmp_to_main(): Renamed {self.tmp!r} to {self.main!r}"
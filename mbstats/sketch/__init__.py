@@ -0,0 +1,141 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+import math
+
+# values below this are counted as zero (nginx times have a 1ms resolution)
+MIN_INDEXABLE_VALUE = 1e-6
+
+
+class DDSketch:
+    """Mergeable quantile sketch with relative accuracy guarantees
+
+    Values are counted in logarithmically sized bins, so that any quantile
+    is estimated within relative_accuracy of the true value. Memory is
+    bounded by max_bins: when exceeded, lowest bins are collapsed, which
+    only affects accuracy of the lowest quantiles.
+
+    See https://arxiv.org/abs/1908.10693
+    """
+
+    __slots__ = (
+        'relative_accuracy',
+        'max_bins',
+        'log_gamma',
+        'bins',
+        'zero_count',
+        'count',
+    )
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.log_gamma = math.log(self._gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    @property
+    def _gamma(self):
+        return (1.0 + self.relative_accuracy) / (1.0 - self.relative_accuracy)
+
+    def add(self, value, count=1):
+        self.count += count
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        bins = self.bins
+        if index in bins:
+            bins[index] += count
+        else:
+            bins[index] = count
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def _collapse(self):
+        lowest, second = sorted(self.bins)[:2]
+        self.bins[second] += self.bins.pop(lowest)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracies")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+        while len(bins) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q):
+        """Returns estimated value at quantile q (0 <= q <= 1), None if empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                break
+        gamma = self._gamma
+        return 2.0 * gamma**index / (gamma + 1.0)
+
+
+def parse_percentiles(percentiles):
+    """Converts '50,95,99.9' to [50.0, 95.0, 99.9]"""
+    if not percentiles:
+        return []
+    result = []
+    for item in str(percentiles).split(','):
+        value = float(item)
+        if not 0 < value < 100:
+            raise ValueError(f"Invalid percentile: {item}")
+        result.append(value)
+    return result
+
+
+def percentile_suffix(percentile):
+    """Returns measurement suffix for a percentile: 95 -> p95, 99.9 -> p99_9"""
+    return 'p' + f'{percentile:g}'.replace('.', '_')
@@ -0,0 +1,609 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+"""Compact binary format for status files
+
+A file starts with MAGIC and a version byte, followed by one encoded value.
+Each value starts with a type tag byte. Strings are written once, then
+referenced by index. Lists of dicts, like leftover rows and saved points,
+are written as tables: keys are written once per distinct set of keys,
+and values column by column, columns of ints, floats or strings being
+packed with struct in one call.
+
+Only types found in status can be encoded, so loading a status file
+never executes code, unlike pickle. Status files pickled by previous
+versions are loaded by loads_pickle(), which only accepts those types.
+"""
+
+from collections import (
+    defaultdict,
+    deque,
+)
+import contextlib
+import gc
+import io
+import itertools
+from operator import itemgetter
+import pickle
+import struct
+
+from mbstats.cardinality import HeavyHitters
+from mbstats.sketch import DDSketch
+
+MAGIC = b'MBSTATS\0'
+VERSION = 1
+
+# type tags
+NONE = 0
+TRUE = 1
+FALSE = 2
+INT = 3
+BIGINT = 4
+FLOAT = 5
+STR = 6
+STR_REF = 7
+BYTES = 8
+LIST = 9
+TUPLE = 10
+DICT = 11
+SET = 12
+DEQUE = 13
+DEFAULTDICT = 14
+OBJECT = 15
+TABLE = 16
+
+# table columns
+COLUMN_VALUES = 0
+COLUMN_INT = 1
+COLUMN_FLOAT = 2
+COLUMN_STR = 3
+COLUMN_LISTS = 4
+COLUMN_DEFAULTDICTS = 5
+
+# defaultdict factories which can be encoded
+FACTORIES = {
+    'int': int,
+    'float': float,
+    'dict': dict,
+    'list': list,
+    'deque': deque,
+}
+
+FACTORY_NAMES = {factory: name for name, factory in FACTORIES.items()}
+
+# name: (class, attributes), objects are restored without calling __init__()
+CLASSES = {
+    'DDSketch': (DDSketch, DDSketch.__slots__),
+    'HeavyHitters': (
+        HeavyHitters,
+        (
+            'k',
+            'capacity',
+            'counts',
+            'errors',
+            'floor',
+            'allowed',
+            'admitted',
+            'overflow',
+        ),
+    ),
+}
+
+CLASS_NAMES = {cls: name for name, (cls, _attributes) in CLASSES.items()}
+
+# globals a pickled status may refer to
+PICKLE_GLOBALS = {
+    (obj.__module__, obj.__qualname__): obj
+    for obj in (
+        defaultdict,
+        deque,
+        int,
+        float,
+        str,
+        bytes,
+        bool,
+        dict,
+        list,
+        tuple,
+        set,
+        frozenset,
+        *CLASS_NAMES,
+    )
+}
+
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+F64 = struct.Struct('<d')
+
+INT_MIN = -(2**63)
+INT_MAX = 2**63 - 1
+
+
+class StatusFormatError(ValueError):
+    """Raised when data can't be decoded"""
+
+
+class Encoder:
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = {}
+        self.encoders = {
+            type(None): self.encode_none,
+            bool: self.encode_bool,
+            int: self.encode_int,
+            float: self.encode_float,
+            str: self.encode_str,
+            bytes: self.encode_bytes,
+            list: self.encode_list,
+            tuple: self.encode_tuple,
+            dict: self.encode_dict,
+            set: self.encode_set,
+            deque: self.encode_deque,
+            defaultdict: self.encode_defaultdict,
+        }
+        for cls in CLASS_NAMES:
+            self.encoders[cls] = self.encode_object
+
+    def encode(self, value):
+        try:
+            encoder = self.encoders[type(value)]
+        except KeyError:
+            raise TypeError(f"Cannot encode {type(value).__name__} in status")
+        encoder(value)
+
+    def encode_none(self, value):
+        self.out.append(NONE)
+
+    def encode_bool(self, value):
+        self.out.append(TRUE if value else FALSE)
+
+    def encode_int(self, value):
+        if INT_MIN <= value <= INT_MAX:
+            self.out.append(INT)
+            self.out += I64.pack(value)
+        else:
+            self.out.append(BIGINT)
+            self.encode_str(str(value))
+
+    def encode_float(self, value):
+        self.out.append(FLOAT)
+        self.out += F64.pack(value)
+
+    def encode_str(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            self.strings[value] = len(self.strings)
+            data = value.encode('utf-8', 'surrogatepass')
+            self.out.append(STR)
+            self.out += U32.pack(len(data))
+            self.out += data
+        else:
+            self.out.append(STR_REF)
+            self.out += U32.pack(index)
+
+    def encode_bytes(self, value):
+        self.out.append(BYTES)
+        self.out += U32.pack(len(value))
+        self.out += value
+
+    def encode_items(self, tag, values):
+        self.out.append(tag)
+        self.out += U32.pack(len(values))
+        encode = self.encode
+        for value in values:
+            encode(value)
+
+    def encode_list(self, value):
+        if len(value) > 1 and all(type(row) is dict for row in value):
+            self.encode_table(value)
+        else:
+            self.encode_items(LIST, value)
+
+    def encode_tuple(self, value):
+        self.encode_items(TUPLE, value)
+
+    def encode_set(self, value):
+        self.encode_items(SET, value)
+
+    def encode_dict_items(self, value):
+        self.out += U32.pack(len(value))
+        encode = self.encode
+        for k, v in value.items():
+            encode(k)
+            encode(v)
+
+    def encode_dict(self, value):
+        self.out.append(DICT)
+        self.encode_dict_items(value)
+
+    def encode_defaultdict(self, value):
+        try:
+            name = FACTORY_NAMES[value.default_factory]
+        except KeyError:
+            raise TypeError(
+                f"Cannot encode defaultdict({value.default_factory!r}) in status"
+            )
+        self.out.append(DEFAULTDICT)
+        self.encode_str(name)
+        self.encode_dict_items(value)
+
+    def encode_deque(self, value):
+        self.out.append(DEQUE)
+        self.encode(value.maxlen)
+        self.encode_list(list(value))
+
+    def encode_object(self, value):
+        name = CLASS_NAMES[type(value)]
+        _cls, attributes = CLASSES[name]
+        self.out.append(OBJECT)
+        self.encode_str(name)
+        self.encode_tuple(tuple(getattr(value, a) for a in attributes))
+
+    def encode_table(self, rows):
+        # rows are grouped per keys, in order of appearance
+        keys_per_row = list(map(tuple, rows))
+        groups = list(dict.fromkeys(keys_per_row))
+        if len(groups) > 255:
+            self.encode_items(LIST, rows)
+            return
+        self.out.append(TABLE)
+        self.out += U32.pack(len(rows))
+        self.out += U32.pack(len(groups))
+        if len(groups) == 1:
+            self.encode_group(groups[0], rows)
+            return
+        for keys in groups:
+            self.encode_group(
+                keys, [row for row, k in zip(rows, keys_per_row) if k == keys]
+            )
+        # group of each row, to restore rows order
+        index = {keys: i for i, keys in enumerate(groups)}
+        self.out += bytes([index[keys] for keys in keys_per_row])
+
+    def encode_group(self, keys, rows):
+        self.encode_tuple(keys)
+        self.out += U32.pack(len(rows))
+        if len(keys) == 1:
+            columns = [list(map(itemgetter(keys[0]), rows))]
+        elif keys:
+            columns = zip(*map(itemgetter(*keys), rows))
+        else:
+            columns = []
+        for column in columns:
+            self.encode_column(column)
+
+    def encode_column(self, values):
+        out = self.out
+        types = set(map(type, values))
+        count = len(values)
+        if types == {int}:
+            try:
+                packed = struct.pack(f'<{count}q', *values)
+            except struct.error:
+                pass
+            else:
+                out.append(COLUMN_INT)
+                out += packed
+                return
+        elif types == {float}:
+            out.append(COLUMN_FLOAT)
+            out += struct.pack(f'<{count}d', *values)
+            return
+        elif types == {str}:
+            distinct = list(dict.fromkeys(values))
+            index = {value: i for i, value in enumerate(distinct)}
+            out.append(COLUMN_STR)
+            self.encode_items(LIST, distinct)
+            out += struct.pack(f'<{count}I', *map(index.__getitem__, values))
+            return
+        elif types == {list}:
+            # flattened, ie. upstream servers of rows
+            out.append(COLUMN_LISTS)
+            out += struct.pack(f'<{count}I', *map(len, values))
+            flat = list(itertools.chain.from_iterable(values))
+            self.out += U32.pack(len(flat))
+            self.encode_column(flat)
+            return
+        elif types == {defaultdict}:
+            factories = {value.default_factory for value in values}
+            if len(factories) == 1 and next(iter(factories)) in FACTORY_NAMES:
+                # flattened keys and values, ie. upstream times of rows
+                out.append(COLUMN_DEFAULTDICTS)
+                self.encode_str(FACTORY_NAMES[factories.pop()])
+                out += struct.pack(f'<{count}I', *map(len, values))
+                items = list(itertools.chain.from_iterable(map(dict.items, values)))
+                self.out += U32.pack(len(items))
+                if items:
+                    keys, flat = zip(*items)
+                    self.encode_column(list(keys))
+                    self.encode_column(list(flat))
+                else:
+                    self.encode_column([])
+                    self.encode_column([])
+                return
+        out.append(COLUMN_VALUES)
+        self.encode_list(list(values))
+
+
+class Decoder:
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+        decoders = {
+            NONE: lambda: None,
+            TRUE: lambda: True,
+            FALSE: lambda: False,
+            INT: self.decode_int,
+            BIGINT: self.decode_bigint,
+            FLOAT: self.decode_float,
+            STR: self.decode_str,
+            STR_REF: self.decode_str_ref,
+            BYTES: self.decode_bytes,
+            LIST: self.decode_list,
+            TUPLE: self.decode_tuple,
+            DICT: self.decode_dict,
+            SET: self.decode_set,
+            DEQUE: self.decode_deque,
+            DEFAULTDICT: self.decode_defaultdict,
+            OBJECT: self.decode_object,
+            TABLE: self.decode_table,
+        }
+        self.decoders = [decoders.get(tag, self.invalid) for tag in range(256)]
+
+    def decode(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        return self.decoders[tag]()
+
+    def invalid(self):
+        raise StatusFormatError(
+            f"Invalid tag {self.data[self.pos - 1]} at {self.pos - 1}"
+        )
+
+    def u32(self):
+        (value,) = U32.unpack_from(self.data, self.pos)
+        self.pos += 4
+        return value
+
+    def decode_int(self):
+        (value,) = I64.unpack_from(self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def decode_bigint(self):
+        return int(self.decode())
+
+    def decode_float(self):
+        (value,) = F64.unpack_from(self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def decode_str(self):
+        size = self.u32()
+        value = self.data[self.pos : self.pos + size].decode('utf-8', 'surrogatepass')
+        self.pos += size
+        self.strings.append(value)
+        return value
+
+    def decode_str_ref(self):
+        return self.strings[self.u32()]
+
+    def decode_bytes(self):
+        size = self.u32()
+        value = bytes(self.data[self.pos : self.pos + size])
+        self.pos += size
+        return value
+
+    def decode_items(self):
+        decode = self.decode
+        return [decode() for _i in range(self.u32())]
+
+    def decode_list(self):
+        return self.decode_items()
+
+    def decode_tuple(self):
+        return tuple(self.decode_items())
+
+    def decode_set(self):
+        return set(self.decode_items())
+
+    def decode_dict_items(self, target):
+        decode = self.decode
+        for _i in range(self.u32()):
+            k = decode()
+            target[k] = decode()
+        return target
+
+    def decode_dict(self):
+        return self.decode_dict_items({})
+
+    def decode_defaultdict(self):
+        name = self.decode()
+        try:
+            factory = FACTORIES[name]
+        except KeyError:
+            raise StatusFormatError(f"Unknown defaultdict factory: {name!r}")
+        return self.decode_dict_items(defaultdict(factory))
+
+    def decode_deque(self):
+        maxlen = self.decode()
+        return deque(self.decode(), maxlen)
+
+    def decode_object(self):
+        name = self.decode()
+        try:
+            cls, attributes = CLASSES[name]
+        except KeyError:
+            raise StatusFormatError(f"Unknown class: {name!r}")
+        value = cls.__new__(cls)
+        for attribute, v in zip(attributes, self.decode()):
+            setattr(value, attribute, v)
+        return value
+
+    def decode_table(self):
+        count = self.u32()
+        groups = [self.decode_group() for _i in range(self.u32())]
+        if len(groups) == 1:
+            return groups[0]
+        order = self.data[self.pos : self.pos + count]
+        self.pos += count
+        iterators = [iter(rows) for rows in groups]
+        return [next(iterators[i]) for i in order]
+
+    def decode_group(self):
+        keys = self.decode()
+        count = self.u32()
+        if not keys:
+            return [{} for _i in range(count)]
+        columns = [self.decode_column(count) for _key in keys]
+        return [dict(zip(keys, values)) for values in zip(*columns)]
+
+    def decode_column(self, count):
+        kind = self.data[self.pos]
+        self.pos += 1
+        if kind == COLUMN_INT:
+            values = struct.unpack_from(f'<{count}q', self.data, self.pos)
+            self.pos += 8 * count
+        elif kind == COLUMN_FLOAT:
+            values = struct.unpack_from(f'<{count}d', self.data, self.pos)
+            self.pos += 8 * count
+        elif kind == COLUMN_STR:
+            distinct = self.decode()
+            indexes = struct.unpack_from(f'<{count}I', self.data, self.pos)
+            self.pos += 4 * count
+            values = list(map(distinct.__getitem__, indexes))
+        elif kind == COLUMN_LISTS:
+            sizes = struct.unpack_from(f'<{count}I', self.data, self.pos)
+            self.pos += 4 * count
+            flat = iter(self.decode_column(self.u32()))
+            islice = itertools.islice
+            values = [list(islice(flat, size)) for size in sizes]
+        elif kind == COLUMN_DEFAULTDICTS:
+            name = self.decode()
+            try:
+                factory = FACTORIES[name]
+            except KeyError:
+                raise StatusFormatError(f"Unknown defaultdict factory: {name!r}")
+            sizes = struct.unpack_from(f'<{count}I', self.data, self.pos)
+            self.pos += 4 * count
+            total = self.u32()
+            pairs = zip(self.decode_column(total), self.decode_column(total))
+            if total == count and min(sizes, default=1) == 1:
+                # one item each, ie. upstream times of rows with one server
+                values = []
+                append = values.append
+                for k, v in pairs:
+                    value = defaultdict(factory)
+                    value[k] = v
+                    append(value)
+            else:
+                islice = itertools.islice
+                values = [defaultdict(factory, islice(pairs, size)) for size in sizes]
+        elif kind == COLUMN_VALUES:
+            values = self.decode()
+        else:
+            raise StatusFormatError(f"Invalid column {kind} at {self.pos - 1}")
+        return values
+
+
+@contextlib.contextmanager
+def gc_paused():
+    # collections triggered by allocation of many containers, while none of
+    # them can be garbage, would dominate decoding time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def dumps(value):
+    """Returns value encoded in status format, with header"""
+    encoder = Encoder()
+    with gc_paused():
+        encoder.encode(value)
+    return MAGIC + bytes((VERSION,)) + encoder.out
+
+
+def is_status_format(data):
+    return data[: len(MAGIC)] == MAGIC
+
+
+def loads(data):
+    """Returns value decoded from data returned by dumps()"""
+    if not is_status_format(data):
+        raise StatusFormatError("Not in status format")
+    version = data[len(MAGIC)]
+    if version != VERSION:
+        raise StatusFormatError(f"Unsupported status format version: {version}")
+    decoder = Decoder(data, len(MAGIC) + 1)
+    try:
+        with gc_paused():
+            value = decoder.decode()
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise StatusFormatError(f"Truncated or invalid status: {e}")
+    if decoder.pos != len(data):
+        raise StatusFormatError("Trailing data in status")
+    return value
+
+
+class StatusUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        try:
+            return PICKLE_GLOBALS[(module, name)]
+        except KeyError:
+            raise StatusFormatError(
+                f"Forbidden global in pickled status: {module}.{name}"
+            )
+
+
+def loads_pickle(data):
+    """Returns status pickled by previous versions, refusing other globals"""
+    try:
+        with gc_paused():
+            return StatusUnpickler(io.BytesIO(data)).load()
+    except StatusFormatError:
+        raise
+    except Exception as e:
+        raise StatusFormatError(f"Invalid pickled status: {e}")
@@ -0,0 +1,124 @@
+#
+# mbstats
+#
+# Tails a log and applies mbstats parser, then reports metrics to InfluxDB
+#
+# Usage:
+#
+# $ mbstats [options]
+#
+# Help:
+#
+# $ mbstats -h
+#
+#
+# Copyright 2016-2023, MetaBrainz Foundation
+# Author: Laurent Monin
+#
+# mbstats is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# mbstats is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Logster. If not, see <http://www.gnu.org/licenses/>.
+#
+# Include bits of code from Etsy Logster
+# https://github.com/etsy/logster
+#
+# Logster itself was forked from the ganglia-logtailer project
+# (http://bitbucket.org/maplebed/ganglia-logtailer):
+# Copyright Linden Research, Inc. 2008
+# Released under the GPL v2 or later.
+# For a full description of the license, please visit
+# http://www.gnu.org/licenses/gpl.txt
+#
+
+
+SATISFIED = 0
+TOLERATING = 1
+FRUSTRATED = 2
+
+# apdex: tolerating up to 4 times the threshold, frustrated above
+TOLERATING_FACTOR = 4.0
+
+
+def parse_thresholds(spec):
+    """Parses latency thresholds specification
+
+    spec is either a string like '0.5,example.org=0.3,example.org/ws=1.0' or
+    a dict like {'*': 0.5, 'example.org': 0.3, 'example.org/ws': 1.0} (from
+    json config). Keys are vhost or vhost/loctag, '*' or no key being the
+    default for all vhosts.
+
+    Returns a dict (vhost, loctag) -> threshold in seconds, None being a
+    wildcard.
+    """
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        items = list(spec.items())
+    else:
+        items = []
+        for item in str(spec).split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '=' in item:
+                key, value = item.rsplit('=', 1)
+            else:
+                key, value = '*', item
+            items.append((key.strip(), value))
+
+    rules = {}
+    for key, value in items:
+        threshold = float(value)
+        if threshold <= 0:
+            raise ValueError(f"Invalid latency threshold for {key}: {value}")
+        if key == '*':
+            rules[(None, None)] = threshold
+        elif '/' in key:
+            vhost, loctag = key.split('/', 1)
+            rules[(vhost, loctag)] = threshold
+        else:
+            rules[(key, None)] = threshold
+    return rules
+
+
+class LatencyThresholds:
+    """Resolves latency threshold per vhost/loctag, memoizing lookups"""
+
+    def __init__(self, spec):
+        self.rules = parse_thresholds(spec)
+        self._cache = {}
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def get(self, vhost, loctag):
+        key = (vhost, loctag)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        rules = self.rules
+        threshold = rules.get(key)
+        if threshold is None:
+            threshold = rules.get((vhost, None))
+            if threshold is None:
+                threshold = rules.get((None, None))
+        self._cache[key] = threshold
+        return threshold
+
+
+def classify(value, threshold):
+    if value <= threshold:
+        return SATISFIED
+    if value <= threshold * TOLERATING_FACTOR:
+        return TOLERATING
+    return FRUSTRATED
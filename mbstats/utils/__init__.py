@@ -38,11 +38,21 @@
 # For a full description of the license, please visit
 # http://www.gnu.org/licenses/gpl.txt
 #
+from collections import defaultdict
+import contextlib
 import datetime
 import inspect
+import itertools
 import json
 import math
-import pickle
+import time
+
+from mbstats.statusformat import (
+    dumps,
+    is_status_format,
+    loads,
+    loads_pickle,
+)
 
 # This provides a lineno() function to make it easy to grab the line
 # number that we're on (for logging)
@@ -55,9 +65,79 @@ def lineno():
     return inspect.currentframe().f_back.f_lineno
 
 
+class StageTimer:
+    """Accumulates durations (in seconds) and counters per processing stage
+
+    Stages can be nested, time accounted to a stage while another one is
+    measured is not accounted to the enclosing stage, so each second is
+    reported once.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counters = defaultdict(int)
+        # time accounted to nested stages, per measured stage
+        self._nested = []
+
+    def add(self, stage, duration):
+        self.durations[stage] += duration
+        if self._nested:
+            self._nested[-1] += duration
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def total(self):
+        return sum(self.durations.values())
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            # nested time may be estimated, see timed_iter()
+            self.durations[stage] += max(duration - self._nested.pop(), 0.0)
+            if self._nested:
+                self._nested[-1] += duration
+
+    def timed_iter(self, iterable, stage, every=64):
+        """Yields items from iterable, accounting time spent fetching them
+
+        Only 1 in every fetches is timed, standing for every fetches, so the
+        clock isn't read twice per item on the hot path.
+        """
+        iterator = iter(iterable)
+        perf_counter = time.perf_counter
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, perf_counter() - start)
+                return
+            self.add(stage, (perf_counter() - start) * every)
+            yield item
+            fetched = 1
+            for item in itertools.islice(iterator, every - 1):
+                fetched += 1
+                yield item
+            if fetched < every:
+                return
+
+    def fields(self, prefix='stage_'):
+        fields = {}
+        for stage, duration in self.durations.items():
+            fields[f'{prefix}{stage}_seconds'] = float(duration)
+        fields.update(self.counters)
+        return fields
+
+
 def save_obj(obj, filepath, logger=None):
     with open(filepath, 'wb') as f:
-        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        f.write(dumps(obj))
         if logger is not None:
             logger.debug(f"save_obj(): saved to {filepath!r}")
 
@@ -66,7 +146,13 @@ def load_obj(filepath, logger=None):
     with open(filepath, 'rb') as f:
         if logger is not None:
             logger.debug(f"load_obj(): loading from {filepath!r}")
-        return pickle.load(f)
+        data = f.read()
+    if is_status_format(data):
+        return loads(data)
+    # saved by a previous version, next save converts it
+    if logger is not None:
+        logger.info(f"load_obj(): loading pickle from {filepath!r}")
+    return loads_pickle(data)
 
 
 def timestamp_RFC3339(timestamp):
@@ -81,6 +167,22 @@ def msec2bucket(msec, bucket_duration):
     return int(math.ceil(float(msec) / float(bucket_duration)))
 
 
+def parse_rollups(rollups, bucket_duration):
+    """Converts '300,3600' to [300, 3600], checking against bucket duration"""
+    if not rollups:
+        return []
+    durations = []
+    for item in str(rollups).split(','):
+        duration = int(item)
+        if duration <= bucket_duration or duration % bucket_duration:
+            raise ValueError(
+                f"Rollup duration {duration} is not a multiple of bucket duration"
+                f" {bucket_duration}"
+            )
+        durations.append(duration)
+    return durations
+
+
 def _read_config(conf_path):
     with open(conf_path) as f:
         return json.load(f)
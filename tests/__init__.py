@@ -1,5 +1,44 @@
+from enum import IntEnum
 import unittest
 
+from mbstats.app import get_default_status
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    compile_format,
+    parse_format,
+)
+
+# https://github.com/metabrainz/openresty-gateways/blob/master/files/nginx/nginx.conf#L23
+# positions of fields in default log format
+PosField = IntEnum('PosField', {'version': 0, **parse_format(DEFAULT_FORMAT)[1]})
+
+# parser for default log format
+parseline = compile_format(DEFAULT_FORMAT)
+
+SAMPLE_LINE = '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026|10.2.2.31:65412|200|0.024|0.000|0.024'
+
+
+def sample_line(n, replace_with='xxx', line=SAMPLE_LINE):
+    """Return line with field at position n replaced"""
+    parts = line.split('|')
+    parts[n] = replace_with
+    return '|'.join(parts)
+
+
+class ListTailer(list):
+    """Lines to parse, used in place of Pygtail"""
+
+    def update_offset_file(self):
+        pass
+
+
+def default_status(bucket_duration=60, lookback_factor=2, **values):
+    """Return a new status, as initialized by init_status(), updated with values"""
+    status = get_default_status(bucket_duration, lookback_factor, 30)
+    status = {k: v() for k, v in status.items()}
+    status.update(values)
+    return status
+
 
 def get_suite():
     "Return a unittest.TestSuite."
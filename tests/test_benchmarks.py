@@ -0,0 +1,63 @@
+import unittest
+
+from benchmarks.bench import (
+    STAGES,
+    compare,
+    run,
+)
+from benchmarks.loggen import (
+    LogGenerator,
+    parse_status_mix,
+)
+
+from tests import parseline
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_parse_status_mix(self):
+        self.assertEqual(parse_status_mix('200:90,404:10'), ([200, 404], [90.0, 10.0]))
+
+    def test_generated_lines_parse(self):
+        generator = LogGenerator(
+            vhosts=3,
+            chain_length=3,
+            redirect_rate=0.5,
+            out_of_order_rate=0.1,
+            status_mix='200:1,502:1',
+        )
+        vhosts = set()
+        redirects = 0
+        for line in generator.lines(500):
+            row, _last_msec, _bucket = parseline(line, bucket_duration=60)
+            vhosts.add(row['vhost'])
+            self.assertIn(row['status'], (200, 502))
+            if 'upstreams' in row:
+                self.assertLessEqual(row['upstreams']['servers_contacted'], 3)
+                redirects += row['upstreams']['internal_redirects']
+        self.assertEqual(len(vhosts), 3)
+        self.assertGreater(redirects, 0)
+
+    def test_generator_is_reproducible(self):
+        lines1 = list(LogGenerator(seed=42).lines(10))
+        lines2 = list(LogGenerator(seed=42).lines(10))
+        self.assertEqual(lines1, lines2)
+
+    def test_run_and_compare(self):
+        lines = list(LogGenerator().lines(200))
+        results = run(lines, repeat=1, allocations=False)
+        self.assertEqual(tuple(results), STAGES)
+        for result in results.values():
+            self.assertGreater(result['lines_per_second'], 0)
+
+        self.assertEqual(compare(results, results, 0.1), [])
+        baseline = {
+            'parseline': {
+                'lines_per_second': results['parseline']['lines_per_second'] * 2
+            }
+        }
+        regressions = compare(results, baseline, 0.1)
+        self.assertEqual([r[0] for r in regressions], ['parseline'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import pickle
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    process_bucket,
+)
+from mbstats.cardinality import (
+    OTHER,
+    HeavyHitters,
+    get_limiters,
+    limiters_stats,
+    parse_limits,
+)
+
+from tests import (
+    PosField,
+    default_status,
+    parseline,
+)
+
+
+class TestCardinality(unittest.TestCase):
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(''), {})
+        self.assertEqual(
+            parse_limits('vhost=10, upstream=5'), {'vhost': 10, 'upstream': 5}
+        )
+        self.assertEqual(parse_limits({'loctag': '3'}), {'loctag': 3})
+        for spec in ('host=10', 'vhost=0', 'vhost', 'vhost=x'):
+            with self.assertRaises(ValueError, msg=spec):
+                parse_limits(spec)
+
+    def test_heavy_hitters(self):
+        hh = HeavyHitters(2, capacity=10)
+        self.assertEqual(hh('a'), 'a')
+        self.assertEqual(hh('b'), 'b')
+        self.assertEqual(hh('c'), OTHER)
+        self.assertEqual(hh.overflow, 1)
+
+        # c becomes a heavy hitter, random values are folded into other
+        for i in range(100):
+            hh('c')
+            hh(f'random{i}')
+        for _i in range(5):
+            hh('a')
+        self.assertLessEqual(len(hh.counts), 10)
+        self.assertEqual(hh.top(2), ['c', 'a'])
+
+        hh.start_loop()
+        self.assertEqual(hh.allowed, {'c', 'a'})
+        self.assertEqual(hh.overflow, 0)
+        self.assertEqual(hh('c'), 'c')
+        self.assertEqual(hh('b'), OTHER)
+
+        restored = pickle.loads(pickle.dumps(hh))
+        self.assertEqual(restored.top(), hh.top())
+
+    def test_heavy_hitters_weights(self):
+        hh = HeavyHitters(1, capacity=10)
+        hh('a')
+        hh('b', weight=4)
+        self.assertEqual(hh.top(), ['b', 'a'])
+        self.assertEqual(hh.overflow, 4)
+
+    def test_heavy_hitters_buckets(self):
+        hh = HeavyHitters(1, capacity=10)
+        self.assertEqual(hh('a', 1), 'a')
+        self.assertEqual(hh('b', 1), OTHER)
+        # b becomes the top value, but bucket 1 still folds it
+        for _i in range(10):
+            hh('b', 2)
+        hh.start_loop(keep_from=1)
+        self.assertEqual(hh('b', 1), OTHER)
+        self.assertEqual(hh('a', 1), 'a')
+        self.assertEqual(hh('b', 3), 'b')
+        self.assertEqual(hh('a', 3), OTHER)
+        hh.start_loop(keep_from=2)
+        self.assertNotIn(1, hh.admitted)
+
+    def test_process_bucket_limits(self):
+        saved = {}
+        limiters = get_limiters(saved, parse_limits('vhost=2,upstream=1'))
+        self.assertIs(limiters, saved)
+        storage = get_storage()
+        mbs = mbsdict()
+        status = default_status()
+        sample_line = '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026|10.2.2.31:65412, 10.2.2.32:65412|200, 200|0.024, 0.024|0.000, 0.000|0.024, 0.024'
+        for vhost in ('a', 'b', 'c', 'd', 'a'):
+            parts = sample_line.split('|')
+            parts[PosField.vhost] = vhost
+            row, last_msec, bucket = parseline('|'.join(parts), bucket_duration=60)
+            storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs, limiters=limiters)
+
+        vhosts = {key[1] for key in mbs['hits']}
+        self.assertEqual(len(vhosts), 3)
+        self.assertIn(OTHER, vhosts)
+        self.assertEqual(sum(mbs['hits'].values()), 5)
+        upstreams = {key[4] for key in mbs['upstreams_hits']}
+        self.assertEqual(len(upstreams), 2)
+        self.assertIn(OTHER, upstreams)
+        self.assertEqual(sum(mbs['upstreams_hits'].values()), 10)
+
+        stats = limiters_stats(limiters)
+        self.assertEqual(stats['cardinality_overflow_vhost'], 2)
+        self.assertEqual(stats['cardinality_overflow_upstream'], 5)
+        self.assertEqual(stats['cardinality_tracked_vhost'], 4)
+
+        # limits removed from options are dropped
+        get_limiters(saved, parse_limits('vhost=2'))
+        self.assertEqual(list(saved), ['vhost'])
+
+
+if __name__ == '__main__':
+    unittest.main()
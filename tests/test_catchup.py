@@ -0,0 +1,123 @@
+import itertools
+import os.path
+import tempfile
+import unittest
+
+from mbstats.app import parsefile
+from mbstats.catchup import MmapTailer
+from mbstats.cmdline_options import parse_options
+from mbstats.idle import read_offset
+from mbstats.utils import StageTimer
+from pygtail import Pygtail
+
+from tests import (
+    PosField,
+    default_status,
+    sample_line,
+)
+
+
+class TestCatchup(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.logfile = os.path.join(self.test_dir.name, 'nginx.log')
+        self.offset_file = self.logfile + '.offset'
+        # some lines are longer than the chunk size used below
+        self.lines = [f'1|{i}|' + 'x' * (i % 150) + '\n' for i in range(200)]
+        with open(self.logfile, 'w') as f:
+            f.write(''.join(self.lines) + '1|incomplete')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_lines(self):
+        tailer = MmapTailer(self.logfile, 0, self.offset_file, chunk_size=100)
+        self.assertEqual(list(tailer), self.lines)
+        tailer.update_offset_file()
+        inode, offset = read_offset(self.offset_file)
+        self.assertEqual(inode, os.stat(self.logfile).st_ino)
+        # incomplete last line is left for next loop
+        self.assertEqual(offset, os.path.getsize(self.logfile) - len('1|incomplete'))
+
+    def test_resume(self):
+        tailer = MmapTailer(self.logfile, 0, self.offset_file, chunk_size=1000)
+        lines = list(itertools.islice(tailer, 42))
+        tailer.update_offset_file()
+        self.assertEqual(lines, self.lines[:42])
+
+        _inode, offset = read_offset(self.offset_file)
+        tailer = MmapTailer(self.logfile, offset, self.offset_file, chunk_size=1000)
+        self.assertEqual(list(itertools.islice(tailer, 10)), self.lines[42:52])
+        tailer.update_offset_file()
+
+        # offset file can be used by Pygtail
+        pygtail = Pygtail(self.logfile, offset_file=self.offset_file)
+        self.assertEqual(next(pygtail), self.lines[52])
+
+    def test_truncated(self):
+        tailer = MmapTailer(self.logfile, 10**9, self.offset_file)
+        self.assertEqual(list(tailer), self.lines)
+
+    def test_nothing_pending(self):
+        size = os.path.getsize(self.logfile)
+        tailer = MmapTailer(self.logfile, size, self.offset_file)
+        self.assertEqual(list(tailer), [])
+        tailer.update_offset_file()
+        self.assertEqual(read_offset(self.offset_file)[1], size)
+
+    def test_invalid_utf8(self):
+        with open(self.logfile, 'wb') as f:
+            f.write(b'1|\xff|a\n1|\xc3\xa9|b\n')
+        tailer = MmapTailer(self.logfile, 0, self.offset_file)
+        self.assertEqual(next(iter(tailer)), '1|�|a\n')
+        tailer.update_offset_file()
+        self.assertEqual(read_offset(self.offset_file)[1], 6)
+
+    def test_parsefile(self):
+        start = 1568962800.0
+        with open(self.logfile, 'w') as f:
+            for second in range(0, 200, 10):
+                f.write(sample_line(PosField.msec, str(start + second)) + '\n')
+
+        def parse(tailer, args=()):
+            status = default_status()
+            options = parse_options(['-f', self.logfile] + list(args))
+            timer = StageTimer()
+            mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+                tailer, status, options, timer=timer
+            )
+            return mbs, parsed_lines, timer.counters['read_bytes']
+
+        def tailers():
+            pygtail_offset = os.path.join(self.test_dir.name, 'pygtail.offset')
+            mmap_offset = os.path.join(self.test_dir.name, 'mmap.offset')
+            for path in (pygtail_offset, mmap_offset):
+                if os.path.exists(path):
+                    os.remove(path)
+            return (
+                (Pygtail(self.logfile, offset_file=pygtail_offset), pygtail_offset),
+                (
+                    MmapTailer(self.logfile, 0, mmap_offset, chunk_size=1000),
+                    mmap_offset,
+                ),
+            )
+
+        # both readers account the same bytes
+        (pygtail, _), (mmap_tailer, _) = tailers()
+        mbs, parsed_lines, read_bytes = parse(pygtail)
+        mmap_mbs, mmap_parsed_lines, mmap_read_bytes = parse(mmap_tailer)
+        self.assertEqual(parsed_lines, 20)
+        self.assertEqual(mmap_parsed_lines, parsed_lines)
+        self.assertEqual(mmap_read_bytes, read_bytes)
+        self.assertEqual(read_bytes, os.path.getsize(self.logfile))
+        self.assertEqual(dict(mmap_mbs['hits']), dict(mbs['hits']))
+
+        # so bytes budget stops both at the same line
+        (pygtail, pygtail_offset), (mmap_tailer, mmap_offset) = tailers()
+        args = ['--max-bytes', '1000']
+        self.assertEqual(parse(pygtail, args)[1:], parse(mmap_tailer, args)[1:])
+        self.assertEqual(read_offset(mmap_offset), read_offset(pygtail_offset))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import contextlib
+import io
+import unittest
+
+from mbstats.cmdline_options import parse_options
+
+
+class TestCmdlineOptions(unittest.TestCase):
+    def assertInvalid(self, args, message):
+        with io.StringIO() as buf:
+            with contextlib.redirect_stderr(buf):
+                with self.assertRaises(SystemExit, msg=args):
+                    parse_options(['-f', 'nginx.log'] + args)
+            self.assertIn(message, buf.getvalue())
+
+    def test_percentiles_accuracy(self):
+        options = parse_options(['-f', 'nginx.log'])
+        self.assertEqual(options.percentiles_accuracy, 0.01)
+        options = parse_options(['-f', 'nginx.log', '--percentiles-accuracy', '0.5'])
+        self.assertEqual(options.percentiles_accuracy, 0.5)
+        for value in ('0', '1', '-0.01', '1.5'):
+            self.assertInvalid(
+                ['--percentiles-accuracy', value], '--percentiles-accuracy: must be'
+            )
+
+    def test_tracemalloc_interval(self):
+        options = parse_options(['-f', 'nginx.log'])
+        self.assertEqual(options.tracemalloc_interval, 600.0)
+        self.assertInvalid(
+            ['--tracemalloc-interval', '-1'], '--tracemalloc-interval: must be'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+from argparse import Namespace
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    mbspostprocess,
+    process_bucket,
+)
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.dimensions import (
+    Dimensions,
+    parse_dimensions,
+)
+
+from tests import (
+    PosField,
+    default_status,
+    parseline,
+)
+
+SAMPLE_LINE = '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026|10.2.2.31:65412, 10.2.2.32:65412|200, 502|0.024, 0.048|0.000, 0.000|0.024, 0.024'
+
+
+class TestDimensions(unittest.TestCase):
+    def test_parse_dimensions(self):
+        self.assertEqual(parse_dimensions(''), {})
+        self.assertEqual(
+            parse_dimensions('protocol, upstream:upstreams_hits+upstreams_status'),
+            {'protocol': (), 'upstream': ('upstreams_hits', 'upstreams_status')},
+        )
+        for spec in ('host', 'protocol:hits', 'upstream:hits', 'status:upstreams_hits'):
+            with self.assertRaises(ValueError, msg=spec):
+                parse_dimensions(spec)
+
+    def test_dimensions(self):
+        self.assertFalse(Dimensions(''))
+        dimensions = Dimensions('loctag,upstream:upstreams_hits,status')
+        self.assertEqual(dimensions.common, ('loctag',))
+        self.assertTrue(dimensions.upstream['upstreams_hits'])
+        self.assertFalse(dimensions.upstream['upstreams_response_time_mean'])
+        self.assertEqual(
+            dimensions.status, {'status': False, 'upstreams_status': False}
+        )
+
+    def test_process_bucket_dimensions(self):
+        storage = get_storage()
+        mbs = mbsdict()
+        status = default_status()
+        for protocol in ('s', '-'):
+            parts = SAMPLE_LINE.split('|')
+            parts[PosField.protocol] = protocol
+            row, last_msec, bucket = parseline('|'.join(parts), bucket_duration=60)
+            storage[bucket].append(row)
+        dimensions = Dimensions('protocol,upstream:upstreams_hits+upstreams_status')
+        process_bucket(bucket, storage, status, mbs, dimensions=dimensions)
+        mbspostprocess(mbs)
+
+        key = (bucket, 'musicbrainz.org', None, 'ws')
+        self.assertEqual(dict(mbs['hits']), {key: 2})
+        self.assertEqual(dict(mbs['status']), {key + (200,): 2})
+        self.assertEqual(
+            dict(mbs['upstreams_hits']),
+            {key + ('10.2.2.31:65412',): 2, key + ('10.2.2.32:65412',): 2},
+        )
+        self.assertEqual(mbs['upstreams_status'][key + ('10.2.2.32:65412', '502')], 2)
+        # upstreams are aggregated for other measurements
+        self.assertEqual(list(mbs['upstreams_response_time_mean']), [key + (None,)])
+        self.assertAlmostEqual(
+            mbs['upstreams_response_time_mean'][key + (None,)], 0.036
+        )
+
+        backend = InfluxBackend(Namespace(dry_run=True))
+        backend.add_points(mbs, {'bucket_duration': 60})
+        tags = {
+            point['measurement']: point['tags']
+            for point in backend.points
+            if point['measurement']
+            in ('hits', 'upstreams_response_time_mean', 'upstreams_hits')
+        }
+        self.assertEqual(tags['hits'], {'vhost': 'musicbrainz.org', 'loctag': 'ws'})
+        self.assertEqual(
+            tags['upstreams_response_time_mean'],
+            {'vhost': 'musicbrainz.org', 'loctag': 'ws'},
+        )
+        self.assertIn('upstream', tags['upstreams_hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+from argparse import Namespace
+import unittest
+
+from benchmarks import e2e
+from benchmarks.fakeinflux import FakeInfluxServer
+from benchmarks.loggen import LogGenerator
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.influxdb1x import (
+    InfluxDBClient,
+    InfluxDBClientError,
+    InfluxDBServerError,
+)
+
+
+def influx_options(port):
+    return Namespace(
+        influx_host='127.0.0.1',
+        influx_port=port,
+        influx_username='root',
+        influx_password='root',
+        influx_database='mbstats_test',
+        influx_timeout=10,
+        influx_batch_size=2,
+        influx_drop_database=True,
+        dry_run=False,
+        quiet=0,
+    )
+
+
+POINTS = [
+    {
+        'measurement': 'hits',
+        'tags': {'vhost': 'example.org'},
+        'time': '2019-09-20T06:56:00+00:00',
+        'fields': {'value': i},
+    }
+    for i in range(5)
+]
+
+
+class TestFakeInflux(unittest.TestCase):
+    def test_write_points(self):
+        with FakeInfluxServer(keep_lines=True) as server:
+            backend = InfluxBackend(influx_options(server.port))
+            self.assertIn('mbstats_test', server.databases)
+            self.assertTrue(backend.send_points(tags={'host': 'h'}, points=POINTS))
+            stats = server.stats.as_dict()
+            backend.client.close()
+
+        self.assertEqual(stats['points'], 5)
+        self.assertEqual(stats['write_requests'], 3)
+        self.assertEqual(stats['bytes_received'], backend.client.bytes_sent)
+        self.assertEqual(backend.client.write_requests, 3)
+        self.assertTrue(server.lines[0].startswith(b'hits,host=h,vhost=example.org '))
+
+    def test_unknown_database(self):
+        with FakeInfluxServer() as server:
+            client = InfluxDBClient(port=server.port, database='unknown')
+            with self.assertRaises(InfluxDBClientError) as cm:
+                client.write_points(POINTS)
+            client.close()
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_error_injection(self):
+        with FakeInfluxServer(error_rate=1.0) as server:
+            backend = InfluxBackend(influx_options(server.port))
+            with self.assertRaises(InfluxDBServerError):
+                backend.send_points(points=POINTS)
+            backend.client.close()
+        self.assertEqual(server.stats.errors, 1)
+
+    def test_partial_write(self):
+        with FakeInfluxServer(partial_write_rate=1.0) as server:
+            backend = InfluxBackend(influx_options(server.port))
+            with self.assertRaisesRegex(InfluxDBClientError, 'partial write'):
+                backend.send_points(points=POINTS, batch_size=0)
+            backend.client.close()
+        self.assertEqual(server.stats.points, 4)
+        self.assertEqual(server.stats.dropped_points, 1)
+
+    def test_e2e(self):
+        results = e2e.run(LogGenerator(rate=10.0), lines=2000, max_lines=1000)
+        self.assertEqual(results['loops'], 2)
+        self.assertEqual(results['own_stats']['parsed_lines'], 2000)
+        self.assertGreater(results['points'], 0)
+        self.assertEqual(results['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
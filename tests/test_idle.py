@@ -0,0 +1,110 @@
+import logging
+import os.path
+import tempfile
+import time
+import unittest
+
+from mbstats.app import main_loop
+from mbstats.cmdline_options import parse_options
+from mbstats.idle import IdleCheck
+from mbstats.safefile import SafeFile
+from mbstats.utils import load_obj
+
+from tests import (
+    SAMPLE_LINE,
+    PosField,
+    sample_line,
+)
+
+LINES = 10
+
+
+class TestIdle(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.logfile = os.path.join(self.test_dir.name, 'nginx.log')
+        start = 1568962800.0
+        with open(self.logfile, 'w') as f:
+            for second in range(LINES):
+                f.write(sample_line(PosField.msec, str(start + second)) + '\n')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_unchanged(self):
+        offset_file = os.path.join(self.test_dir.name, 'nginx.log.offset')
+        idle = IdleCheck(self.logfile, offset_file)
+        self.assertFalse(idle.unchanged())
+        with open(offset_file, 'w') as f:
+            f.write('%d\n%d\n' % (os.stat(self.logfile).st_ino, 42))
+        # previous loop left pending work
+        idle.backend = object()
+        self.assertFalse(idle.unchanged())
+        idle.clean = True
+        self.assertFalse(idle.unchanged())
+        size = os.path.getsize(self.logfile)
+        with open(offset_file, 'w') as f:
+            f.write('%d\n%d\n' % (os.stat(self.logfile).st_ino, size))
+        self.assertTrue(idle.unchanged())
+
+    def test_flush_due(self):
+        idle = IdleCheck(self.logfile, None)
+        self.assertFalse(idle.flush_due(time.time()))
+        # oldest bucket with rows is 10, it can be flushed once a line of
+        # bucket 11 would have been parsed
+        idle.set_leftover({9: [], 10: [{}], 12: [{}]}, 60, 2)
+        self.assertEqual(idle.flush_at, 11 * 60)
+        self.assertFalse(idle.flush_due(11 * 60))
+        self.assertTrue(idle.flush_due(11 * 60 + 1))
+        idle.set_leftover({10: []}, 60, 2)
+        self.assertIsNone(idle.flush_at)
+
+    def test_main_loop(self):
+        workdir = self.test_dir.name
+        options = parse_options(
+            ['-f', self.logfile, '-w', workdir, '--do-not-skip-to-end', '--dry-run']
+        )
+        logger = logging.getLogger('test_idle_loop')
+        offset_file = SafeFile(workdir, self.logfile, suffix='.offset')
+        status_file = SafeFile(workdir, self.logfile, suffix='.status')
+        idle = IdleCheck(self.logfile, offset_file.main)
+
+        fields = main_loop(options, logger, first_loop=True, idle=idle)
+        self.assertEqual(fields['parsed_lines'], LINES)
+        self.assertEqual(fields['idle'], 0)
+        self.assertTrue(idle.clean)
+        self.assertTrue(load_obj(status_file.main)['leftover'])
+        self.assertTrue(idle.flush_due(time.time()))
+
+        # nothing was written to the log file, but lookback window of
+        # leftover buckets passed, they are flushed
+        fields = main_loop(options, logger, idle=idle)
+        self.assertEqual(fields['idle'], 0)
+        self.assertEqual(fields['parsed_lines'], 0)
+        self.assertGreater(fields['sent_points'], 0)
+        status = load_obj(status_file.main)
+        self.assertFalse(status['leftover'])
+        self.assertGreater(status['last_msec'], time.time() - 60)
+        self.assertIsNone(idle.flush_at)
+
+        # status isn't loaded nor saved anymore
+        mtime = os.stat(status_file.main).st_mtime_ns
+        previous = fields
+        fields = main_loop(options, logger, idle=idle)
+        self.assertEqual(fields['idle'], 1)
+        self.assertEqual(fields['parsed_lines'], 0)
+        self.assertEqual(os.stat(status_file.main).st_mtime_ns, mtime)
+        # same fields as a full loop, so series are continuous
+        self.assertEqual(set(fields), set(previous))
+        self.assertEqual(fields['stage_read_seconds'], 0.0)
+        self.assertEqual(fields['lookback_factor'], previous['lookback_factor'])
+
+        with open(self.logfile, 'a') as f:
+            f.write(SAMPLE_LINE + '\n')
+        fields = main_loop(options, logger, idle=idle)
+        self.assertEqual(fields['idle'], 0)
+        self.assertEqual(fields['parsed_lines'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
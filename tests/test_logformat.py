@@ -0,0 +1,244 @@
+import gzip
+import io
+import os.path
+import unittest
+
+from mbstats.app import (
+    ParseLate,
+    ParseSkip,
+)
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    ParseFiltered,
+    compile_format,
+    custom_measurements,
+    parse_filters,
+    parse_format,
+)
+from mbstats.normalize import parse_normalize
+
+SAMPLE_LINE = (
+    '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026'
+    '|10.2.2.31:65412|200|0.024|0.000|0.024\n'
+)
+
+
+class TestLogFormat(unittest.TestCase):
+    def test_parse_format(self):
+        version, positions = parse_format(DEFAULT_FORMAT)
+        self.assertEqual(version, '1')
+        self.assertEqual(positions['msec'], 1)
+        self.assertEqual(positions['upstream_header_time'], 14)
+
+        # mbstats field names can be used too, unknown variables are ignored
+        version, positions = parse_format(
+            '2|$ssl_protocol|$vhost|$msec|$statproto|$loctag|$status|$bytes_sent'
+        )
+        self.assertEqual(version, '2')
+        self.assertEqual(
+            positions,
+            {
+                'vhost': 2,
+                'msec': 3,
+                'protocol': 4,
+                'loctag': 5,
+                'status': 6,
+                'bytes_sent': 7,
+            },
+        )
+
+    def test_parse_format_invalid(self):
+        invalid = (
+            ('$msec|$host', "has to start with a version"),
+            ('1|msec', "invalid log format item: msec"),
+            ('1|$msec|$host|$statproto|$loctag|$status', "missing field.*bytes_sent"),
+            (DEFAULT_FORMAT + '|$host', "duplicated field"),
+            (DEFAULT_FORMAT.replace('|$upstream_status', ''), "all or none"),
+        )
+        for spec, message in invalid:
+            with self.assertRaisesRegex(ValueError, message):
+                parse_format(spec)
+
+    def test_default_format(self):
+        parse = compile_format(DEFAULT_FORMAT)
+        self.assertEqual(parse.msec_index, 1)
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        logfile = os.path.join(this_dir, 'data', 'test1.log.gz')
+        with io.TextIOWrapper(io.BufferedReader(gzip.open(logfile))) as f:
+            rows = [parse(line, bucket_duration=60)[0] for line in f]
+        self.assertTrue(rows)
+        for row in rows:
+            self.assertIn('request_length', row)
+            self.assertNotIn('upstream_header_time', row['upstreams'])
+
+    def test_custom_format(self):
+        parse = compile_format(
+            '2|$msec|$ssl_protocol|$host|$statproto|$loctag|$status|$bytes_sent'
+            '|$request_time'
+        )
+        row, last_msec, bucket = parse(
+            '2|1568962563.374|TLSv1.3|musicbrainz.org|s|ws|200|2799|0.026\n',
+            bucket_duration=60,
+        )
+        self.assertEqual(
+            row,
+            {
+                'vhost': 'musicbrainz.org',
+                'protocol': 's',
+                'loctag': 'ws',
+                'status': 200,
+                'bytes_sent': 2799,
+                'request_time': 0.026,
+            },
+        )
+        self.assertEqual(last_msec, 1568962563.374)
+        with self.assertRaisesRegex(ParseSkip, "invalid log version: 1") as cm:
+            parse(SAMPLE_LINE)
+        self.assertEqual(cm.exception.reason, 'version')
+        with self.assertRaises(ParseLate):
+            parse(SAMPLE_LINE.replace('1|', '2|', 1), ignore_before=1568962564)
+
+    def test_declared_fields(self):
+        custom = []
+        version, positions = parse_format(
+            '2|$msec|$host|$statproto|$loctag|$status|$bytes_sent'
+            '|$upstream_bytes_received:int:sum|$ssl_handshake_time:float:mean',
+            custom=custom,
+        )
+        self.assertEqual(positions['upstream_bytes_received'], 7)
+        self.assertEqual(positions['ssl_handshake_time'], 8)
+        self.assertEqual(
+            custom,
+            [
+                ('upstream_bytes_received', 'int', 'sum'),
+                ('ssl_handshake_time', 'float', 'mean'),
+            ],
+        )
+        additive, means = custom_measurements(custom)
+        self.assertEqual(
+            additive,
+            (
+                ('upstream_bytes_received_sum', int),
+                ('_ssl_handshake_time_premean', float),
+                ('_ssl_handshake_time_count', int),
+            ),
+        )
+        self.assertEqual(
+            means,
+            {
+                'ssl_handshake_time_mean': (
+                    '_ssl_handshake_time_premean',
+                    '_ssl_handshake_time_count',
+                )
+            },
+        )
+
+        parse = compile_format(
+            '2|$msec|$host|$statproto|$loctag|$status|$bytes_sent'
+            '|$upstream_bytes_received:int:sum|$ssl_handshake_time:float:mean'
+        )
+        self.assertEqual(parse.custom, tuple(custom))
+        row, last_msec, bucket = parse(
+            '2|1568962563.374|musicbrainz.org|s|ws|200|2799|12, 3 : 4|0.250\n',
+            bucket_duration=60,
+        )
+        # values of each upstream are summed
+        self.assertEqual(row['upstream_bytes_received'], 19)
+        self.assertEqual(row['ssl_handshake_time'], 0.25)
+        row, last_msec, bucket = parse(
+            '2|1568962563.374|musicbrainz.org|s|ws|200|2799|-|-\n',
+            bucket_duration=60,
+        )
+        self.assertNotIn('upstream_bytes_received', row)
+        self.assertNotIn('ssl_handshake_time', row)
+
+    def test_declared_fields_invalid(self):
+        invalid = (
+            ('$upstream_bytes_received:int', "invalid field declaration"),
+            ('$Upstream:int:sum', "invalid field name"),
+            ('$request_time:float:mean', "known to mbstats"),
+            ('$sampling:int:sum', "reserved field name"),
+            ('$upstreams_bytes:int:sum', "reserved field name"),
+            ('$upstream_bytes_received:str:sum', "invalid field type"),
+            ('$upstream_bytes_received:int:max', "invalid field aggregation"),
+        )
+        for item, message in invalid:
+            with self.assertRaisesRegex(ValueError, message):
+                parse_format(DEFAULT_FORMAT + '|' + item)
+
+    def test_groups(self):
+        parse = compile_format(DEFAULT_FORMAT, groups=('request_time',))
+        row, last_msec, bucket = parse(SAMPLE_LINE)
+        self.assertEqual(
+            row,
+            {
+                'vhost': 'musicbrainz.org',
+                'protocol': 's',
+                'loctag': 'ws',
+                'status': 200,
+                'bytes_sent': 2799,
+                'request_time': 0.026,
+            },
+        )
+        self.assertNotIn('upstream', parse.source)
+        # fields of disabled groups aren't even converted
+        parse(SAMPLE_LINE.replace('|289|', '|xxx|'))
+
+    def test_parse_filters(self):
+        self.assertEqual(parse_filters(''), ())
+        self.assertEqual(
+            parse_filters('vhost=a.org, status=444,vhost=*.b.org'),
+            (('status', ('444',)), ('vhost', ('a.org', '*.b.org'))),
+        )
+        for spec in ('vhost', 'vhost=', 'upstream=x'):
+            with self.assertRaises(ValueError):
+                parse_filters(spec)
+
+    def test_filters(self):
+        parse = compile_format(
+            DEFAULT_FORMAT,
+            include=parse_filters('vhost=*.org,loctag=ws,loctag=api'),
+            exclude=parse_filters('vhost=health.org,status=444'),
+        )
+        row, last_msec, bucket = parse(SAMPLE_LINE)
+        self.assertEqual(row['vhost'], 'musicbrainz.org')
+        filtered = (
+            ('|musicbrainz.org|', '|musicbrainz.net|', 'vhost not included'),
+            ('|ws|', '|-|', 'loctag not included'),
+            ('|musicbrainz.org|', '|health.org|', 'vhost excluded'),
+            ('|200|2799|', '|444|2799|', 'status excluded'),
+        )
+        for old, new, message in filtered:
+            with self.assertRaisesRegex(ParseFiltered, message) as cm:
+                parse(SAMPLE_LINE.replace(old, new))
+            self.assertEqual(cm.exception.reason, 'filtered')
+        # filters are applied before any conversion
+        with self.assertRaises(ParseFiltered):
+            parse(
+                SAMPLE_LINE.replace('|musicbrainz.org|', '|x|').replace('|289|', '|x|')
+            )
+
+    def test_normalize(self):
+        parse = compile_format(
+            DEFAULT_FORMAT,
+            include=parse_filters('vhost=WWW.musicbrainz.org'),
+            normalize=parse_normalize(
+                ['vhost:lower', r'vhost:s/^www\.//', 'upstream:10.2.2.0/24=web']
+            ),
+            normalize_cache_size=2,
+        )
+        line = SAMPLE_LINE.replace('|musicbrainz.org|', '|WWW.musicbrainz.org|')
+        # filters use raw values
+        row, last_msec, bucket = parse(line)
+        self.assertEqual(row['vhost'], 'musicbrainz.org')
+        self.assertEqual(row['loctag'], 'ws')
+        # upstream addresses are normalized when aggregated
+        self.assertEqual(row['upstreams']['servers'], ['10.2.2.31:65412'])
+        self.assertEqual(parse.normalize_upstream('10.2.2.31:65412'), 'web')
+        self.assertIn('normalize_vhost(', parse.source)
+        self.assertNotIn('normalize_loctag(', parse.source)
+        self.assertIsNone(compile_format(DEFAULT_FORMAT).normalize_upstream)
+
+
+if __name__ == '__main__':
+    unittest.main()
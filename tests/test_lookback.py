@@ -0,0 +1,79 @@
+import unittest
+
+from mbstats.app import parsefile
+from mbstats.cmdline_options import parse_options
+from mbstats.lookback import (
+    adapt_lookback,
+    decay_lateness,
+)
+
+from tests import (
+    ListTailer,
+    PosField,
+    default_status,
+    sample_line,
+)
+
+
+class TestLookback(unittest.TestCase):
+    def test_adapt_lookback(self):
+        # 99% of lines are in newest bucket or one bucket behind
+        lateness = {0: 900, 1: 90, 3: 10}
+        self.assertEqual(adapt_lookback(lateness, 90, 1, 5), 1)
+        self.assertEqual(adapt_lookback(lateness, 99, 1, 5), 2)
+        self.assertEqual(adapt_lookback(lateness, 99.9, 1, 5), 4)
+        self.assertEqual(adapt_lookback(lateness, 99.9, 1, 3), 3)
+
+    def test_adapt_lookback_decrease(self):
+        lateness = {0: 1000}
+        # lowered one bucket per loop
+        self.assertEqual(adapt_lookback(lateness, 99, 4, 5), 3)
+        self.assertEqual(adapt_lookback(lateness, 99, 2, 5), 1)
+        # but never above maximum
+        self.assertEqual(adapt_lookback(lateness, 99, 4, 2), 2)
+
+    def test_adapt_lookback_no_lines(self):
+        self.assertEqual(adapt_lookback({}, 99, 3, 5), 3)
+        self.assertEqual(adapt_lookback({}, 99, 3, 2), 2)
+
+    def test_decay_lateness(self):
+        lateness = {0: 100, 1: 3, 2: 1}
+        decay_lateness(lateness)
+        self.assertEqual(lateness, {0: 50, 1: 1})
+
+    def test_lookback_change(self):
+        start = 1568962800.0
+        first_bucket = int(start // 60)
+        lines = ListTailer()
+        for minute in range(9):
+            lines.append(sample_line(PosField.msec, str(start + minute * 60)))
+        status = default_status(lookback_factor=3, last_msec=start - 60)
+        options = parse_options(['-f', 'nginx.log', '--adaptive-lookback', '99'])
+        mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+            lines, status, options
+        )
+        self.assertEqual(sorted(mbs['hits'])[-1][0], first_bucket + 5)
+        self.assertEqual(
+            sorted(leftover), [first_bucket + 6, first_bucket + 7, first_bucket + 8]
+        )
+        # lines were ordered
+        self.assertEqual(status['lateness'], {0: 9})
+
+        # lookback factor lowered from 3 to 1, leftovers ready with the new
+        # factor are processed, nothing is lost
+        status['leftover'] = leftover
+        status['last_msec'] = last_msec
+        status['lookback_factor'] = 1
+        lines = ListTailer([sample_line(PosField.msec, str(start + 9 * 60))])
+        mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+            lines, status, options, previous_lookback_factor=3
+        )
+        self.assertEqual(
+            sorted(k[0] for k in mbs['hits']),
+            [first_bucket + 6, first_bucket + 7, first_bucket + 8],
+        )
+        self.assertEqual(list(leftover), [first_bucket + 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from collections import deque
+import logging
+import tracemalloc
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+)
+from mbstats.memory import (
+    MBS_ENTRY_BYTES,
+    AllocationSites,
+    memory_stats,
+    peak_rss_bytes,
+    rss_bytes,
+    structure_sizes,
+)
+
+
+class TestMemory(unittest.TestCase):
+    def test_rss(self):
+        self.assertGreater(rss_bytes(), 0)
+        self.assertGreaterEqual(peak_rss_bytes(), rss_bytes() // 2)
+
+    def test_structure_sizes(self):
+        leftover = get_storage()
+        leftover[1].append({'vhost': 'a'})
+        leftover[1].append({'vhost': 'b'})
+        leftover[2].append({'vhost': 'c'})
+        mbs = mbsdict()
+        mbs['hits'][(1, 'a', '-', '-')] += 1
+        mbs['hits'][(1, 'b', '-', '-')] += 1
+        saved_points = deque([[{}, {}], [{}]], 10)
+
+        fields = structure_sizes(mbs=mbs, leftover=leftover, saved_points=saved_points)
+        self.assertEqual(fields['mem_leftover_buckets'], 2)
+        self.assertEqual(fields['mem_leftover_rows_per_bucket_max'], 2)
+        self.assertEqual(fields['mem_leftover_rows_per_bucket_mean'], 1.5)
+        self.assertEqual(fields['mem_mbs_entries'], 2)
+        self.assertEqual(fields['mem_mbs_estimated_bytes'], 2 * MBS_ENTRY_BYTES)
+        self.assertEqual(fields['mem_saved_points_batches'], 2)
+        self.assertEqual(fields['mem_saved_points'], 3)
+
+    def test_memory_stats_tracemalloc(self):
+        fields = memory_stats()
+        self.assertNotIn('mem_traced_bytes', fields)
+        self.assertIn('mem_rss_bytes', fields)
+
+        tracemalloc.start()
+        try:
+            fields = memory_stats()
+        finally:
+            tracemalloc.stop()
+        self.assertIn('mem_traced_bytes', fields)
+        self.assertIn('mem_traced_peak_bytes', fields)
+
+    def test_allocation_sites(self):
+        logger = logging.getLogger('test.allocation_sites')
+        sites = AllocationSites(60, top=3, logger=logger)
+        # nothing to log while not tracing
+        self.assertFalse(sites.log(now=0))
+
+        tracemalloc.start()
+        try:
+            with self.assertLogs(logger, level='INFO') as logs:
+                self.assertTrue(sites.log(now=100))
+                # at most once per interval
+                self.assertFalse(sites.log(now=159))
+                self.assertTrue(sites.log(now=160))
+        finally:
+            tracemalloc.stop()
+        self.assertLessEqual(len(logs.output), 6)
+        self.assertTrue(
+            logs.output[0].startswith('INFO:test.allocation_sites:tracemalloc: ')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
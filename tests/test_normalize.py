@@ -0,0 +1,166 @@
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    mbspostprocess,
+    process_bucket,
+)
+from mbstats.cmdline_options import parse_options
+from mbstats.logformat import (
+    DEFAULT_FORMAT,
+    compile_format,
+)
+from mbstats.normalize import (
+    Normalizer,
+    get_normalizers,
+    parse_normalize,
+    split_port,
+)
+from mbstats.sketch import DDSketch
+from mbstats.thresholds import LatencyThresholds
+
+from tests import (
+    SAMPLE_LINE,
+    PosField,
+    default_status,
+)
+
+
+class TestNormalize(unittest.TestCase):
+    def test_parse_normalize(self):
+        self.assertEqual(parse_normalize(''), ())
+        self.assertEqual(parse_normalize([]), ())
+        self.assertEqual(
+            parse_normalize(['upstream:strip_port', ' vhost:lower', 'vhost:s|\\.$||']),
+            (
+                ('vhost', (('lower',), ('rewrite', '\\.$', ''))),
+                ('upstream', (('strip_port',),)),
+            ),
+        )
+        self.assertEqual(
+            parse_normalize('upstream:10.2.2.0/24=web'),
+            (('upstream', (('pool', '10.2.2.0/24', 'web'),)),),
+        )
+        for spec in (
+            'vhost',
+            'vhost:',
+            'status:lower',
+            'vhost:upper',
+            'vhost:s/(/x/',
+            'vhost:s/a/b',
+            'upstream:10.2.2.0/33=web',
+            'upstream:10.2.2.0/24=',
+        ):
+            with self.assertRaises(ValueError, msg=spec):
+                parse_normalize(spec)
+
+    def test_quantifier(self):
+        # commas in regexes are kept
+        rules = parse_normalize([r'loctag:s/^(ws)[0-9]{2,3}$/\1/'])
+        self.assertEqual(
+            rules, (('loctag', (('rewrite', r'^(ws)[0-9]{2,3}$', r'\1'),)),)
+        )
+        normalize = Normalizer(dict(rules)['loctag'])
+        self.assertEqual(normalize('ws12'), 'ws')
+        self.assertEqual(normalize('ws1'), 'ws1')
+
+        options = parse_options(
+            [
+                '-f',
+                'test.log',
+                '--normalize-tags',
+                'vhost:lower',
+                '--normalize-tags',
+                r'loctag:s/^(ws)[0-9]{2,3}$/\1/',
+            ]
+        )
+        self.assertEqual(
+            parse_normalize(options.normalize_tags),
+            (('vhost', (('lower',),)),) + rules,
+        )
+
+    def test_split_port(self):
+        self.assertEqual(split_port('10.2.2.31:65412'), '10.2.2.31')
+        self.assertEqual(split_port('[::1]:8080'), '[::1]')
+        self.assertEqual(split_port('10.2.2.31'), '10.2.2.31')
+        self.assertEqual(split_port('unix:/run/app.sock'), 'unix:/run/app.sock')
+
+    def test_normalizer(self):
+        normalize = Normalizer(
+            dict(
+                parse_normalize(['vhost:lower', r'vhost:s/^www\.//', r'vhost:s/\.$//'])
+            )['vhost']
+        )
+        self.assertEqual(normalize('WWW.MusicBrainz.org.'), 'musicbrainz.org')
+        self.assertEqual(normalize('beta.musicbrainz.org'), 'beta.musicbrainz.org')
+
+    def test_pool(self):
+        normalize = Normalizer(
+            dict(
+                parse_normalize(
+                    [
+                        'upstream:10.2.2.0/24=web',
+                        'upstream:fd00::/8=ws',
+                        'upstream:strip_port',
+                    ]
+                )
+            )['upstream']
+        )
+        self.assertEqual(normalize('10.2.2.31:65412'), 'web')
+        self.assertEqual(normalize('10.2.2.32'), 'web')
+        self.assertEqual(normalize('[fd00::1]:80'), 'ws')
+        self.assertEqual(normalize('10.2.3.1:80'), '10.2.3.1')
+        self.assertEqual(normalize('unix:/run/app.sock'), 'unix:/run/app.sock')
+
+    def test_get_normalizers(self):
+        normalizers = get_normalizers(parse_normalize('vhost:lower'), 2)
+        self.assertEqual(list(normalizers), ['vhost'])
+        normalize = normalizers['vhost']
+        for value in ('A', 'A', 'B', 'A', 'C', 'B'):
+            self.assertEqual(normalize(value), value.lower())
+        info = normalize.cache_info()
+        # rules are applied once per distinct value, in a bounded cache
+        self.assertEqual((info.hits, info.misses), (2, 4))
+        self.assertEqual(info.currsize, 2)
+
+    def test_process_bucket_pool(self):
+        parse = compile_format(
+            DEFAULT_FORMAT, normalize=parse_normalize('upstream:10.0.0.0/24=web')
+        )
+        storage = get_storage()
+        mbs = mbsdict(sketch_factory=DDSketch)
+        status = default_status()
+        line = SAMPLE_LINE.split('|')
+        line[PosField.upstream_addr] = '10.0.0.1:80, 10.0.0.2:80'
+        line[PosField.upstream_status] = '502, 200'
+        line[PosField.upstream_response_time] = '1.000, 2.000'
+        line[PosField.upstream_connect_time] = '0.000, 0.000'
+        line[PosField.upstream_header_time] = '1.000, 2.000'
+        row, last_msec, bucket = parse('|'.join(line), bucket_duration=60)
+        storage[bucket].append(row)
+        thresholds = LatencyThresholds('1.5')
+        process_bucket(
+            bucket,
+            storage,
+            status,
+            mbs,
+            thresholds=thresholds,
+            normalize_upstream=parse.normalize_upstream,
+        )
+        mbspostprocess(mbs)
+
+        # both servers are reported as one pool, each response counted once
+        key = (bucket, 'musicbrainz.org', 's', 'ws', 'web')
+        self.assertEqual(dict(mbs['upstreams_hits']), {key: 2})
+        self.assertEqual(
+            dict(mbs['upstreams_status']), {key + ('502',): 1, key + ('200',): 1}
+        )
+        self.assertAlmostEqual(mbs['upstreams_response_time_mean'][key], 1.5)
+        self.assertEqual(mbs['upstreams_response_time_satisfied'][key], 1)
+        self.assertEqual(mbs['upstreams_response_time_tolerating'][key], 1)
+        self.assertEqual(mbs['_upstreams_response_time_sketch'][key].count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+from argparse import Namespace
+import os.path
+import tempfile
+import unittest
+
+from mbstats.app import (
+    mbsdict,
+    mbsrollup,
+    parsefile,
+)
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.cmdline_options import parse_options
+from mbstats.overload import (
+    adapt_sampling,
+    pending_bytes,
+)
+from mbstats.utils import (
+    StageTimer,
+    msec2bucket,
+)
+from pygtail import Pygtail
+
+from tests import (
+    ListTailer,
+    PosField,
+    default_status,
+    sample_line,
+)
+
+
+class TestOverload(unittest.TestCase):
+    def test_adapt_sampling(self):
+        # 10 MB backlog at 1 MB/s would take 10s
+        self.assertEqual(adapt_sampling(10e6, 1e6, 60, 1, 100), 1)
+        self.assertEqual(adapt_sampling(10e6, 1e6, 5, 1, 100), 2)
+        self.assertEqual(adapt_sampling(10e6, 1e6, 5, 3, 100), 6)
+        self.assertEqual(adapt_sampling(10e6, 1e6, 0.01, 1, 100), 100)
+
+    def test_adapt_sampling_decrease(self):
+        # lowered by half once backlog is small enough
+        self.assertEqual(adapt_sampling(0, 1e6, 5, 8, 100), 4)
+        self.assertEqual(adapt_sampling(3e6, 1e6, 5, 8, 100), 8)
+        self.assertEqual(adapt_sampling(0, 1e6, 5, 1, 100), 1)
+        # but never above maximum
+        self.assertEqual(adapt_sampling(3e6, 1e6, 5, 8, 4), 4)
+
+    def test_adapt_sampling_no_throughput(self):
+        self.assertEqual(adapt_sampling(10e6, 0, 5, 3, 100), 3)
+
+    def test_pending_bytes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'nginx.log')
+            with open(logfile, 'w') as f:
+                f.write('a\nb\n')
+            tailer = Pygtail(logfile, offset_file=logfile + '.offset')
+            self.assertEqual(pending_bytes(tailer), 4)
+            tailer.readlines()
+            tailer = Pygtail(logfile, offset_file=logfile + '.offset')
+            self.assertEqual(pending_bytes(tailer), 0)
+            with open(logfile, 'a') as f:
+                f.write('cc\n')
+            self.assertEqual(pending_bytes(tailer), 3)
+
+    def test_sampling(self):
+        start = 1568962800.0
+        lines = ListTailer()
+        for second in range(5, 305, 5):
+            lines.append(sample_line(PosField.msec, str(start + second)))
+
+        def parse(sampling_rate, args=()):
+            status = default_status(last_msec=start - 60, sampling_rate=sampling_rate)
+            options = parse_options(['-f', 'nginx.log'] + list(args))
+            timer = StageTimer()
+            mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+                lines, status, options, timer=timer
+            )
+            return mbs, parsed_lines, timer
+
+        mbs, parsed_lines, timer = parse(1)
+        self.assertEqual(mbs['_sampling'], {})
+        sampled, sampled_parsed_lines, timer = parse(4)
+        self.assertEqual(sampled_parsed_lines, parsed_lines)
+        self.assertEqual(timer.counters['sampled_out_lines'], 45)
+        # counters are scaled back up, means are unchanged
+        self.assertEqual(dict(sampled['hits']), dict(mbs['hits']))
+        self.assertEqual(dict(sampled['status']), dict(mbs['status']))
+        for k, v in mbs['request_time_mean'].items():
+            self.assertAlmostEqual(sampled['request_time_mean'][k], v)
+        self.assertEqual(
+            dict(sampled['_sampling']), {k[:1]: 4 for k in sampled['hits']}
+        )
+
+        # lines budget is scaled too
+        sampled, sampled_parsed_lines, timer = parse(4, ['--max-lines', '5'])
+        self.assertEqual(sampled_parsed_lines, 20)
+        # but bytes budget is not, it is checked on next sampled line
+        line_bytes = len(lines[0])
+        sampled, sampled_parsed_lines, timer = parse(
+            4, ['--max-bytes', str(10 * line_bytes)]
+        )
+        self.assertEqual(sampled_parsed_lines, 12)
+        self.assertEqual(timer.counters['read_bytes'], 12 * line_bytes)
+
+        backend = InfluxBackend(Namespace(dry_run=True))
+        backend.add_points(sampled, {'bucket_duration': 60})
+        for point in backend.points:
+            self.assertEqual(point['fields']['sampling'], 4)
+
+    def test_sampling_rate_change(self):
+        start = 1568962800.0
+
+        def loops(rates):
+            status = default_status(last_msec=start)
+            options = parse_options(['-f', 'nginx.log'])
+            results = []
+            for i, rate in enumerate(rates):
+                # 12 lines per bucket, so 1 in 4 sampling is exact
+                lines = ListTailer()
+                for second in range(5, 305, 5):
+                    msec = start + i * 300 + second
+                    lines.append(sample_line(PosField.msec, str(msec)))
+                status['sampling_rate'] = rate
+                mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+                    lines, status, options
+                )
+                status['leftover'] = leftover
+                status['last_msec'] = last_msec
+                results.append(mbs)
+            return results
+
+        expected = loops([1, 1, 1])
+        # leftovers keep the rate they were sampled at
+        results = loops([1, 4, 1])
+        for mbs, expected_mbs in zip(results, expected):
+            self.assertEqual(dict(mbs['hits']), dict(expected_mbs['hits']))
+            self.assertEqual(dict(mbs['bytes_sent']), dict(expected_mbs['bytes_sent']))
+        self.assertEqual(results[0]['_sampling'], {})
+        first_bucket = msec2bucket(start, 60)
+        # buckets of first loop leftovers were not sampled
+        self.assertEqual(
+            sorted(results[1]['_sampling']),
+            [(first_bucket + n,) for n in range(6, 9)],
+        )
+        self.assertEqual(
+            sorted(results[2]['_sampling']),
+            [(first_bucket + n,) for n in range(9, 11)],
+        )
+
+        # rollups carry sampling of their buckets
+        rollups = mbsrollup(results[1], {}, [300], 60, (first_bucket + 20) * 60)
+        ((duration, rollup),) = rollups
+        self.assertEqual(set(rollup['_sampling'].values()), {4})
+        backend = InfluxBackend(Namespace(dry_run=True))
+        backend.add_points(mbsdict(), {'bucket_duration': 60}, rollups=rollups)
+        sampled = [p for p in backend.points if 'sampling' in p['fields']]
+        self.assertTrue(sampled)
+        for point in sampled:
+            self.assertTrue(point['measurement'].endswith('_5m'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,53 @@
+from argparse import Namespace
 import contextlib
 import gzip
 import io
+import logging
 import os.path
 import sys
 import tempfile
+import time
 import unittest
 
 from mbstats.app import (
+    MBStatsStatusFileError,
     ParseSkip,
-    PosField,
     get_default_status,
     get_storage,
     main,
+    main_loop,
+    mbscorrect,
     mbsdict,
     mbspostprocess,
+    mbsrollup,
+    parse_budget_reached,
+    parsefile,
+    process_bucket,
+)
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.cmdline_options import parse_options
+from mbstats.idle import (
+    read_offset,
+)
+from mbstats.logformat import (
+    compile_format,
     parse_upstreams,
+)
+from mbstats.safefile import SafeFile
+from mbstats.utils import (
+    StageTimer,
+    bucket2time,
+    load_obj,
+    msec2bucket,
+)
+
+from tests import (
+    SAMPLE_LINE,
+    ListTailer,
+    PosField,
+    default_status,
     parseline,
-    process_bucket,
 )
-from mbstats.utils import bucket2time
 
 LINES_TO_PARSE = 10
 
@@ -43,7 +72,7 @@ class TestParser(unittest.TestCase):
 
         self.log_numlines = count
         # print("Log has %d lines" % self.log_numlines)
-        self.sample_line = '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026|10.2.2.31:65412|200|0.024|0.000|0.024'
+        self.sample_line = SAMPLE_LINE
 
     def get_sample_line(self, n, replace_with='xxx', line=None):
         if line is None:
@@ -136,11 +165,54 @@ class TestParser(unittest.TestCase):
             ]
         )
         self.assertIn('Sending 68 points', output)
+        self.assertIn("'stage_parse_seconds'", output)
+        self.assertIn("'read_bytes'", output)
         remain -= num
 
         # All lines should have been parsed
         self.assertEqual(remain, 0)
 
+    def test_max_bytes(self):
+        with open(self.logfile) as f:
+            lines = f.readlines()
+        max_bytes = len(lines[0]) + len(lines[1]) + 1
+        args = [
+            'testing',
+            '-f',
+            self.logfile,
+            '-w',
+            self.test_dir.name,
+            '--do-not-skip-to-end',
+            '--dry-run',
+            '--log-handler=stdout',
+            '--startover',
+            '--max-bytes',
+            str(max_bytes),
+        ]
+        output = self.call_main(args)
+        # budget is checked after each line, so the line crossing it is kept
+        self.assertIn(' parsed=3 ', output)
+        self.assertIn('Parsing budget reached (max_bytes=%d)' % max_bytes, output)
+
+    def test_parse_budget_reached(self):
+        options = Namespace(max_lines=0, max_bytes=0, max_seconds=0.0)
+        self.assertIsNone(parse_budget_reached(10, 1000, options, 0))
+
+        options = Namespace(max_lines=10, max_bytes=0, max_seconds=0.0)
+        self.assertEqual(parse_budget_reached(10, 1000, options, 0), 'max_lines=10')
+
+        options = Namespace(max_lines=0, max_bytes=1000, max_seconds=0.0)
+        self.assertIsNone(parse_budget_reached(10, 999, options, 0))
+        self.assertEqual(parse_budget_reached(10, 1000, options, 0), 'max_bytes=1000')
+
+        options = Namespace(max_lines=0, max_bytes=0, max_seconds=1.5)
+        deadline = time.time() + 3600
+        self.assertIsNone(parse_budget_reached(10, 1000, options, deadline))
+        deadline = time.time() - 1
+        self.assertEqual(
+            parse_budget_reached(10, 1000, options, deadline), 'max_seconds=1.500'
+        )
+
     def test_parse_upstreams(self):
 
         upstreams = {
@@ -288,10 +360,11 @@ class TestParser(unittest.TestCase):
 
     def test_parseline_version_invalid(self):
         line = self.get_sample_line(PosField.version)
-        with self.assertRaisesRegex(ParseSkip, "^invalid log version: xxx$"):
+        with self.assertRaisesRegex(ParseSkip, "^invalid log version: xxx$") as cm:
             row, last_msec, bucket = parseline(
                 line, ignore_before=0, bucket_duration=1, last_msec=0
             )
+        self.assertEqual(cm.exception.reason, 'version')
 
     def test_parseline_msec_valid(self):
         row, last_msec, bucket = parseline(
@@ -713,6 +786,331 @@ class TestParser(unittest.TestCase):
         self.assertEqual(count_200, 9)
         self.assertEqual(count_302, 10)
 
+    def test_declared_fields(self):
+        start = 1568962800.0  # 2019-09-20T07:00:00, a 5 minutes boundary
+        log_format = (
+            '2|$msec|$host|$statproto|$loctag|$status|$bytes_sent'
+            '|$upstream_bytes_received:int:sum|$ssl_handshake_time:float:mean'
+        )
+        key = ('musicbrainz.org', 's', 'ws')
+        lines = ListTailer()
+        for minute in range(6):
+            for received, handshake in (('12, 3', '0.100'), ('-', '0.300')):
+                lines.append(
+                    f'2|{start + minute * 60 + 1}|musicbrainz.org|s|ws|200|2799'
+                    f'|{received}|{handshake}\n'
+                )
+        status = default_status(last_msec=start - 60)
+        options = parse_options(['-f', self.logfile, '--log-format', log_format])
+        mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+            lines, status, options
+        )
+        bucket = msec2bucket(start + 1, 60)
+        self.assertEqual(mbs['upstream_bytes_received_sum'][(bucket,) + key], 15)
+        self.assertEqual(mbs['_ssl_handshake_time_count'][(bucket,) + key], 2)
+        self.assertAlmostEqual(mbs['ssl_handshake_time_mean'][(bucket,) + key], 0.2)
+
+        parse = compile_format(log_format)
+        completed = mbsrollup(
+            mbs, status['rollups'], [300], 60, start + 300, custom=parse.custom
+        )
+        ((duration, rollup),) = completed
+        rollup_key = (msec2bucket(start + 1, 300),) + key
+        self.assertEqual(rollup['upstream_bytes_received_sum'][rollup_key], 60)
+        self.assertAlmostEqual(rollup['ssl_handshake_time_mean'][rollup_key], 0.2)
+
+        backend = InfluxBackend(
+            Namespace(dry_run=True, log_format=log_format, mean_fields='both')
+        )
+        self.assertEqual(
+            backend.mbs_tags['upstream_bytes_received_sum'],
+            ('vhost', 'protocol', 'loctag'),
+        )
+        self.assertNotIn('_ssl_handshake_time_count', backend.mbs_tags)
+        backend.add_points(mbs, status, rollups=completed)
+        points = {
+            (point['measurement'], point['time']): point['fields']
+            for point in backend.points
+        }
+        time_rfc3339 = bucket2time(bucket, 60)
+        self.assertEqual(
+            points[('upstream_bytes_received_sum', time_rfc3339)], {'value': 15}
+        )
+        fields = points[('ssl_handshake_time_mean', time_rfc3339)]
+        self.assertAlmostEqual(fields['value'], 0.2)
+        self.assertAlmostEqual(fields['sum'], 0.4)
+        self.assertEqual(fields['count'], 2)
+        self.assertIn(
+            ('upstream_bytes_received_sum_5m', '2019-09-20T07:05:00+00:00'), points
+        )
+
+        # late lines of an emitted bucket are added to its saved sums
+        corrections = {}
+        mbscorrect(mbs, corrections, bucket, custom=parse.custom)
+        mbscorrect(mbs, corrections, bucket, custom=parse.custom)
+        mbspostprocess(mbs, parse.custom)
+        self.assertEqual(mbs['upstream_bytes_received_sum'][(bucket,) + key], 30)
+        self.assertAlmostEqual(mbs['ssl_handshake_time_mean'][(bucket,) + key], 0.2)
+
+    def test_mean_fields(self):
+        storage = get_storage()
+        mbs = mbsdict()
+        status = default_status()
+        for request_time in ('0.1', '0.3'):
+            line = self.get_sample_line(PosField.request_time, request_time)
+            row, last_msec, bucket = parseline(line, bucket_duration=60)
+            storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs)
+        mbspostprocess(mbs)
+
+        def get_fields(mean_fields, measurement):
+            backend = InfluxBackend(Namespace(dry_run=True, mean_fields=mean_fields))
+            backend.add_points(mbs, status)
+            for point in backend.points:
+                if point['measurement'] == measurement:
+                    return point['fields']
+
+        fields = get_fields('value', 'request_time_mean')
+        self.assertEqual(list(fields), ['value'])
+        self.assertAlmostEqual(fields['value'], 0.2)
+
+        fields = get_fields('both', 'request_time_mean')
+        self.assertAlmostEqual(fields['value'], 0.2)
+        self.assertAlmostEqual(fields['sum'], 0.4)
+        self.assertEqual(fields['count'], 2)
+
+        fields = get_fields('sums', 'upstreams_response_time_mean')
+        self.assertEqual(fields, {'sum': 0.048, 'count': 2})
+
+        # counters are unchanged
+        self.assertEqual(get_fields('sums', 'hits'), {'value': 2})
+
+    def test_emit(self):
+        start = 1568962800.0
+        lines = ListTailer()
+        for minute in range(20):
+            for second in (1, 30, 59):
+                lines.append(
+                    self.get_sample_line(
+                        PosField.msec, str(start + minute * 60 + second)
+                    )
+                )
+
+        def parse(emit=None):
+            status = default_status(last_msec=start - 60)
+            options = parse_options(['-f', self.logfile, '--percentiles', '50'])
+            return parsefile(lines, status, options, emit=emit)
+
+        mbs, leftover, last_msec, parsed_lines, skipped_lines = parse()
+        self.assertEqual(len(mbs['hits']), 18)
+
+        emitted = []
+        mbs_emit, leftover_emit, *others = parse(
+            emit=lambda part, complete_before: emitted.append((part, complete_before))
+        )
+        self.assertEqual(others, [last_msec, parsed_lines, skipped_lines])
+        self.assertEqual(leftover_emit, leftover)
+        # buckets which may receive lines are kept, others were emitted one by one
+        self.assertEqual(len(mbs_emit['hits']), 3)
+        self.assertEqual(len(emitted), 15)
+        hits = dict(mbs_emit['hits'])
+        for part, complete_before in emitted:
+            self.assertEqual(len(part['hits']), 1)
+            (key,) = part['hits']
+            self.assertEqual(complete_before, key[0] * 60)
+            self.assertIn(key, part['request_time_mean'])
+            self.assertIn(key, part['request_time_p50'])
+            hits.update(part['hits'])
+        self.assertEqual(hits, dict(mbs['hits']))
+
+        # time spent in emitted points isn't accounted to emit nor parse
+        timer = StageTimer()
+
+        def emit(part, complete_before):
+            with timer.measure('points'):
+                time.sleep(0.01)
+
+        status = default_status(last_msec=start - 60)
+        options = parse_options(['-f', self.logfile, '--percentiles', '50'])
+        parsefile(lines, status, options, timer=timer, emit=emit)
+        self.assertGreaterEqual(timer.durations['points'], 0.15)
+        self.assertLess(timer.durations['emit'], 0.1)
+        self.assertLess(timer.durations['parse'], 0.1)
+
+    def test_late_corrections(self):
+        start = 1568962800.0
+        key = ('musicbrainz.org', 's', 'ws')
+
+        def minute_lines(minutes):
+            lines = ListTailer()
+            for minute in minutes:
+                lines.append(
+                    self.get_sample_line(PosField.msec, str(start + minute * 60 + 1))
+                )
+            return lines
+
+        def parse(status, lines, args):
+            options = parse_options(['-f', self.logfile] + args)
+            mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+                lines, status, options
+            )
+            status['leftover'] = leftover
+            status['last_msec'] = last_msec
+            return mbs, skipped_lines
+
+        for args, expected_hits, expected_skipped in (
+            ([], 0, 2),
+            (['--late-grace-buckets', '5'], 3, 0),
+        ):
+            status = default_status(last_msec=start - 60)
+            mbs, skipped = parse(status, minute_lines([0, 1, 3, 4, 5, 6, 7, 8]), args)
+            bucket = int(start // 60) + 4
+            self.assertEqual(mbs['hits'][(bucket,) + key], 1)
+            mbscorrect(mbs, status['corrections'], 0)
+
+            # minute 3 is out of lookback window now, its lines are late
+            mbs, skipped = parse(status, minute_lines([9, 3, 3, 10]), args)
+            self.assertEqual(skipped, expected_skipped)
+            mbscorrect(mbs, status['corrections'], 0)
+            mbspostprocess(mbs)
+            # corrected total includes the line from first loop
+            self.assertEqual(mbs['hits'].get((bucket,) + key, 0), expected_hits)
+
+    def test_disable_measurements(self):
+        lines = ListTailer()
+        for second in range(0, 300, 10):
+            lines.append(self.get_sample_line(PosField.msec, str(1568962800 + second)))
+        status = default_status(last_msec=1568962800 - 60)
+        args = ['--disable-measurements', 'gzip,request_length,upstreams']
+        options = parse_options(['-f', self.logfile] + args)
+        mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+            lines, status, options
+        )
+        self.assertTrue(mbs['hits'])
+        self.assertTrue(mbs['request_time_mean'])
+        self.assertEqual(mbs['gzip_count'], {})
+        self.assertEqual(mbs['_request_length_premean'], {})
+        self.assertEqual(mbs['upstreams_hits'], {})
+
+        backend = InfluxBackend(
+            Namespace(dry_run=True, percentiles='99', disable_measurements=args[1])
+        )
+        self.assertIn('status', backend.mbs_tags)
+        self.assertIn('request_time_mean', backend.mbs_tags)
+        self.assertIn('request_time_p99', backend.mbs_tags)
+        self.assertNotIn('gzip_ratio_mean', backend.mbs_tags)
+        self.assertNotIn('hits_with_upstream', backend.mbs_tags)
+        self.assertNotIn('upstreams_response_time_p99', backend.mbs_tags)
+
+    def test_skipped_lines_log(self):
+        start = 1568962800.0
+        lines = ListTailer()
+        lines.append(self.get_sample_line(PosField.msec, str(start)))
+        for _i in range(20):
+            lines.append(self.get_sample_line(PosField.msec, str(start - 600)))
+        for _i in range(2):
+            lines.append(self.get_sample_line(0, '2'))
+        status = default_status(last_msec=start - 60)
+        options = parse_options(['-f', self.logfile, '--skip-log-limit', '5'])
+        timer = StageTimer()
+        logger = logging.getLogger('test.skipped')
+        with self.assertLogs(logger, level='INFO') as logs:
+            mbs, leftover, last_msec, parsed_lines, skipped_lines = parsefile(
+                lines, status, options, logger=logger, timer=timer
+            )
+        self.assertEqual(skipped_lines, 22)
+        self.assertEqual(
+            len([log for log in logs.output if 'unordered or old entry' in log]), 5
+        )
+        self.assertEqual(
+            len([log for log in logs.output if 'invalid log version' in log]), 2
+        )
+        self.assertIn(
+            'WARNING:test.skipped:Skipped 22 lines (late=20 version=2), 15 not logged',
+            logs.output,
+        )
+        fields = timer.fields()
+        self.assertEqual(fields['skipped_lines_late'], 20)
+        self.assertEqual(fields['skipped_lines_version'], 2)
+        self.assertNotIn('skipped_lines_filtered', fields)
+
+        # filtered lines aren't logged, only counted
+        status['last_msec'] = start - 60
+        options = parse_options(
+            [
+                '-f',
+                self.logfile,
+                '--skip-log-limit',
+                '5',
+                '--exclude-lines',
+                'loctag=ws',
+            ]
+        )
+        timer = StageTimer()
+        with self.assertLogs(logger, level='INFO') as logs:
+            parsefile(
+                ListTailer(lines[:21]), status, options, logger=logger, timer=timer
+            )
+        self.assertEqual(
+            logs.output[-1], 'INFO:test.skipped:Skipped 21 lines (filtered=21)'
+        )
+        self.assertFalse([log for log in logs.output if log.startswith('ERROR')])
+        fields = timer.fields()
+        self.assertEqual(fields['skipped_lines_filtered'], 21)
+        self.assertNotIn('skipped_lines_late', fields)
+        self.assertNotIn('skipped_lines_version', fields)
+
+    def test_emit_send_failure(self):
+        workdir = self.test_dir.name
+        options = parse_options(
+            [
+                '-f',
+                self.logfile,
+                '-w',
+                workdir,
+                '--do-not-skip-to-end',
+                '--dry-run',
+                '--simulate-send-failure',
+                '--emit-buffer-points',
+                '1',
+            ]
+        )
+        logger = logging.getLogger('test_emit_send_failure')
+        status_file = SafeFile(workdir, self.logfile, suffix='.status')
+        start = 1568962800.0
+        with open(self.logfile, 'w') as f:
+            for second in range(0, 600, 10):
+                f.write(self.get_sample_line(PosField.msec, str(start + second)))
+                f.write('\n')
+
+        fields = main_loop(options, logger, first_loop=True)
+        self.assertEqual(fields['sent_points'], 0)
+        # sends stopped after first failure, points of the loop were saved
+        # as a single entry of the fifo
+        status = load_obj(status_file.main)
+        self.assertEqual(len(status['saved_points']), 1)
+        self.assertGreater(len(status['saved_points'][0]), 1)
+
+    def test_truncated_log_failed_loop(self):
+        workdir = self.test_dir.name
+        args = ['-f', self.logfile, '-w', workdir, '--do-not-skip-to-end', '--dry-run']
+        logger = logging.getLogger('test_truncated_log_failed_loop')
+        offset_file = SafeFile(workdir, self.logfile, suffix='.offset')
+
+        main_loop(parse_options(args), logger, first_loop=True)
+        offset = read_offset(offset_file.main)
+        self.assertNotEqual(offset[1], 0)
+
+        # log file is truncated and rotated file cannot be found, Pygtail
+        # resets its offset, but the loop fails: main offset is unchanged
+        with open(self.logfile, 'w') as f:
+            f.write(self.sample_line + '\n')
+        options = parse_options(args + ['--bucket-duration', '30'])
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(MBStatsStatusFileError):
+                main_loop(options, logger)
+        self.assertEqual(read_offset(offset_file.main), offset)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import os.path
+import pstats
+import sys
+import tempfile
+import unittest
+
+from mbstats.profiling import (
+    LoopProfiler,
+    StackSampler,
+    rotate_files,
+)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        # Create a temporary directory
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.basepath = os.path.join(self.test_dir.name, 'test')
+
+    def tearDown(self):
+        # Close the file, the directory will be removed after the test
+        self.test_dir.cleanup()
+
+    def test_rotate_files(self):
+        for i in range(5):
+            path = rotate_files(self.basepath, '.pstats', 3)
+            self.assertEqual(path, self.basepath + '.pstats')
+            with open(path, 'w') as f:
+                f.write(str(i))
+
+        expect = {
+            '.pstats': '4',
+            '.1.pstats': '3',
+            '.2.pstats': '2',
+        }
+        for suffix, payload in expect.items():
+            with open(self.basepath + suffix) as f:
+                self.assertEqual(f.read(), payload)
+        self.assertFalse(os.path.exists(self.basepath + '.3.pstats'))
+
+    def test_loop_profiler(self):
+        profiler = LoopProfiler(self.basepath, keep=2)
+        self.assertEqual(profiler.runcall(sum, [1, 2, 3]), 6)
+        stats = pstats.Stats(self.basepath + '.pstats')
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_stack_sampler(self):
+        sampler = StackSampler(self.basepath)
+        for _i in range(2):
+            sampler._sample(None, sys._getframe())
+        sampler.dump()
+        with open(self.basepath + '.samples') as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('test_profiling.py:test_stack_sampler:', lines[0])
+        self.assertTrue(lines[0].endswith(' 2\n'))
+
+        # signal handler only records the request
+        sampler.request_toggle()
+        self.assertFalse(sampler.running)
+        sampler.update()
+        self.assertTrue(sampler.running)
+        sampler.update()
+        self.assertTrue(sampler.running)
+        sampler.request_toggle()
+        sampler.update()
+        self.assertFalse(sampler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
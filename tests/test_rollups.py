@@ -0,0 +1,81 @@
+from argparse import Namespace
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    mbspostprocess,
+    mbsrollup,
+    process_bucket,
+)
+from mbstats.backends.influxdb import InfluxBackend
+from mbstats.utils import bucket2time
+
+from tests import (
+    PosField,
+    default_status,
+    parseline,
+    sample_line,
+)
+
+
+class TestRollups(unittest.TestCase):
+    def test_rollups(self):
+        bucket_duration = 60
+        status = default_status(bucket_duration)
+        start = 1568962800.0  # 2019-09-20T07:00:00, a 5 minutes boundary
+        key = ('musicbrainz.org', 's', 'ws')
+
+        def parse_minutes(minutes):
+            storage = get_storage()
+            mbs = mbsdict()
+            for minute in minutes:
+                for request_time in ('0.1', '0.3'):
+                    line = sample_line(PosField.msec, str(start + minute * 60 + 1))
+                    line = sample_line(PosField.request_time, request_time, line=line)
+                    row, last_msec, bucket = parseline(line, bucket_duration=60)
+                    storage[bucket].append(row)
+            for bucket in list(storage):
+                process_bucket(bucket, storage, status, mbs)
+            mbspostprocess(mbs)
+            return mbs
+
+        # first loop, minutes 0 to 3 of first 5 minutes rollup
+        mbs = parse_minutes(range(4))
+        completed = mbsrollup(
+            mbs, status['rollups'], [300], bucket_duration, start + 4 * 60
+        )
+        self.assertEqual(completed, [])
+        rollup_bucket = int(start // 300) + 1
+        self.assertEqual(status['rollups'][300]['hits'][(rollup_bucket,) + key], 8)
+
+        # second loop, minute 4 completes first rollup, minute 5 starts next one
+        mbs = parse_minutes([4, 5])
+        completed = mbsrollup(
+            mbs, status['rollups'], [300], bucket_duration, start + 5 * 60
+        )
+        self.assertEqual(len(completed), 1)
+        duration, rollup = completed[0]
+        self.assertEqual(duration, 300)
+        self.assertEqual(rollup['hits'], {(rollup_bucket,) + key: 10})
+        self.assertAlmostEqual(rollup['request_time_mean'][(rollup_bucket,) + key], 0.2)
+        self.assertEqual(bucket2time(rollup_bucket, 300), '2019-09-20T07:05:00+00:00')
+        backend = InfluxBackend(Namespace(dry_run=True))
+        backend.add_points(mbsdict(), status, rollups=completed)
+        measurements = {point['measurement'] for point in backend.points}
+        self.assertIn('hits_5m', measurements)
+        self.assertIn('request_time_mean_5m', measurements)
+        self.assertEqual(backend.points[0]['time'], '2019-09-20T07:05:00+00:00')
+
+        # remaining partial rollup is kept
+        self.assertEqual(
+            dict(status['rollups'][300]['hits']), {(rollup_bucket + 1,) + key: 2}
+        )
+
+        # rollups removed from options are dropped
+        mbsrollup(mbsdict(), status['rollups'], [], bucket_duration, start)
+        self.assertEqual(status['rollups'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
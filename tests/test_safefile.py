@@ -1,7 +1,11 @@
+import os
 import tempfile
 import unittest
 
-from mbstats.safefile import SafeFile
+from mbstats.safefile import (
+    FSYNC_POLICIES,
+    SafeFile,
+)
 
 
 class TestSafeFile(unittest.TestCase):
@@ -81,6 +85,23 @@ class TestSafeFile(unittest.TestCase):
             read_payload = read_data(attr)
             self.assertEqual(expect[attr], read_payload, attr)
 
+    def test_rename_tmp_to_main(self):
+        for fsync in FSYNC_POLICIES:
+            safefile = SafeFile(self.test_dir.name, 'test_' + fsync, fsync=fsync)
+            with open(safefile.main, 'wb') as f:
+                f.write(b'main')
+            inode = os.stat(safefile.main).st_ino
+            with open(safefile.tmp, 'wb') as f:
+                f.write(b'tmp')
+            safefile.rename_tmp_to_main()
+            # previous generation is linked, not copied
+            self.assertEqual(os.stat(safefile.old).st_ino, inode)
+            with open(safefile.old, 'rb') as f:
+                self.assertEqual(f.read(), b'main')
+            with open(safefile.main, 'rb') as f:
+                self.assertEqual(f.read(), b'tmp')
+            self.assertFalse(os.path.exists(safefile.tmp))
+
 
 if __name__ == '__main__':
     unittest.main()
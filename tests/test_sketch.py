@@ -0,0 +1,124 @@
+import pickle
+import random
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    mbspercentiles,
+    mbspostprocess,
+    process_bucket,
+)
+from mbstats.sketch import (
+    DDSketch,
+    parse_percentiles,
+    percentile_suffix,
+)
+
+from tests import (
+    PosField,
+    default_status,
+    parseline,
+    sample_line,
+)
+
+
+class TestSketch(unittest.TestCase):
+    def test_quantiles_accuracy(self):
+        rng = random.Random(1)
+        values = sorted(rng.expovariate(10.0) for _i in range(20000))
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+
+        self.assertEqual(sketch.count, len(values))
+        for q in (0.5, 0.9, 0.95, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), expected, delta=expected * 0.02)
+
+    def test_zero_and_empty(self):
+        sketch = DDSketch()
+        self.assertIsNone(sketch.quantile(0.5))
+        for value in (0.0, 0.0, 0.0, 1.0):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertAlmostEqual(sketch.quantile(1.0), 1.0, delta=0.01)
+
+    def test_merge(self):
+        sketch1 = DDSketch()
+        sketch2 = DDSketch()
+        for i in range(1, 101):
+            sketch1.add(i / 1000.0)
+            sketch2.add(i / 10.0)
+        sketch1.merge(sketch2)
+        self.assertEqual(sketch1.count, 200)
+        self.assertAlmostEqual(sketch1.quantile(0.75), 5.0, delta=0.1)
+
+        with self.assertRaises(ValueError):
+            sketch1.merge(DDSketch(relative_accuracy=0.05))
+
+    def test_max_bins(self):
+        sketch = DDSketch(max_bins=10)
+        for i in range(1, 1000):
+            sketch.add(i / 100.0)
+        self.assertLessEqual(len(sketch.bins), 10)
+        self.assertEqual(sketch.count, 999)
+        # highest quantiles are unaffected by collapsing
+        self.assertAlmostEqual(sketch.quantile(0.999), 9.98, delta=0.2)
+
+    def test_pickle(self):
+        sketch = DDSketch()
+        sketch.add(0.123)
+        restored = pickle.loads(pickle.dumps(sketch, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(restored.bins, sketch.bins)
+        self.assertEqual(restored.quantile(0.5), sketch.quantile(0.5))
+
+    def test_parse_percentiles(self):
+        self.assertEqual(parse_percentiles(''), [])
+        self.assertEqual(parse_percentiles('50,99.9'), [50.0, 99.9])
+        with self.assertRaises(ValueError):
+            parse_percentiles('100')
+        with self.assertRaises(ValueError):
+            parse_percentiles('x')
+
+    def test_percentile_suffix(self):
+        self.assertEqual(percentile_suffix(95.0), 'p95')
+        self.assertEqual(percentile_suffix(99.9), 'p99_9')
+
+    def test_process_bucket_percentiles(self):
+        storage = get_storage()
+        mbs = mbsdict(sketch_factory=DDSketch)
+        status = default_status()
+        for i in range(1, 101):
+            line = sample_line(PosField.request_time, replace_with=str(i))
+            row, last_msec, bucket = parseline(line, bucket_duration=60)
+            storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs)
+        mbspostprocess(mbs)
+        mbspercentiles(mbs, status['sketches'], [50, 99], bucket)
+
+        key = (bucket, 'musicbrainz.org', 's', 'ws')
+        self.assertAlmostEqual(mbs['request_time_p50'][key], 50, delta=1)
+        self.assertAlmostEqual(mbs['request_time_p99'][key], 99, delta=1)
+        upstream_key = key + ('10.2.2.31:65412',)
+        self.assertAlmostEqual(
+            mbs['upstreams_response_time_p50'][upstream_key], 0.024, delta=0.001
+        )
+
+        # a later loop, with more lines for the same bucket, merges saved sketch
+        mbs = mbsdict(sketch_factory=DDSketch)
+        for _i in range(100):
+            line = sample_line(PosField.request_time, replace_with='1000')
+            row, last_msec, bucket = parseline(line, bucket_duration=60)
+            storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs)
+        mbspostprocess(mbs)
+        mbspercentiles(mbs, status['sketches'], [50, 99], bucket + 1)
+        self.assertAlmostEqual(mbs['request_time_p99'][key], 1000, delta=20)
+        self.assertAlmostEqual(mbs['request_time_p50'][key], 100, delta=5)
+        # bucket is before keep_from, so its sketch is discarded
+        self.assertEqual(status['sketches']['request_time'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
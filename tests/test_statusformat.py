@@ -0,0 +1,174 @@
+from collections import (
+    defaultdict,
+    deque,
+)
+import pickle
+import unittest
+
+from mbstats.app import get_storage
+from mbstats.cardinality import HeavyHitters
+from mbstats.sketch import DDSketch
+from mbstats.statusformat import (
+    MAGIC,
+    StatusFormatError,
+    dumps,
+    loads,
+    loads_pickle,
+)
+
+from tests import (
+    default_status,
+    parseline,
+)
+
+LINES = (
+    '1|1568962563.374|musicbrainz.org|s|ws|200|2799|2.5|289|0.026'
+    '|10.2.2.31:65412, 10.2.2.32:65412 : 10.2.2.33:80|200, 502 : 200'
+    '|0.024, 0.048 : 0.010|0.000, 0.000 : -|0.024, 0.024 : 0.010',
+    '1|1568962563.412|beta.musicbrainz.org|-|-|304|0|-|300|0.001|-|-|-|-|-',
+    '1|1568962624.001|musicbrainz.org|s|ws|200|2799|-|289|-'
+    '|10.2.2.31:65412|200|0.024|0.000|0.024',
+)
+
+
+class TestStatusFormat(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        restored = loads(dumps(value))
+        self.assertEqual(restored, value)
+        self.assertIs(type(restored), type(value))
+        return restored
+
+    def test_values(self):
+        for value in (
+            None,
+            True,
+            False,
+            0,
+            -(2**63),
+            2**100,
+            -1.5,
+            '',
+            'élément',
+            b'\x00\xff',
+            [1, 'a', None],
+            (1, ('a', None)),
+            {'a', 'b'},
+            {(12, 'musicbrainz.org', None): 3, 'x': {'y': [1.0]}},
+        ):
+            self.assertRoundTrip(value)
+
+    def test_containers(self):
+        restored = self.assertRoundTrip(deque([[1], [2]], 30))
+        self.assertEqual(restored.maxlen, 30)
+        for factory in (int, float, deque):
+            d = defaultdict(factory)
+            d[(1, 'a')]
+            restored = self.assertRoundTrip(d)
+            self.assertIs(restored.default_factory, factory)
+        with self.assertRaises(TypeError):
+            dumps(defaultdict(lambda: 0))
+        with self.assertRaises(TypeError):
+            dumps(object())
+
+    def test_table(self):
+        rows = [
+            {'a': 1, 'b': 'x', 'c': [1, 2]},
+            {'a': 2, 'b': 'y'},
+            {'a': 2**70, 'b': 'x', 'c': []},
+            {},
+            {'a': 1.5, 'b': None},
+        ]
+        restored = self.assertRoundTrip(rows)
+        self.assertEqual([list(row) for row in restored], [list(row) for row in rows])
+
+        # columns of defaultdicts, with one item each or not
+        for sizes in ((1, 1, 1), (2, 0, 1), (0, 0)):
+            rows = [
+                {'t': defaultdict(float, {f'server{i}': 0.5 for i in range(size)})}
+                for size in sizes
+            ]
+            restored = self.assertRoundTrip(rows)
+            for row in restored:
+                self.assertIs(row['t'].default_factory, float)
+
+    def test_rows(self):
+        storage = get_storage()
+        for line in LINES:
+            row, last_msec, bucket = parseline(line, bucket_duration=60)
+            storage[bucket].append(row)
+        restored = self.assertRoundTrip(storage)
+        for bucket, rows in storage.items():
+            for row, restored_row in zip(rows, restored[bucket]):
+                if 'upstreams' in row:
+                    upstreams = restored_row['upstreams']
+                    self.assertIs(type(upstreams['response_time']), defaultdict)
+                    self.assertEqual(upstreams['response_time']['unknown'], 0.0)
+
+    def test_objects(self):
+        sketch = DDSketch()
+        for i in range(100):
+            sketch.add(i / 100.0)
+        restored = loads(dumps(sketch))
+        self.assertEqual(restored.bins, sketch.bins)
+        self.assertEqual(restored.quantile(0.5), sketch.quantile(0.5))
+        restored.add(0.5)
+        self.assertEqual(restored.count, 101)
+
+        hh = HeavyHitters(2)
+        for value in 'abacab':
+            hh(value, 1)
+        hh.start_loop()
+        restored = loads(dumps(hh))
+        self.assertEqual(vars(restored), vars(hh))
+        self.assertEqual(restored('a'), hh('a'))
+
+    def get_status(self):
+        status = default_status(leftover=get_storage())
+        row, status['last_msec'], bucket = parseline(LINES[0])
+        status['leftover'][bucket].append(row)
+        status['saved_points'].append(
+            [
+                {
+                    'measurement': 'hits',
+                    'tags': {'vhost': 'musicbrainz.org'},
+                    'time': '2019-09-20T06:56:00+00:00',
+                    'fields': {'value': 3},
+                }
+            ]
+            * 2
+        )
+        status['lateness'] = {0: 12, 2: 1}
+        return status
+
+    def test_status(self):
+        status = self.get_status()
+        restored = self.assertRoundTrip(status)
+        self.assertEqual(restored['saved_points'].maxlen, 30)
+
+    def test_legacy_pickle(self):
+        # status files saved before the status format
+        status = self.get_status()
+        data = pickle.dumps(status, pickle.HIGHEST_PROTOCOL)
+        with self.assertRaisesRegex(StatusFormatError, 'Not in status format'):
+            loads(data)
+        restored = loads_pickle(data)
+        self.assertEqual(restored, status)
+        self.assertEqual(restored['saved_points'].maxlen, 30)
+        # once saved again, it is in status format
+        self.assertRoundTrip(restored)
+        with self.assertRaisesRegex(StatusFormatError, 'Forbidden global'):
+            loads_pickle(pickle.dumps(object()))
+
+    def test_invalid(self):
+        data = dumps({'last_msec': 1.0, 'leftover': None})
+        with self.assertRaisesRegex(StatusFormatError, 'Not in status format'):
+            loads(b'\x80\x05')
+        with self.assertRaisesRegex(StatusFormatError, 'version'):
+            loads(MAGIC + b'\x02' + data[len(MAGIC) + 1 :])
+        for truncated in (data[:-1], data + b'\x00', MAGIC + b'\x01\xfe'):
+            with self.assertRaises(StatusFormatError):
+                loads(truncated)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from mbstats.app import (
+    get_storage,
+    mbsdict,
+    mbspostprocess,
+    process_bucket,
+)
+from mbstats.thresholds import (
+    FRUSTRATED,
+    SATISFIED,
+    TOLERATING,
+    LatencyThresholds,
+    classify,
+    parse_thresholds,
+)
+
+from tests import (
+    SAMPLE_LINE,
+    PosField,
+    default_status,
+    parseline,
+    sample_line,
+)
+
+
+class TestThresholds(unittest.TestCase):
+    def test_parse_thresholds(self):
+        self.assertEqual(parse_thresholds(''), {})
+        expected = {
+            (None, None): 0.5,
+            ('example.org', None): 0.3,
+            ('example.org', 'ws'): 1.0,
+        }
+        self.assertEqual(
+            parse_thresholds('0.5, example.org=0.3,example.org/ws=1.0'), expected
+        )
+        self.assertEqual(
+            parse_thresholds({'*': 0.5, 'example.org': '0.3', 'example.org/ws': 1}),
+            expected,
+        )
+        with self.assertRaises(ValueError):
+            parse_thresholds('example.org=x')
+        with self.assertRaises(ValueError):
+            parse_thresholds('example.org=0')
+
+    def test_latency_thresholds(self):
+        thresholds = LatencyThresholds('example.org=0.3,example.org/ws=1.0')
+        self.assertTrue(thresholds)
+        self.assertEqual(thresholds.get('example.org', 'ws'), 1.0)
+        self.assertEqual(thresholds.get('example.org', '-'), 0.3)
+        self.assertIsNone(thresholds.get('other.org', '-'))
+        # memoized
+        self.assertEqual(thresholds.get('example.org', '-'), 0.3)
+        self.assertEqual(len(thresholds._cache), 3)
+
+        thresholds = LatencyThresholds('0.5')
+        self.assertEqual(thresholds.get('other.org', '-'), 0.5)
+        self.assertFalse(LatencyThresholds(''))
+
+    def test_classify(self):
+        self.assertEqual(classify(0.5, 0.5), SATISFIED)
+        self.assertEqual(classify(0.6, 0.5), TOLERATING)
+        self.assertEqual(classify(2.0, 0.5), TOLERATING)
+        self.assertEqual(classify(2.1, 0.5), FRUSTRATED)
+
+    def test_process_bucket_thresholds(self):
+        storage = get_storage()
+        mbs = mbsdict()
+        status = default_status()
+        thresholds = LatencyThresholds('1.0,musicbrainz.org/xxx=10')
+        for request_time in ('0.5', '1.0', '2', '4', '5', '6'):
+            line = sample_line(PosField.request_time, request_time)
+            row, last_msec, bucket = parseline(line, bucket_duration=60)
+            storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs, thresholds=thresholds)
+        mbspostprocess(mbs)
+
+        key = (bucket, 'musicbrainz.org', 's', 'ws')
+        self.assertEqual(mbs['request_time_satisfied'][key], 2)
+        self.assertEqual(mbs['request_time_tolerating'][key], 2)
+        self.assertEqual(mbs['request_time_frustrated'][key], 2)
+        self.assertEqual(mbs['request_time_apdex'][key], 0.5)
+        upstream_key = key + ('10.2.2.31:65412',)
+        self.assertEqual(mbs['upstreams_response_time_satisfied'][upstream_key], 6)
+        self.assertEqual(mbs['upstreams_response_time_apdex'][upstream_key], 1.0)
+
+        # no thresholds, no counters
+        mbs = mbsdict()
+        row, last_msec, bucket = parseline(SAMPLE_LINE, bucket_duration=60)
+        storage[bucket].append(row)
+        process_bucket(bucket, storage, status, mbs)
+        mbspostprocess(mbs)
+        self.assertEqual(mbs['hits'][key], 1)
+        self.assertEqual(mbs['request_time_satisfied'], {})
+        self.assertEqual(mbs['request_time_apdex'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
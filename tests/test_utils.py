@@ -1,21 +1,45 @@
+from collections import (
+    defaultdict,
+    deque,
+)
 import json
 from json.decoder import JSONDecodeError
 import os.path
+import pickle
 import tempfile
+import time
 import unittest
 
+from mbstats.sketch import DDSketch
+from mbstats.statusformat import (
+    MAGIC,
+    StatusFormatError,
+)
 from mbstats.utils import (
+    StageTimer,
     _read_config,
     bucket2time,
     lineno,
     load_obj,
     msec2bucket,
+    parse_rollups,
     read_config,
     save_obj,
     timestamp_RFC3339,
 )
 
 
+class Payload:
+    called = False
+
+    def __reduce__(self):
+        return (Payload.run, ())
+
+    @staticmethod
+    def run():
+        Payload.called = True
+
+
 class TestUtils(unittest.TestCase):
     def setUp(self):
         # Create a temporary directory
@@ -26,7 +50,7 @@ class TestUtils(unittest.TestCase):
         self.test_dir.cleanup()
 
     def test_lineno(self):
-        self.assertEqual(lineno(), 29)  #  if this line moves, change the number
+        self.assertEqual(lineno(), 53)  #  if this line moves, change the number
 
     def test_save_load_obj(self):
         obj = {'test': 666}
@@ -35,6 +59,39 @@ class TestUtils(unittest.TestCase):
         read_obj = load_obj(filepath)
         self.assertEqual(obj, read_obj)
 
+    def test_load_obj_pickle(self):
+        # status files saved by previous versions
+        obj = {'test': 666}
+        filepath = os.path.join(self.test_dir.name, 'testfile')
+        with open(filepath, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        self.assertEqual(load_obj(filepath), obj)
+        save_obj(obj, filepath)
+        with open(filepath, 'rb') as f:
+            self.assertTrue(f.read().startswith(MAGIC))
+
+        # types found in status are allowed
+        obj = {
+            'leftover': defaultdict(list, {1: [{'a': 1.5}]}),
+            'saved_points': deque([[{'b': 'c'}]]),
+            'sketches': {('x',): DDSketch(0.01)},
+        }
+        obj['sketches'][('x',)].add(0.5)
+        with open(filepath, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        loaded = load_obj(filepath)
+        self.assertEqual(loaded['leftover'], obj['leftover'])
+        self.assertIs(loaded['leftover'].default_factory, list)
+        self.assertEqual(loaded['saved_points'], obj['saved_points'])
+        self.assertEqual(loaded['sketches'][('x',)].count, 1)
+
+        # anything else is refused, as loading it could execute code
+        with open(filepath, 'wb') as f:
+            pickle.dump({'status': Payload()}, f, pickle.HIGHEST_PROTOCOL)
+        with self.assertRaises(StatusFormatError):
+            load_obj(filepath)
+        self.assertFalse(Payload.called)
+
     def test_read_json_config(self):
         conf_file = os.path.join(self.test_dir.name, 'config')
         payload = '{a: 1}'
@@ -109,6 +166,65 @@ class TestUtils(unittest.TestCase):
         do_test(msec, 3600, '2019-09-20T07:00:00+00:00', 435823)
         do_test(msec, 7200, '2019-09-20T08:00:00+00:00', 217912)
 
+    def test_stage_timer(self):
+        timer = StageTimer()
+        with timer.measure('stage1'):
+            pass
+        timer.add('stage1', 1.0)
+        items = list(timer.timed_iter(range(3), 'read'))
+        self.assertEqual(items, [0, 1, 2])
+        timer.count('bytes', 10)
+        timer.count('bytes', 5)
+
+        fields = timer.fields()
+        self.assertGreaterEqual(fields['stage_stage1_seconds'], 1.0)
+        self.assertIn('stage_read_seconds', fields)
+        self.assertEqual(fields['bytes'], 15)
+
+    def test_stage_timer_nested(self):
+        timer = StageTimer()
+        with timer.measure('outer'):
+            with timer.measure('inner'):
+                time.sleep(0.01)
+            # time measured elsewhere, ie. by the influxdb client
+            start = time.perf_counter()
+            time.sleep(0.01)
+            timer.add('added', time.perf_counter() - start)
+        self.assertGreaterEqual(timer.durations['inner'], 0.01)
+        self.assertGreaterEqual(timer.durations['added'], 0.01)
+        # nested time is not accounted twice
+        self.assertLess(timer.durations['outer'], 0.01)
+        self.assertGreaterEqual(timer.durations['outer'], 0.0)
+
+    def test_stage_timer_timed_iter(self):
+        def slow():
+            for i in range(8):
+                time.sleep(0.002)
+                yield i
+
+        timer = StageTimer()
+        with timer.measure('outer'):
+            items = list(timer.timed_iter(slow(), 'read', every=4))
+        self.assertEqual(items, list(range(8)))
+        # 1 in 4 fetches is timed, standing for 4 fetches
+        self.assertGreaterEqual(timer.durations['read'], 0.016)
+        # and is not accounted to the enclosing stage
+        self.assertLess(timer.durations['outer'], 0.008)
+        self.assertGreaterEqual(timer.durations['outer'], 0.0)
+
+        # consumer stopping early
+        timer = StageTimer()
+        iterator = timer.timed_iter(iter(range(200)), 'read', every=4)
+        self.assertEqual([next(iterator) for _ in range(5)], list(range(5)))
+        self.assertEqual(list(iterator), list(range(5, 200)))
+
+    def test_parse_rollups(self):
+        self.assertEqual(parse_rollups('', 60), [])
+        self.assertEqual(parse_rollups('300,3600', 60), [300, 3600])
+        for rollups in ('90', '60', 'x'):
+            with self.assertRaises(ValueError, msg=rollups):
+                parse_rollups(rollups, 60)
+
 
 if __name__ == '__main__':
     unittest.main()